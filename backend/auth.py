@@ -7,12 +7,19 @@ import jwt
 import os
 from models import User
 from database import get_collection
+from cache import TTLCache
+from services.search_backend import folded_name_fields
 
 # Security configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "kingchat_secret_key_change_in_production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
 
+# Authenticated-user cache: saves the users lookup on every request
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
@@ -50,10 +57,21 @@ def verify_token(token: str):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+def invalidate_cached_user(user_id: str):
+    """Drop a user from the auth cache; call after any write to their document"""
+    user_cache.invalidate(user_id)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+    return await get_user_from_token(credentials.credentials)
+
+async def get_user_from_token(token: str) -> User:
+    """Resolve a bearer token to its user (for transports without headers, e.g. WebSockets)"""
     user_id = verify_token(token)
     
+    cached_user = user_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user
+    
     users_collection = await get_collection("users")
     user_data = await users_collection.find_one({"id": user_id})
     
@@ -64,7 +82,9 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    return User(**user_data)
+    user = User(**user_data)
+    user_cache.set(user_id, user)
+    return user
 
 # Simple auth for demo - create a default user
 async def create_demo_user():
@@ -83,11 +103,13 @@ async def create_demo_user():
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
+    demo_user.update(folded_name_fields(demo_user))
     
     # Check if demo user already exists
     existing_user = await users_collection.find_one({"id": "demo_user_123"})
     if not existing_user:
         await users_collection.insert_one(demo_user)
+        invalidate_cached_user(demo_user["id"])
         print("✅ Demo user created")
     
     return demo_user
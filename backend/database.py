@@ -1,13 +1,16 @@
 import os
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import Optional
+import asyncio
 import logging
+from indexes import sync_indexes
 
 logger = logging.getLogger(__name__)
 
 class Database:
     client: Optional[AsyncIOMotorClient] = None
     database = None
+    index_task: Optional[asyncio.Task] = None
 
 db = Database()
 
@@ -26,8 +29,8 @@ async def connect_to_mongo():
         await db.database.command("ping")
         logger.info("✅ Successfully connected to MongoDB")
         
-        # Create indexes for better performance
-        await create_indexes()
+        # Build missing indexes in the background so startup is not blocked
+        db.index_task = asyncio.create_task(create_indexes())
         
     except Exception as e:
         logger.error(f"❌ Failed to connect to MongoDB: {e}")
@@ -35,40 +38,18 @@ async def connect_to_mongo():
 
 async def close_mongo_connection():
     """Close database connection"""
+    if db.index_task and not db.index_task.done():
+        db.index_task.cancel()
     if db.client:
         db.client.close()
         logger.info("✅ Disconnected from MongoDB")
 
 async def create_indexes():
-    """Create database indexes for better performance"""
+    """Sync database indexes with the declarative registry in indexes.py"""
     try:
         database = await get_database()
-        
-        # Users indexes
-        await database.users.create_index("username", unique=True, sparse=True)
-        await database.users.create_index("email", unique=True, sparse=True)
-        
-        # Chats indexes
-        await database.chats.create_index("participants")
-        await database.chats.create_index("members")
-        await database.chats.create_index("type")
-        await database.chats.create_index("is_public")
-        await database.chats.create_index("updated_at")
-        
-        # Messages indexes
-        await database.messages.create_index([("chat_id", 1), ("timestamp", -1)])
-        await database.messages.create_index("sender_id")
-        await database.messages.create_index("reply_to")
-        await database.messages.create_index("scheduled_for")
-        await database.messages.create_index([("text", "text")])  # Text search
-        
-        # Folders indexes
-        await database.folders.create_index([("user_id", 1), ("folder_type", 1)])
-        
-        # Polls indexes
-        await database.polls.create_index("message_id")
-        
-        logger.info("✅ Database indexes created successfully")
+        await sync_indexes(database)
+        logger.info("✅ Database indexes are in sync with the registry")
         
     except Exception as e:
         logger.error(f"❌ Failed to create indexes: {e}")
@@ -0,0 +1,45 @@
+from contextvars import ContextVar, Token
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+# Per-request identity map: (collection, key) -> raw document (or None if it was not found).
+# Outside a request scope (startup, background workers) every load goes to the database.
+_identity_map: ContextVar[Optional[Dict[Tuple[str, Hashable], Any]]] = ContextVar("identity_map", default=None)
+
+def begin_request_scope() -> Token:
+    """Start a fresh identity map for the current request"""
+    return _identity_map.set({})
+
+def end_request_scope(token: Token):
+    """Drop the identity map started by begin_request_scope"""
+    _identity_map.reset(token)
+
+async def load(collection_name: str, key: Hashable, loader: Callable[[], Awaitable[Optional[dict]]]) -> Optional[dict]:
+    """Return the document for (collection, key), fetching it at most once per request"""
+    scope = _identity_map.get()
+    if scope is None:
+        return await loader()
+
+    entry_key = (collection_name, key)
+    if entry_key in scope:
+        return scope[entry_key]
+
+    document = await loader()
+    scope[entry_key] = document
+    return document
+
+def remember(collection_name: str, key: Hashable, document: Optional[dict]):
+    """Store a document we already have in hand (e.g. a post-image or a fresh insert)"""
+    scope = _identity_map.get()
+    if scope is not None:
+        scope[(collection_name, key)] = document
+
+def discard(collection_name: str, key: Optional[Hashable] = None):
+    """Forget one document after writing it, or the whole collection when key is None"""
+    scope = _identity_map.get()
+    if scope is None:
+        return
+    if key is not None:
+        scope.pop((collection_name, key), None)
+        return
+    for entry_key in [entry_key for entry_key in scope if entry_key[0] == collection_name]:
+        del scope[entry_key]
@@ -0,0 +1,250 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from pymongo import IndexModel
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Delta sync tombstones (chats that left a user's list) expire after this long, and
+# self-destructed messages are kept (hidden) as long so that sync can report them
+SYNC_TOMBSTONE_TTL_SECONDS = int(os.getenv("SYNC_TOMBSTONE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+class IndexSpec(NamedTuple):
+    """A declared index: ordered key pattern plus create_index options"""
+    keys: Tuple[Tuple[str, Any], ...]
+    options: Dict[str, Any]
+
+    @property
+    def name(self) -> str:
+        return self.options.get("name") or "_".join(f"{field}_{direction}" for field, direction in self.keys)
+
+    @property
+    def fields(self) -> List[str]:
+        return [field for field, _ in self.keys]
+
+    @property
+    def is_text(self) -> bool:
+        return any(direction == "text" for _, direction in self.keys)
+
+    def to_model(self) -> IndexModel:
+        return IndexModel(list(self.keys), background=True, **self.options)
+
+def index(*keys, **options) -> IndexSpec:
+    """Declare an index; plain strings are ascending keys, tuples are (field, direction)"""
+    normalized = tuple((key, 1) if isinstance(key, str) else tuple(key) for key in keys)
+    return IndexSpec(normalized, options)
+
+# Every collection the services query, with the indexes that back those queries.
+# tests/test_index_coverage.py checks the service query shapes against this registry.
+INDEX_REGISTRY: Dict[str, List[IndexSpec]] = {
+    "users": [
+        index("id", unique=True),
+        index("username", unique=True, sparse=True),
+        index("email", unique=True, sparse=True),
+        # Name prefix search (lowercased, accent-free copies of name / username)
+        index("name_folded"),
+        index("username_folded", sparse=True),
+    ],
+    "user_privacy_settings": [
+        index("user_id", unique=True),
+    ],
+    "chats": [
+        index("id", unique=True),
+        index("type"),
+        index("is_public", "name_folded"),  # Public chat name prefix search
+        index("updated_at"),
+    ],
+    "chat_members": [
+        index(("chat_id", 1), ("user_id", 1), unique=True),
+        index(("user_id", 1), ("chat_id", 1)),
+    ],
+    "inbox": [
+        index(("user_id", 1), ("chat_id", 1), unique=True),
+        index(("user_id", 1), ("is_archived", 1), ("last_activity", -1), ("chat_id", -1)),
+        index(("user_id", 1), ("chat_type", 1), ("is_archived", 1), ("last_activity", -1), ("chat_id", -1)),
+        index(("chat_id", 1), ("last_read_at", 1)),
+        index("user_id", "updated_at"),  # Delta sync
+    ],
+    "messages": [
+        index("id", unique=True),
+        index(("chat_id", 1), ("timestamp", -1), ("id", -1)),
+        index(("chat_id", 1), ("message_type", 1), ("timestamp", -1), ("id", -1)),
+        index("sender_id"),
+        index("reply_to"),
+        index("is_scheduled", "scheduled_for"),
+        # TTL: Mongo removes self-destructed messages once no sync token can still miss their deletion
+        index("expires_at", expireAfterSeconds=SYNC_TOMBSTONE_TTL_SECONDS),
+        index("updated_at"),  # Changes since a point in time (search index sync)
+        index("chat_id", "updated_at"),  # Changes in the user's chats since a sync token
+        index(("text", "text")),  # Text search
+    ],
+    "sync_tombstones": [
+        index("user_id", "deleted_at"),
+        index("expires_at", expireAfterSeconds=0),
+    ],
+    "chat_sequences": [
+        index("chat_id", unique=True),
+    ],
+    "chat_changes": [
+        index("chat_id", "seq", unique=True),  # Changes since a chat sequence number (long-poll / SSE)
+        # TTL: readers further behind than this skip the gap
+        index("created_at", expireAfterSeconds=SYNC_TOMBSTONE_TTL_SECONDS),
+    ],
+    "message_reactions": [
+        index(("message_id", 1), ("user_id", 1), ("emoji", 1), unique=True),
+        index(("user_id", 1), ("message_id", 1)),
+        index("chat_id"),
+    ],
+    "forward_jobs": [
+        index("id", unique=True),
+        # Expired leases, and jobs from before leases whose updates stopped
+        index("status", "lease_expires_at", "updated_at"),
+    ],
+    "folders": [
+        index(("user_id", 1), ("folder_type", 1)),
+        index("user_id", "updated_at"),  # Delta sync
+    ],
+    "polls": [
+        index("message_id"),
+    ],
+}
+
+def _existing_keys(index_info: dict) -> Tuple[Tuple[str, Any], ...]:
+    """Normalize a list_indexes() entry to the key pattern it was declared with"""
+    key = index_info["key"]
+    if "_fts" in key:
+        # Text indexes are reported as {_fts: "text", _ftsx: 1} with the fields in weights
+        return tuple((field, "text") for field in index_info.get("weights", {}))
+    return tuple((field, direction) for field, direction in key.items())
+
+# create_index options that change what an index enforces or contains
+COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression", "collation")
+
+def _option_mismatches(spec: IndexSpec, index_info: dict) -> Dict[str, Tuple[Any, Any]]:
+    """Options whose declared value differs from the live index, as {option: (declared, existing)}"""
+    mismatches = {}
+    for option in COMPARED_OPTIONS:
+        declared = spec.options.get(option)
+        existing = index_info.get(option)
+        if option == "collation" and declared and existing:
+            # The server reports every collation field; only the declared ones matter
+            existing = {key: existing.get(key) for key in declared}
+        if option in ("unique", "sparse"):
+            declared, existing = bool(declared), bool(existing)
+        if declared != existing:
+            mismatches[option] = (declared, existing)
+    return mismatches
+
+def _is_prefix(shorter: Sequence, longer: Sequence) -> bool:
+    return len(shorter) < len(longer) and tuple(longer[:len(shorter)]) == tuple(shorter)
+
+def diff_indexes(declared: List[IndexSpec], existing: List[dict]) -> Dict[str, list]:
+    """Compare declared specs with list_indexes() output for one collection.
+
+    Returns the specs that are missing, the names of existing indexes that are
+    undeclared or made redundant by a longer index with the same prefix, and
+    the names of indexes whose key pattern matches but whose options
+    (unique, TTL, partial filter, ...) differ from the declaration. Those are
+    never rebuilt automatically: dropping a unique or TTL index on a live
+    collection has to be a deliberate migration.
+    """
+    existing = [info for info in existing if info["name"] != "_id_"]
+    existing_by_keys = {_existing_keys(info): info for info in existing}
+    existing_keys = set(existing_by_keys)
+    missing = [spec for spec in declared if spec.keys not in existing_keys]
+    mismatched = {}
+    for spec in declared:
+        info = existing_by_keys.get(spec.keys)
+        mismatches = _option_mismatches(spec, info) if info else None
+        if mismatches:
+            mismatched[info["name"]] = mismatches
+
+    declared_keys = {spec.keys for spec in declared}
+    undeclared = [info["name"] for info in existing if _existing_keys(info) not in declared_keys]
+
+    all_keys = declared_keys | existing_keys
+    redundant = []
+    for info in existing:
+        keys = _existing_keys(info)
+        if info.get("unique") or info.get("sparse") or any(direction == "text" for _, direction in keys):
+            continue
+        if any(_is_prefix(keys, other) for other in all_keys):
+            redundant.append(info["name"])
+
+    return {"missing": missing, "undeclared": undeclared, "redundant": redundant, "mismatched": mismatched}
+
+async def sync_indexes(database, registry: Optional[Dict[str, List[IndexSpec]]] = None) -> Dict[str, Dict[str, list]]:
+    """Diff the registry against the live indexes and build whatever is missing.
+
+    A failure on one collection is logged and recorded under "error" in its
+    report entry; the remaining collections are still synced.
+    """
+    registry = registry or INDEX_REGISTRY
+    report = {}
+
+    for collection_name, declared in registry.items():
+        collection = database[collection_name]
+        try:
+            existing = await collection.list_indexes().to_list(None)
+            diff = diff_indexes(declared, existing)
+            report[collection_name] = diff
+
+            for name in diff["undeclared"]:
+                logger.warning(f"⚠️ Index {collection_name}.{name} is not declared in the index registry")
+            for name in diff["redundant"]:
+                logger.warning(f"⚠️ Index {collection_name}.{name} is redundant (prefix of a longer index)")
+            for name, mismatches in diff["mismatched"].items():
+                details = ", ".join(f"{option} declared {declared_value!r} but is {existing_value!r}"
+                                    for option, (declared_value, existing_value) in mismatches.items())
+                logger.error(f"❌ Index {collection_name}.{name} does not match the registry ({details}); drop and rebuild it")
+
+            if diff["missing"]:
+                names = await collection.create_indexes([spec.to_model() for spec in diff["missing"]])
+                logger.info(f"✅ Built indexes on {collection_name}: {', '.join(names)}")
+
+        except Exception as e:
+            logger.error(f"❌ Failed to sync indexes on {collection_name}: {e}")
+            report.setdefault(collection_name, {})["error"] = str(e)
+
+    return report
+
+def find_supporting_index(
+    collection_name: str,
+    equality: Sequence[str] = (),
+    sort: Sequence[Tuple[str, int]] = (),
+    text: bool = False,
+    registry: Optional[Dict[str, List[IndexSpec]]] = None,
+) -> Optional[IndexSpec]:
+    """Return a declared index that can serve a query shape without a collection scan.
+
+    `equality` are the fields matched by value (or array membership), `sort` the
+    requested sort order. An index qualifies when its leading keys are bound by
+    the equality fields and, if a sort is given, the following keys provide it
+    in the same or fully reversed direction.
+    """
+    registry = registry or INDEX_REGISTRY
+    for spec in registry.get(collection_name, []):
+        if text:
+            if spec.is_text:
+                return spec
+            continue
+        if spec.is_text:
+            continue
+
+        bound = 0
+        while bound < len(spec.keys) and spec.keys[bound][0] in equality:
+            bound += 1
+        if bound == 0 and (equality or not sort):
+            continue
+
+        if sort:
+            following = spec.keys[bound:bound + len(sort)]
+            if [field for field, _ in following] != [field for field, _ in sort]:
+                continue
+            same = all(d1 == d2 for (_, d1), (_, d2) in zip(following, sort))
+            reversed_ = all(d1 == -d2 for (_, d1), (_, d2) in zip(following, sort))
+            if not (same or reversed_):
+                continue
+
+        return spec
+    return None
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from enum import Enum
@@ -20,6 +20,17 @@ class MessageType(str, Enum):
     poll = "poll"
     system = "system"
 
+class MemberRole(str, Enum):
+    owner = "owner"
+    admin = "admin"
+    member = "member"
+
+class ForwardJobState(str, Enum):
+    queued = "queued"
+    running = "running"
+    completed = "completed"
+    interrupted = "interrupted"
+
 class FolderType(str, Enum):
     all = "all"
     unread = "unread"
@@ -69,6 +80,11 @@ class ContactPrivacySettings(BaseModel):
     show_online_status_to_contact: bool = True
     can_see_contact_online_status: bool = True
 
+class UserPresence(BaseModel):
+    user_id: str
+    is_online: Optional[bool] = None  # None when hidden by the user's privacy settings
+    last_seen: Optional[datetime] = None  # None when hidden (or never seen)
+
 class UserPrivacySettings(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
@@ -107,9 +123,11 @@ class Chat(BaseModel):
     participants: List[str] = []  # User IDs
     
     # Group/Channel specific
+    # Membership lives in the chat_members collection; these stay empty on new chats
     members: List[str] = []  # User IDs
     admins: List[str] = []   # User IDs
     owner: Optional[str] = None  # User ID
+    members_count: int = 0
     subscribers_count: int = 0
     
     # Bot specific
@@ -146,12 +164,49 @@ class ChatUpdate(BaseModel):
     description: Optional[str] = None
     avatar: Optional[str] = None
 
+# Chat membership (one document per chat/user pair)
+class ChatMember(BaseModel):
+    chat_id: str
+    user_id: str
+    role: MemberRole = MemberRole.member
+    joined_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ChatMembersPage(BaseModel):
+    members: List[ChatMember]
+    next_cursor: Optional[str] = None  # Pass as `after` to get the next page
+
+# Per-user inbox (one document per user/chat pair)
+class InboxEntry(BaseModel):
+    user_id: str
+    chat_id: str
+    chat_type: ChatType
+    is_pinned: bool = False
+    is_muted: bool = False
+    is_archived: bool = False
+    unread_count: int = 0
+    last_message: Optional[str] = None
+    last_activity: datetime = Field(default_factory=datetime.utcnow)
+
+class InboxStateUpdate(BaseModel):
+    is_pinned: Optional[bool] = None
+    is_muted: Optional[bool] = None
+    is_archived: Optional[bool] = None
+
 # Message Models
 class MessageReaction(BaseModel):
     emoji: str
-    users: List[str] = []  # User IDs
+    users: List[str] = []  # Legacy; who reacted now lives in message_reactions
     count: int = 0
 
+class ReplyPreview(BaseModel):
+    """Enough of a quoted message to render the reply header"""
+    id: str
+    sender_id: str
+    sender_name: str
+    text: Optional[str] = None  # Truncated
+    message_type: MessageType = MessageType.text
+    is_deleted: bool = False
+
 class Message(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     chat_id: str
@@ -167,7 +222,9 @@ class Message(BaseModel):
     
     # Message features
     reply_to: Optional[str] = None  # Message ID
+    reply_preview: Optional[ReplyPreview] = None  # Filled in when requested
     forwarded_from: Optional[str] = None  # User ID
+    is_forwarded: bool = False
     is_edited: bool = False
     is_deleted: bool = False
     is_pinned: bool = False
@@ -177,6 +234,7 @@ class Message(BaseModel):
     # Secret chat features
     is_secret: bool = False
     self_destruct: Optional[str] = None  # "5m", "1h", "1d", etc.
+    expires_at: Optional[datetime] = None  # Set from self_destruct when the message is written
     
     # Scheduled messages
     scheduled_for: Optional[datetime] = None
@@ -185,13 +243,25 @@ class Message(BaseModel):
     # Bot features
     quick_replies: List[str] = []
     
-    # Reactions
+    # Reactions (stored as `reaction_counts`: emoji -> count)
     reactions: List[MessageReaction] = []
     
     # Timestamps
+    seq: Optional[int] = None  # Chat sequence number of the latest change to this message
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     edited_at: Optional[datetime] = None
-    read_by: List[str] = []  # User IDs who read the message
+    read_by: List[str] = []  # Legacy; read state now lives in per-user inbox watermarks
+    
+    @model_validator(mode="before")
+    @classmethod
+    def reactions_from_counts(cls, data: Any) -> Any:
+        if isinstance(data, dict) and data.get("reaction_counts"):
+            data = dict(data)
+            data["reactions"] = [
+                {"emoji": emoji, "count": count}
+                for emoji, count in data["reaction_counts"].items() if count > 0
+            ]
+        return data
 
 class MessageCreate(BaseModel):
     chat_id: str
@@ -204,10 +274,54 @@ class MessageCreate(BaseModel):
     scheduled_for: Optional[datetime] = None
     quick_replies: List[str] = []
 
+class BulkMessageSendRequest(BaseModel):
+    messages: List[MessageCreate]  # Sent in this order; may target several chats
+
+class BulkMessageResult(BaseModel):
+    index: int  # Position in the request
+    chat_id: str
+    message_id: Optional[str] = None  # Set when the message was sent
+    error: Optional[str] = None
+
+class BulkMessageSendResponse(BaseModel):
+    results: List[BulkMessageResult]
+    total_sent: int
+    total_failed: int
+
 class MessageUpdate(BaseModel):
     text: Optional[str] = None
     is_pinned: Optional[bool] = None
 
+class MessagePage(BaseModel):
+    messages: List[Message] = []  # Chronological order
+    older_cursor: Optional[str] = None  # Pass as `before` for older messages
+    newer_cursor: Optional[str] = None  # Pass as `after` for newer messages
+
+class ChatUpdates(BaseModel):
+    messages: List[Message] = []  # Messages changed after `since`, in order of their latest change
+    seq: int  # Pass as `since` for the next call
+    has_more: bool = False  # More changes are ready; call again right away
+
+class MessageSearchPage(BaseModel):
+    messages: List[Message] = []  # Most relevant first
+    next_cursor: Optional[str] = None  # Pass as `cursor` for the next page
+    timed_out: bool = False  # The search ran out of its time budget
+
+class MessageReadReceipts(BaseModel):
+    message_id: str
+    read_by: List[str] = []  # User IDs visible to the viewer under their privacy settings
+    read_count: int = 0
+
+class BulkReadRequest(BaseModel):
+    reads: Dict[str, str]  # Chat ID -> newest message ID read in that chat
+
+class BulkReadResponse(BaseModel):
+    marked: List[str]  # Chat IDs whose read watermark was advanced
+    failed: List[Dict[str, str]]  # Chat IDs and error messages
+
+class MyReactionsRequest(BaseModel):
+    message_ids: List[str]
+
 class MessageReactionUpdate(BaseModel):
     emoji: str
     action: str  # "add" or "remove"
@@ -223,6 +337,7 @@ class Folder(BaseModel):
     is_default: bool = False
     order: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
 
 class FolderCreate(BaseModel):
     name: str
@@ -269,6 +384,18 @@ class ForwardMessageResponse(BaseModel):
     total_sent: int
     total_failed: int
 
+class ForwardJobStatus(BaseModel):
+    id: str
+    message_id: str
+    status: ForwardJobState
+    total_targets: int
+    total_sent: int = 0
+    total_failed: int = 0
+    failed_forwards: List[Dict[str, str]] = []  # First failures only; totals are exact
+    created_at: datetime
+    updated_at: datetime
+    completed_at: Optional[datetime] = None
+
 # Response Models
 class ChatWithMessages(BaseModel):
     chat: Chat
@@ -280,6 +407,17 @@ class UserChats(BaseModel):
     chats: List[Chat]
     folders: List[Folder]
     privacy_settings: Optional[UserPrivacySettings] = None
+    next_cursor: Optional[str] = None  # Pass as `cursor` to get the next page of chats
+
+class SyncResponse(BaseModel):
+    token: str  # Pass to the next sync
+    reset: bool = False  # Token missing, expired or too far behind: reload everything, then sync with `token`
+    chats: List[Chat] = []  # Chats added to or changed in the user's list
+    removed_chat_ids: List[str] = []  # Chats that left the user's list (left or deleted)
+    folders: List[Folder] = []  # Folders created or changed
+    privacy_settings: Optional[UserPrivacySettings] = None  # Set when the settings changed
+    messages: List[Message] = []  # Messages created or changed in the user's chats
+    deleted_message_ids: List[str] = []
 
 class MessageResponse(BaseModel):
     message: Message
@@ -292,6 +430,7 @@ class SearchResult(BaseModel):
     chats: List[Chat] = []
     users: List[User] = []
     total: int = 0
+    total_is_capped: bool = False  # A part of the total hit the count limit, so it is a lower bound
 
 class SearchRequest(BaseModel):
     query: str
@@ -0,0 +1,50 @@
+from typing import Any, List, Optional
+from datetime import datetime
+import base64
+import json
+
+# Opaque keyset cursors: a base64url-encoded JSON list of the sort-key values of the
+# last row of a page. Datetimes are tagged so they round-trip exactly.
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        # Mongo stores milliseconds; truncate so in-memory values match stored ones
+        value = value.replace(microsecond=value.microsecond // 1000 * 1000)
+        return {"$dt": value.isoformat()}
+    return value
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict) and "$dt" in value:
+        return datetime.fromisoformat(value["$dt"])
+    return value
+
+def encode_cursor(*values: Any) -> str:
+    """Encode the sort-key values of a row into an opaque cursor token"""
+    payload = json.dumps([_encode_value(value) for value in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(token: str, size: int) -> Optional[List[Any]]:
+    """Decode a cursor token with `size` values; returns None if it is malformed"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != size:
+            return None
+        return [_decode_value(value) for value in values]
+    except (ValueError, TypeError):
+        return None
+
+def keyset_filter(fields: List[str], values: List[Any], direction: int) -> dict:
+    """Build the filter for rows strictly after `values` in a compound sort on `fields`.
+
+    `direction` is -1 for descending (rows with smaller keys come next) and 1 for
+    ascending. E.g. fields (timestamp, id) descending gives
+    {$or: [{timestamp: {$lt: t}}, {timestamp: t, id: {$lt: i}}]}.
+    """
+    operator = "$lt" if direction < 0 else "$gt"
+    branches = []
+    for position, field in enumerate(fields):
+        branch = {fields[i]: values[i] for i in range(position)}
+        branch[field] = {operator: values[position]}
+        branches.append(branch)
+    return {"$or": branches}
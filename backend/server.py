@@ -1,8 +1,8 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, WebSocket, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from contextlib import asynccontextmanager
-from typing import List, Optional
+from typing import Dict, List, Optional, Union
 import os
 import logging
 from pathlib import Path
@@ -16,13 +16,30 @@ from models import (
     Message, MessageCreate, MessageUpdate, Folder, FolderCreate,
     ChatType, MessageType, FolderType, UserChats, MessageResponse,
     UserPrivacySettings, ContactPrivacyUpdate, PrivacySettingsUpdate,
-    ForwardMessageRequest, ForwardMessageResponse, ContactForForward
+    ForwardMessageRequest, ForwardMessageResponse, ContactForForward,
+    MemberRole, ChatMembersPage, InboxEntry, InboxStateUpdate, MessageReadReceipts,
+    MessagePage, MessageSearchPage, ForwardJobStatus, SearchRequest, SearchResult, MyReactionsRequest,
+    BulkMessageSendRequest, BulkMessageSendResponse, BulkReadRequest, BulkReadResponse, ChatUpdates, SyncResponse,
+    UserPresence
 )
 from database import connect_to_mongo, close_mongo_connection, get_collection
-from auth import get_current_user, create_demo_user, create_demo_token
+from auth import get_current_user, get_user_from_token, create_demo_user, create_demo_token, user_cache
 from services.chat_service import ChatService
-from services.message_service import MessageService
+from services.message_service import MessageService, reply_preview_cache
 from services.privacy_service import PrivacyService
+from services.membership_service import MembershipService, chat_ids_cache
+from services.inbox_service import InboxService
+from services.forward_job_service import ForwardJobService, forward_job_queue
+from services.scheduled_dispatcher import scheduled_dispatcher
+from services.expiry_sweeper import message_expiry_sweeper
+from services.search_backend import folded_name_fields, search_backend
+from services.last_message_coalescer import last_message_coalescer
+from services.realtime_hub import realtime_hub
+from services.presence_service import presence_store
+from services.chat_sequencer import chat_sequencer, SEQUENCE_POLL_TIMEOUT_SECONDS
+from services.search_service import SearchService
+from services.sync_service import SyncService
+from identity_map import begin_request_scope, end_request_scope
 
 # Configure logging
 logging.basicConfig(
@@ -45,9 +62,39 @@ async def lifespan(app: FastAPI):
     await create_demo_user()
     await create_initial_data()
     
+    # Move member arrays of pre-existing chats into chat_members
+    migrated = await MembershipService.migrate_embedded_members()
+    if migrated:
+        logger.info(f"✅ Migrated membership of {migrated} chats to chat_members")
+    backfilled = await InboxService.backfill_from_memberships()
+    if backfilled:
+        logger.info(f"✅ Backfilled {backfilled} inbox entries")
+    folded = await SearchService.backfill_folded_names()
+    if folded:
+        logger.info(f"✅ Added folded search names to {folded} chats and users")
+    
+    # Background workers
+    interrupted = await ForwardJobService.fail_interrupted_jobs()
+    if interrupted:
+        logger.info(f"⚠️ Marked {interrupted} unfinished forward jobs as interrupted")
+    last_message_coalescer.start()
+    presence_store.start()
+    forward_job_queue.start()
+    scheduled_dispatcher.start()
+    message_expiry_sweeper.start(MessageService.hide_messages)
+    await search_backend.start()
+    
     yield
     
     # Shutdown
+    realtime_hub.close_all()
+    await presence_store.stop()
+    await search_backend.stop()
+    await message_expiry_sweeper.stop()
+    await scheduled_dispatcher.stop()
+    await forward_job_queue.stop()
+    # Flush buffered last-message updates after every writer has stopped
+    await last_message_coalescer.stop()
     await close_mongo_connection()
 
 # Create the main app
@@ -70,6 +117,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Each request gets its own identity map so services fetch a chat/message at most once
+@app.middleware("http")
+async def identity_map_scope(request, call_next):
+    token = begin_request_scope()
+    try:
+        return await call_next(request)
+    finally:
+        end_request_scope(token)
+
 # Health check endpoints
 @api_router.get("/")
 async def root():
@@ -81,7 +137,15 @@ async def health_check():
         "status": "healthy",
         "service": "KingChat API",
         "version": "1.0.0",
-        "timestamp": datetime.utcnow()
+        "timestamp": datetime.utcnow(),
+        "caches": {
+            "users": user_cache.stats(),
+            "chat_ids": chat_ids_cache.stats(),
+            "reply_previews": reply_preview_cache.stats()
+        },
+        "realtime": realtime_hub.stats(),
+        "sequences": chat_sequencer.stats(),
+        "presence": presence_store.stats()
     }
 
 # Authentication endpoints
@@ -107,10 +171,18 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
 
 # User endpoints
 @api_router.get("/users/chats", response_model=UserChats)
-async def get_user_chats_with_folders(current_user: User = Depends(get_current_user)):
-    """Get user's chats organized by folders"""
-    # Get user's chats
-    chats = await ChatService.get_user_chats(current_user.id)
+async def get_user_chats_with_folders(
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    archived: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """Get user's chats organized by folders (`archived` lists the chats they archived)"""
+    # Get one page of the user's chats
+    try:
+        chats, next_cursor = await ChatService.get_user_chats_page(current_user.id, limit, cursor, archived)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Get user's folders
     folders_collection = await get_collection("folders")
@@ -124,7 +196,34 @@ async def get_user_chats_with_folders(current_user: User = Depends(get_current_u
     # Get privacy settings
     privacy_settings = await PrivacyService.get_user_privacy_settings(current_user.id)
     
-    return UserChats(user=current_user, chats=chats, folders=folders, privacy_settings=privacy_settings)
+    return UserChats(
+        user=current_user,
+        chats=chats,
+        folders=folders,
+        privacy_settings=privacy_settings,
+        next_cursor=next_cursor
+    )
+
+@api_router.get("/sync", response_model=SyncResponse)
+async def sync_changes(token: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Changes to the user's chats, folders, privacy settings and messages since a sync token.
+
+    Without a token (or when `reset` comes back) load /users/chats and message
+    pages as usual, then keep calling this with the returned token.
+    """
+    return await SyncService.sync(current_user.id, token)
+
+@api_router.put("/users/chats/{chat_id}", response_model=InboxEntry)
+async def update_inbox_state(
+    chat_id: str,
+    state_update: InboxStateUpdate,
+    current_user: User = Depends(get_current_user)
+):
+    """Pin, mute or archive a chat for the current user"""
+    entry = await InboxService.update_state(current_user.id, chat_id, state_update)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return entry
 
 # Chat endpoints
 @api_router.post("/chats", response_model=Chat)
@@ -135,12 +234,14 @@ async def create_chat(chat_data: ChatCreate, current_user: User = Depends(get_cu
 @api_router.get("/chats", response_model=List[Chat])
 async def get_chats(
     chat_type: Optional[ChatType] = None,
+    limit: int = 100,
+    archived: bool = False,
     current_user: User = Depends(get_current_user)
 ):
-    """Get user's chats, optionally filtered by type"""
+    """Get user's chats (or, with `archived`, the chats they archived), optionally filtered by type"""
     if chat_type:
-        return await ChatService.get_chats_by_type(current_user.id, chat_type)
-    return await ChatService.get_user_chats(current_user.id)
+        return await ChatService.get_chats_by_type(current_user.id, chat_type, limit, archived)
+    return await ChatService.get_user_chats(current_user.id, limit, archived=archived)
 
 @api_router.get("/chats/{chat_id}", response_model=Chat)
 async def get_chat(chat_id: str, current_user: User = Depends(get_current_user)):
@@ -186,6 +287,19 @@ async def leave_chat(chat_id: str, current_user: User = Depends(get_current_user
         raise HTTPException(status_code=400, detail="Cannot leave this chat")
     return {"message": "Successfully left chat"}
 
+@api_router.get("/chats/{chat_id}/members", response_model=ChatMembersPage)
+async def get_chat_members(
+    chat_id: str,
+    limit: int = 100,
+    after: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """List a chat's members, paginated by user ID"""
+    chat = await ChatService.get_chat_by_id(chat_id, current_user.id)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return await MembershipService.list_members(chat_id, limit, after)
+
 # Message endpoints
 @api_router.post("/chats/{chat_id}/messages", response_model=MessageResponse)
 async def send_message(
@@ -195,26 +309,71 @@ async def send_message(
 ):
     """Send a message to a chat"""
     message_data.chat_id = chat_id
-    message = await MessageService.create_message(message_data, current_user.id, current_user.name)
+    try:
+        message = await MessageService.create_message(message_data, current_user.id, current_user.name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not message:
         raise HTTPException(status_code=400, detail="Cannot send message to this chat")
     
-    # Get reply-to message if exists
+    # Get reply-to message if exists (the sender can see it when it is in the same chat)
     reply_to_message = None
     if message.reply_to:
-        reply_to_message = await MessageService.get_message_by_id(message.reply_to, current_user.id)
+        reply_data = await MessageService.load_message_document(message.reply_to)
+        if reply_data and reply_data["chat_id"] == message.chat_id:
+            reply_to_message = Message(**reply_data)
+            message.reply_preview = MessageService.build_reply_preview(reply_data)
     
     return MessageResponse(message=message, reply_to_message=reply_to_message)
 
+@api_router.post("/messages/bulk", response_model=BulkMessageSendResponse)
+async def send_messages_bulk(
+    request: BulkMessageSendRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """Send up to BULK_SEND_MAX_MESSAGES messages across one or more chats (importers and bots)"""
+    if len(request.messages) > MessageService.BULK_SEND_MAX_MESSAGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MessageService.BULK_SEND_MAX_MESSAGES} messages per request"
+        )
+    
+    results = await MessageService.create_messages(request.messages, current_user.id, current_user.name)
+    total_sent = sum(1 for result in results if result.message_id)
+    return BulkMessageSendResponse(results=results, total_sent=total_sent, total_failed=len(results) - total_sent)
+
 @api_router.get("/chats/{chat_id}/messages", response_model=List[Message])
 async def get_chat_messages(
     chat_id: str,
     limit: int = 50,
     before: Optional[str] = None,
+    reply_previews: bool = False,
     current_user: User = Depends(get_current_user)
 ):
-    """Get messages from a chat"""
-    return await MessageService.get_chat_messages(chat_id, current_user.id, limit, before)
+    """Get messages from a chat; `reply_previews` embeds a preview of each quoted message"""
+    try:
+        return await MessageService.get_chat_messages(chat_id, current_user.id, limit, before, reply_previews)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.get("/chats/{chat_id}/messages/page", response_model=MessagePage)
+async def get_chat_messages_page(
+    chat_id: str,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    around: Optional[str] = None,
+    reply_previews: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """Get a page of messages with cursors for older/newer pages, or centered on a message"""
+    try:
+        page = await MessageService.get_chat_messages_page(chat_id, current_user.id, limit, before, after, around, reply_previews)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return page
 
 @api_router.put("/messages/{message_id}", response_model=Message)
 async def update_message(
@@ -236,6 +395,18 @@ async def delete_message(message_id: str, current_user: User = Depends(get_curre
         raise HTTPException(status_code=404, detail="Message not found or no permission")
     return {"message": "Message deleted successfully"}
 
+@api_router.post("/messages/read", response_model=BulkReadResponse)
+async def mark_messages_as_read(request: BulkReadRequest, current_user: User = Depends(get_current_user)):
+    """Mark many chats as read, each up to the given message (catch-up sync)"""
+    if len(request.reads) > MessageService.BULK_READ_MAX_CHATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MessageService.BULK_READ_MAX_CHATS} chats per request"
+        )
+    
+    marked, failed = await MessageService.mark_many_as_read(request.reads, current_user.id)
+    return BulkReadResponse(marked=marked, failed=failed)
+
 @api_router.post("/messages/{message_id}/read")
 async def mark_message_as_read(message_id: str, current_user: User = Depends(get_current_user)):
     """Mark a message as read"""
@@ -248,6 +419,14 @@ async def mark_message_as_read(message_id: str, current_user: User = Depends(get
         raise HTTPException(status_code=400, detail="Cannot mark message as read")
     return {"message": "Message marked as read"}
 
+@api_router.get("/messages/{message_id}/receipts", response_model=MessageReadReceipts)
+async def get_message_read_receipts(message_id: str, current_user: User = Depends(get_current_user)):
+    """Get who has read a message (respecting their privacy settings)"""
+    receipts = await MessageService.get_read_receipts(message_id, current_user.id)
+    if not receipts:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return receipts
+
 @api_router.post("/messages/{message_id}/react")
 async def add_reaction_to_message(
     message_id: str,
@@ -255,7 +434,10 @@ async def add_reaction_to_message(
     current_user: User = Depends(get_current_user)
 ):
     """Add reaction to a message"""
-    message = await MessageService.add_reaction(message_id, emoji, current_user.id)
+    try:
+        message = await MessageService.add_reaction(message_id, emoji, current_user.id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     return message
@@ -267,18 +449,49 @@ async def remove_reaction_from_message(
     current_user: User = Depends(get_current_user)
 ):
     """Remove reaction from a message"""
-    message = await MessageService.remove_reaction(message_id, emoji, current_user.id)
+    try:
+        message = await MessageService.remove_reaction(message_id, emoji, current_user.id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     return message
 
-@api_router.post("/messages/{message_id}/forward-unlimited", response_model=ForwardMessageResponse)
+@api_router.post("/messages/my-reactions", response_model=Dict[str, List[str]])
+async def get_my_reactions(
+    reactions_request: MyReactionsRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """Get the current user's reactions for a batch of messages (e.g. one history page)"""
+    return await MessageService.get_my_reactions(reactions_request.message_ids, current_user.id)
+
+@api_router.post(
+    "/messages/{message_id}/forward-unlimited",
+    response_model=Union[ForwardMessageResponse, ForwardJobStatus]
+)
 async def forward_message_unlimited(
     message_id: str,
     forward_request: ForwardMessageRequest,
+    async_mode: bool = False,
     current_user: User = Depends(get_current_user)
 ):
-    """Forward a message to unlimited chats (KingChat advantage!)"""
+    """Forward a message to unlimited chats (KingChat advantage!)
+    
+    With async_mode the forward runs in the background and a job is returned
+    immediately; poll /forward-jobs/{job_id} for progress.
+    """
+    if async_mode:
+        message = await MessageService.get_message_by_id(message_id, current_user.id)
+        if not message:
+            raise HTTPException(status_code=404, detail="Message not found")
+        return await ForwardJobService.create_job(
+            message,
+            forward_request.target_chat_ids,
+            current_user.id,
+            current_user.name,
+            forward_request.add_caption
+        )
+    
     result = await MessageService.forward_message_unlimited(
         message_id, 
         forward_request.target_chat_ids, 
@@ -288,6 +501,14 @@ async def forward_message_unlimited(
     )
     return ForwardMessageResponse(**result)
 
+@api_router.get("/forward-jobs/{job_id}", response_model=ForwardJobStatus)
+async def get_forward_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """Get the progress of a background forward job"""
+    job = await ForwardJobService.get_job(job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Forward job not found")
+    return job
+
 @api_router.get("/contacts/for-forward", response_model=List[ContactForForward])
 async def get_contacts_for_forward(current_user: User = Depends(get_current_user)):
     """Get all contacts available for forwarding messages"""
@@ -317,6 +538,36 @@ async def search_messages(
     """Search messages"""
     return await MessageService.search_messages(q, chat_id, current_user.id, limit)
 
+@api_router.get("/search/messages/page", response_model=MessageSearchPage)
+async def search_messages_page(
+    q: str,
+    chat_id: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Search messages in the user's chats, most relevant first, one page at a time"""
+    try:
+        return await MessageService.search_messages_page(q, current_user.id, chat_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.post("/search", response_model=SearchResult)
+async def search(search_request: SearchRequest, current_user: User = Depends(get_current_user)):
+    """Search messages, chats and users at once; message filters limit the search to messages"""
+    return await SearchService.search(search_request, current_user.id)
+
+# Only backends with an in-process index can suggest words cheaply
+if search_backend.supports_typeahead:
+    @api_router.get("/search/typeahead", response_model=List[str])
+    async def search_typeahead(
+        q: str,
+        limit: int = 10,
+        current_user: User = Depends(get_current_user)
+    ):
+        """Suggest words from the user's chats that complete the last word of `q`"""
+        return await MessageService.search_typeahead(q, current_user.id, limit)
+
 # Privacy endpoints
 @api_router.get("/privacy", response_model=UserPrivacySettings)
 async def get_privacy_settings(current_user: User = Depends(get_current_user)):
@@ -352,6 +603,186 @@ async def get_contact_privacy(
 ):
     """Get privacy settings for a specific contact"""
     return await PrivacyService.get_contact_privacy_settings(current_user.id, contact_id)
+
+# Presence endpoints
+@api_router.post("/presence/heartbeat")
+async def presence_heartbeat(current_user: User = Depends(get_current_user)):
+    """Keep the current user online for PRESENCE_TTL_SECONDS (not needed while a WebSocket is open)"""
+    await presence_store.heartbeat(current_user.id)
+    return {"message": "Heartbeat recorded"}
+
+@api_router.get("/users/{user_id}/presence", response_model=UserPresence)
+async def get_user_presence(
+    user_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Get a user's online status and last seen time, as far as their privacy settings allow"""
+    presence = await presence_store.get_presence(user_id, current_user.id)
+    if presence is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return presence
+
+@api_router.post("/chats/{chat_id}/typing")
+async def send_typing(
+    chat_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Show a typing indicator to the chat's realtime followers"""
+    chat = await ChatService.get_chat_by_id(chat_id, current_user.id)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    presence_store.typing(chat_id, current_user.id)
+    return {"message": "Typing indicator sent"}
+
+# Realtime endpoint
+@api_router.websocket("/ws")
+async def realtime_socket(websocket: WebSocket, token: str = ""):
+    """Push message events of the user's chats over a WebSocket.
+
+    Browsers cannot set headers on WebSockets, so the JWT is passed as the
+    `token` query parameter. The connection follows all of the user's chats;
+    clients may send {"action": "subscribe" | "unsubscribe", "chat_ids": [...]}
+    to follow other accessible chats (e.g. public channels),
+    {"action": "watch_presence" | "unwatch_presence", "user_ids": [...]} to
+    receive presence events of users (the reply carries their current presence), and {"action": "typing", "chat_id": ...}
+    for a followed chat. An open connection keeps the user online. A client that
+    falls REALTIME_QUEUE_SIZE events behind is disconnected and should
+    reconnect and reload history.
+    """
+    try:
+        user = await get_user_from_token(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    await websocket.accept()
+    subscriber = realtime_hub.connect(user.id, await MembershipService.get_cached_user_chat_ids(user.id))
+    await presence_store.heartbeat(user.id)
+    
+    async def send_events():
+        while True:
+            event = await subscriber.next_event()
+            if event is None:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return
+            await websocket.send_text(event)
+    
+    async def receive_actions():
+        while True:
+            request = await websocket.receive_json()
+            if not isinstance(request, dict):
+                request = {}
+            action = request.get("action")
+            
+            if action == "typing":
+                if request.get("chat_id") in subscriber.chat_ids:
+                    presence_store.typing(request["chat_id"], user.id)
+                else:
+                    realtime_hub.send(subscriber, "error", {"detail": "Expected the chat_id of a followed chat"})
+                continue
+            
+            if action in ("watch_presence", "unwatch_presence"):
+                user_ids = request.get("user_ids")
+                if not isinstance(user_ids, list):
+                    realtime_hub.send(subscriber, "error", {"detail": "Expected a list of user_ids"})
+                    continue
+                user_ids = [user_id for user_id in user_ids if isinstance(user_id, str)]
+                if action == "watch_presence":
+                    added = realtime_hub.watch_presence(subscriber, user_ids)
+                    presences = await presence_store.get_presences(added, user.id) if added else []
+                    realtime_hub.send(subscriber, "watching", {"user_ids": added, "presences": [presence.dict() for presence in presences]})
+                else:
+                    realtime_hub.unwatch_presence(subscriber, user_ids)
+                    realtime_hub.send(subscriber, "unwatched", {"user_ids": user_ids})
+                continue
+            
+            chat_ids = request.get("chat_ids")
+            if action not in ("subscribe", "unsubscribe") or not isinstance(chat_ids, list):
+                realtime_hub.send(subscriber, "error", {"detail": "Expected an action and a list of chat_ids"})
+                continue
+            chat_ids = [chat_id for chat_id in chat_ids if isinstance(chat_id, str)]
+            if action == "subscribe":
+                accessible = await ChatService.get_accessible_chats(chat_ids, user.id)
+                added = realtime_hub.subscribe(subscriber, [chat_id for chat_id in chat_ids if chat_id in accessible])
+                realtime_hub.send(subscriber, "subscribed", {"chat_ids": added})
+            else:
+                realtime_hub.unsubscribe(subscriber, chat_ids)
+                realtime_hub.send(subscriber, "unsubscribed", {"chat_ids": chat_ids})
+    
+    tasks = [asyncio.create_task(send_events()), asyncio.create_task(receive_actions())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        realtime_hub.disconnect(subscriber)
+        for task in tasks:
+            task.cancel()
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # Runs even when the server cancels the handler on disconnect
+            await presence_store.went_offline(user.id)
+
+@api_router.get("/chats/{chat_id}/updates", response_model=ChatUpdates)
+async def get_chat_updates(
+    chat_id: str,
+    since: Optional[int] = None,
+    timeout: float = SEQUENCE_POLL_TIMEOUT_SECONDS,
+    limit: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    """Long-poll for messages changed after sequence number `since`.
+
+    Parks up to `timeout` seconds when nothing changed. Call without `since`
+    first to get the chat's current sequence number.
+    """
+    timeout = max(0.0, min(timeout, SEQUENCE_POLL_TIMEOUT_SECONDS))
+    updates = await MessageService.get_chat_updates(chat_id, current_user.id, since, limit, timeout)
+    if updates is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return updates
+
+@api_router.get("/chats/{chat_id}/events")
+async def stream_chat_updates(
+    chat_id: str,
+    since: Optional[int] = None,
+    last_event_id: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user)
+):
+    """Server-Sent Events stream of a chat's changed messages.
+
+    Each `messages` event carries a ChatUpdates body and uses its `seq` as
+    the event id, so a reconnecting EventSource resumes via Last-Event-ID.
+    Without `since` the stream starts at the chat's current sequence number.
+    A comment is sent every SEQUENCE_POLL_TIMEOUT_SECONDS while idle.
+    """
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    head = await MessageService.get_chat_updates(chat_id, current_user.id, None)
+    if head is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    async def events(since: int):
+        while True:
+            # Fresh identity map per round so access is re-checked against the database
+            token = begin_request_scope()
+            try:
+                page = await MessageService.get_chat_updates(
+                    chat_id, current_user.id, since, timeout=SEQUENCE_POLL_TIMEOUT_SECONDS
+                )
+            finally:
+                end_request_scope(token)
+            if page is None:
+                yield "event: closed\ndata: {}\n\n"
+                return
+            if page.messages:
+                since = page.seq
+                yield f"id: {page.seq}\nevent: messages\ndata: {page.json()}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+    
+    return StreamingResponse(events(head.seq if since is None else since), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @api_router.get("/folders", response_model=List[Folder])
 async def get_folders(current_user: User = Depends(get_current_user)):
     """Get user's chat folders"""
@@ -373,6 +804,7 @@ async def create_folder(folder_data: FolderCreate, current_user: User = Depends(
     folder_dict["id"] = str(uuid.uuid4())
     folder_dict["user_id"] = current_user.id
     folder_dict["created_at"] = datetime.utcnow()
+    folder_dict["updated_at"] = folder_dict["created_at"]
     
     await folders_collection.insert_one(folder_dict)
     return Folder(**folder_dict)
@@ -454,6 +886,8 @@ async def create_default_folders(user_id: str) -> List[Folder]:
         }
     ]
     
+    for folder_data in default_folders:
+        folder_data["updated_at"] = folder_data["created_at"]
     await folders_collection.insert_many(default_folders)
     return [Folder(**folder_data) for folder_data in default_folders]
 
@@ -476,6 +910,7 @@ async def create_initial_data():
                 "type": "private",
                 "avatar": "https://images.unsplash.com/photo-1494790108755-2616b612b892?w=150&h=150&fit=crop&crop=face",
                 "participants": ["demo_user_123", "user_maria"],
+                "members_count": 2,
                 "is_online": True,
                 "last_message": "Oi! Como você está?",
                 "last_message_time": datetime.utcnow(),
@@ -488,9 +923,8 @@ async def create_initial_data():
                 "name": "Canal Tech News 📢",
                 "type": "channel",
                 "avatar": "https://images.unsplash.com/photo-1518611012118-696072aa579a?w=150&h=150&fit=crop",
-                "members": ["demo_user_123"],
-                "admins": ["admin_user"],
                 "owner": "admin_user",
+                "members_count": 2,
                 "subscribers_count": 15420,
                 "is_public": True,
                 "last_message": "Breaking: Nova atualização revolucionária lançada!",
@@ -504,6 +938,7 @@ async def create_initial_data():
                 "type": "bot",
                 "avatar": "https://images.unsplash.com/photo-1507003211169-0a1dd7228f2d?w=150&h=150&fit=crop&crop=face",
                 "participants": ["demo_user_123", "bot_assistant"],
+                "members_count": 2,
                 "is_verified": True,
                 "bot_commands": ["/help", "/weather", "/news", "/joke"],
                 "last_message": "Como posso ajudar você hoje?",
@@ -516,9 +951,8 @@ async def create_initial_data():
                 "name": "Grupo Família 👨‍👩‍👧‍👦",
                 "type": "group",
                 "avatar": "https://images.unsplash.com/photo-1511632765486-a01980e01a18?w=150&h=150&fit=crop&crop=faces",
-                "members": ["demo_user_123", "user_mae", "user_pedro"],
-                "admins": ["user_mae"],
                 "owner": "user_mae",
+                "members_count": 3,
                 "last_message": "Pedro: Vai ter churrasco no domingo!",
                 "last_message_time": datetime.utcnow(),
                 "created_at": datetime.utcnow(),
@@ -526,7 +960,19 @@ async def create_initial_data():
             }
         ]
         
-        await chats_collection.insert_many(demo_chats)
+        await chats_collection.insert_many([{**chat, **folded_name_fields(chat)} for chat in demo_chats])
+        
+        # Demo chat memberships
+        demo_members = {
+            "demo_chat_1": {"demo_user_123": MemberRole.member, "user_maria": MemberRole.member},
+            "demo_chat_2": {"admin_user": MemberRole.owner, "demo_user_123": MemberRole.member},
+            "demo_chat_3": {"demo_user_123": MemberRole.member, "bot_assistant": MemberRole.member},
+            "demo_chat_4": {"user_mae": MemberRole.owner, "demo_user_123": MemberRole.member, "user_pedro": MemberRole.member}
+        }
+        chat_types = {chat["id"]: chat["type"] for chat in demo_chats}
+        for chat_id, roles in demo_members.items():
+            await MembershipService.add_members(chat_id, roles)
+            await InboxService.add_entries(chat_id, chat_types[chat_id], roles)
         
         # Create demo messages
         demo_messages = [
@@ -537,8 +983,7 @@ async def create_initial_data():
                 "sender_name": "Maria Silva",
                 "text": "Oi! Como você está?",
                 "message_type": "text",
-                "timestamp": datetime.utcnow(),
-                "read_by": ["user_maria"]
+                "timestamp": datetime.utcnow()
             },
             {
                 "id": "demo_msg_2",
@@ -548,8 +993,7 @@ async def create_initial_data():
                 "text": "🚀 BREAKING: Nova atualização revolucionária do KingChat!",
                 "message_type": "text",
                 "is_channel_post": True,
-                "timestamp": datetime.utcnow(),
-                "read_by": ["admin_user"]
+                "timestamp": datetime.utcnow()
             },
             {
                 "id": "demo_msg_3",
@@ -559,12 +1003,17 @@ async def create_initial_data():
                 "text": "Olá! Sou seu assistente pessoal do KingChat 🤖",
                 "message_type": "text",
                 "is_bot": True,
-                "timestamp": datetime.utcnow(),
-                "read_by": ["bot_assistant"]
+                "timestamp": datetime.utcnow()
             }
         ]
         
-        await messages_collection.insert_many(demo_messages)
+        demo_messages = [{**message, "updated_at": message["timestamp"]} for message in demo_messages]
+        async with chat_sequencer.allocate_messages(demo_messages):
+            await messages_collection.insert_many(demo_messages)
+        # Senders have read their own messages: their read watermarks move past them
+        await InboxService.record_messages([
+            (message["chat_id"], message["sender_id"], message["text"], message["timestamp"]) for message in demo_messages
+        ])
         
         logger.info("✅ Initial demo data created successfully")
         
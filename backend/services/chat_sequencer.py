@@ -0,0 +1,138 @@
+from typing import AsyncIterator, Dict, List, Set
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from database import get_collection
+import asyncio
+import os
+
+# Sequence long-poll configuration
+# Longest a long-poll or SSE request is parked before answering (or sending a heartbeat)
+SEQUENCE_POLL_TIMEOUT_SECONDS = float(os.getenv("SEQUENCE_POLL_TIMEOUT_SECONDS", "25"))
+# How long a missing sequence number holds back readers before its writer is presumed dead
+SEQUENCE_LEASE_SECONDS = float(os.getenv("SEQUENCE_LEASE_SECONDS", "30"))
+# Newest numbers checked for unfinished writes when a reader starts at a chat's head
+SEQUENCE_HEAD_WINDOW = int(os.getenv("SEQUENCE_HEAD_WINDOW", "100"))
+
+class ChatSequencer:
+    """Per-chat sequence numbers for message mutations, and waiting for them.
+
+    Every create/edit/delete/reaction reserves the next `seq` of its chat
+    (one $inc on chat_sequences), writes it onto the message in the same
+    update as the change itself, and afterwards records it in chat_changes
+    as (chat_id, seq, message_id). "What changed after seq N" is one range
+    scan on chat_changes. Parked readers hold an asyncio.Event per chat that
+    writes in this process set, instead of re-querying.
+
+    A number is reserved before its write lands, so a later number can be
+    recorded first. Readers stop at the first missing number (changes),
+    unless the changes after it were recorded more than SEQUENCE_LEASE_SECONDS
+    ago, i.e. its writer died. This holds across processes; writes in other
+    processes are only picked up when a parked reader times out.
+    """
+
+    def __init__(self, head_window: int):
+        self.head_window = head_window
+        self._watchers: Dict[str, Set[asyncio.Event]] = {}
+
+    @asynccontextmanager
+    async def allocate(self, message_ids: Dict[str, List[str]]) -> AsyncIterator[Dict[str, int]]:
+        """Reserve one number per changed message, consecutive per chat; yields the first number of each chat.
+
+        The i-th message of a chat's list gets first + i. Do the write inside
+        the block: on exit the numbers are recorded in chat_changes (also when
+        the write failed, so readers are not held back) and the chats'
+        watchers are woken.
+        """
+        message_ids = {chat_id: ids for chat_id, ids in message_ids.items() if ids}
+        sequences_collection = await get_collection("chat_sequences")
+
+        firsts = {}
+
+        async def reserve(chat_id: str, count: int):
+            sequence = await sequences_collection.find_one_and_update(
+                {"chat_id": chat_id},
+                {"$inc": {"seq": count}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            firsts[chat_id] = sequence["seq"] - count + 1
+
+        try:
+            await asyncio.gather(*[reserve(chat_id, len(ids)) for chat_id, ids in message_ids.items()])
+            yield firsts
+        finally:
+            if firsts:
+                changes_collection = await get_collection("chat_changes")
+                now = datetime.utcnow()
+                await changes_collection.insert_many([
+                    {"chat_id": chat_id, "seq": first + position, "message_id": message_id, "created_at": now}
+                    for chat_id, first in firsts.items()
+                    for position, message_id in enumerate(message_ids[chat_id])
+                ], ordered=False)
+            for chat_id in firsts:
+                for watcher in self._watchers.get(chat_id, ()):
+                    watcher.set()
+
+    @asynccontextmanager
+    async def allocate_messages(self, message_dicts: List[dict]) -> AsyncIterator[None]:
+        """allocate() for new messages: stamps `seq` on every visible one, in list order per chat"""
+        visible = [message_dict for message_dict in message_dicts if not message_dict.get("is_scheduled")]
+        message_ids: Dict[str, List[str]] = {}
+        for message_dict in visible:
+            message_ids.setdefault(message_dict["chat_id"], []).append(message_dict["id"])
+        async with self.allocate(message_ids) as firsts:
+            next_seqs = dict(firsts)
+            for message_dict in visible:
+                message_dict["seq"] = next_seqs[message_dict["chat_id"]]
+                next_seqs[message_dict["chat_id"]] += 1
+            yield
+
+    async def changes(self, chat_id: str, since: int, limit: int) -> List[dict]:
+        """Recorded changes after `since` in sequence order, up to the first number still being written"""
+        changes_collection = await get_collection("chat_changes")
+
+        rows = await changes_collection.find(
+            {"chat_id": chat_id, "seq": {"$gt": since}}, {"_id": 0}
+        ).sort("seq", 1).limit(limit).to_list(limit)
+
+        settled = datetime.utcnow() - timedelta(seconds=SEQUENCE_LEASE_SECONDS)
+        visible = []
+        expected = since + 1
+        for row in rows:
+            if row["seq"] != expected and row["created_at"] > settled:
+                break
+            visible.append(row)
+            expected = row["seq"] + 1
+        return visible
+
+    async def head(self, chat_id: str) -> int:
+        """Latest sequence number of a chat up to which every write has landed (0 before its first mutation)"""
+        sequences_collection = await get_collection("chat_sequences")
+        sequence = await sequences_collection.find_one({"chat_id": chat_id}, {"seq": 1, "_id": 0})
+        if not sequence:
+            return 0
+        since = max(sequence["seq"] - self.head_window, 0)
+        changes = await self.changes(chat_id, since, self.head_window)
+        return changes[-1]["seq"] if changes else since
+
+    def watch(self, chat_id: str) -> asyncio.Event:
+        """Register an event set on the chat's next mutation; call before reading to not miss one"""
+        watcher = asyncio.Event()
+        self._watchers.setdefault(chat_id, set()).add(watcher)
+        return watcher
+
+    def unwatch(self, chat_id: str, watcher: asyncio.Event):
+        watchers = self._watchers.get(chat_id)
+        if watchers is not None:
+            watchers.discard(watcher)
+            if not watchers:
+                del self._watchers[chat_id]
+
+    def stats(self) -> dict:
+        return {
+            "watched_chats": len(self._watchers),
+            "watchers": sum(len(watchers) for watchers in self._watchers.values())
+        }
+
+chat_sequencer = ChatSequencer(SEQUENCE_HEAD_WINDOW)
@@ -1,10 +1,29 @@
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+from pymongo import ReturnDocument
 from datetime import datetime
 from database import get_collection
-from models import Chat, ChatCreate, ChatUpdate, ChatType, User
+from models import Chat, ChatCreate, ChatUpdate, ChatType, InboxEntry, MemberRole, User
+from services.membership_service import MembershipService
+from services.inbox_service import InboxService
+from services.last_message_coalescer import last_message_coalescer
+from services.search_backend import folded_name_fields
+import identity_map
 import uuid
 
 class ChatService:
+    # Legacy chats may still carry embedded member arrays; never load them
+    CHAT_PROJECTION = {"members": 0, "admins": 0}
+    
+    @staticmethod
+    async def load_chat_document(chat_id: str) -> Optional[dict]:
+        """Load a raw chat document through the request identity map"""
+        chats_collection = await get_collection("chats")
+        return await identity_map.load(
+            "chats",
+            chat_id,
+            lambda: chats_collection.find_one({"id": chat_id}, ChatService.CHAT_PROJECTION)
+        )
+    
     @staticmethod
     async def create_chat(chat_data: ChatCreate, creator_id: str) -> Chat:
         """Create a new chat"""
@@ -14,88 +33,149 @@ class ChatService:
         chat_dict["id"] = str(uuid.uuid4())
         chat_dict["created_at"] = datetime.utcnow()
         chat_dict["updated_at"] = datetime.utcnow()
+        chat_dict.update(folded_name_fields(chat_dict))
         
-        # Add creator to participants/members based on chat type
+        # Membership goes to chat_members; private chats also keep their two participants inline
+        roles = {creator_id: MemberRole.member}
+        roles.update({participant: MemberRole.member for participant in chat_data.participants if participant != creator_id})
         if chat_data.type == ChatType.private:
-            chat_dict["participants"] = [creator_id] + chat_data.participants
+            chat_dict["participants"] = list(roles)
         else:
-            chat_dict["members"] = [creator_id] + chat_data.participants
-            chat_dict["admins"] = [creator_id]
+            chat_dict["participants"] = []
             chat_dict["owner"] = creator_id
+            roles[creator_id] = MemberRole.owner
+        chat_dict["members_count"] = len(roles)
         
         # Set default values based on chat type
         if chat_data.type == ChatType.channel:
             chat_dict["is_public"] = chat_data.is_public
-            chat_dict["subscribers_count"] = len(chat_dict["members"])
+            chat_dict["subscribers_count"] = len(roles)
         elif chat_data.type == ChatType.bot:
             chat_dict["is_verified"] = True
             chat_dict["bot_commands"] = ["/help", "/start", "/stop"]
         
         await chats_collection.insert_one(chat_dict)
+        await MembershipService.add_members(chat_dict["id"], roles)
+        await InboxService.add_entries(chat_dict["id"], chat_data.type.value, roles, chat_dict["created_at"])
+        identity_map.remember("chats", chat_dict["id"], chat_dict)
         return Chat(**chat_dict)
     
     @staticmethod
-    async def get_user_chats(user_id: str) -> List[Chat]:
-        """Get all chats for a user"""
+    async def get_user_chats(user_id: str, limit: int = 100, cursor: Optional[str] = None, archived: bool = False) -> List[Chat]:
+        """Get a user's chats (or archived chats), most recent activity first"""
+        chats, _ = await ChatService.get_user_chats_page(user_id, limit, cursor, archived)
+        return chats
+    
+    @staticmethod
+    async def get_user_chats_page(user_id: str, limit: int = 100, cursor: Optional[str] = None, archived: bool = False,
+                                  chat_type: Optional[ChatType] = None) -> Tuple[List[Chat], Optional[str]]:
+        """Get one page of a user's chats (or archived chats) from their inbox, with per-user state applied.
+        
+        Raises ValueError for malformed cursors.
+        """
+        entries, next_cursor = await InboxService.list_entries(user_id, limit, cursor, archived, chat_type)
+        if not entries:
+            return [], None
+        return await ChatService.get_chats_for_entries(entries), next_cursor
+    
+    @staticmethod
+    async def get_chats_for_entries(entries: List[InboxEntry]) -> List[Chat]:
+        """Load the chats of inbox rows in one $in query, with each row's per-user state applied"""
         chats_collection = await get_collection("chats")
         
-        # Find chats where user is participant, member, or it's a public channel
-        query = {
-            "$or": [
-                {"participants": user_id},
-                {"members": user_id},
-                {"type": "channel", "is_public": True}
-            ],
-            "is_archived": {"$ne": True}
-        }
+        chats_cursor = chats_collection.find({"id": {"$in": [entry.chat_id for entry in entries]}}, ChatService.CHAT_PROJECTION)
+        chats_by_id = {chat_data["id"]: chat_data async for chat_data in chats_cursor}
         
-        cursor = chats_collection.find(query).sort("updated_at", -1)
         chats = []
-        async for chat_data in cursor:
-            chats.append(Chat(**chat_data))
+        for entry in entries:
+            chat_data = chats_by_id.get(entry.chat_id)
+            if not chat_data:
+                continue
+            chats.append(Chat(**{
+                **chat_data,
+                "is_pinned": entry.is_pinned,
+                "is_muted": entry.is_muted,
+                "is_archived": entry.is_archived,
+                "unread_count": entry.unread_count
+            }))
         
         return chats
     
     @staticmethod
     async def get_chat_by_id(chat_id: str, user_id: str) -> Optional[Chat]:
         """Get a specific chat by ID"""
-        chats_collection = await get_collection("chats")
-        
-        chat_data = await chats_collection.find_one({"id": chat_id})
+        chat_data = await ChatService.load_chat_document(chat_id)
         if not chat_data:
             return None
         
         chat = Chat(**chat_data)
         
         # Check if user has access to this chat
-        if not ChatService.user_has_access(chat, user_id):
+        if not await ChatService.user_has_access(chat, user_id):
             return None
         
         return chat
     
     @staticmethod
-    async def update_chat(chat_id: str, chat_update: ChatUpdate, user_id: str) -> Optional[Chat]:
-        """Update a chat"""
+    async def get_accessible_chats(chat_ids: List[str], user_id: str) -> Dict[str, Chat]:
+        """Get the chats among `chat_ids` that the user has access to, keyed by ID.
+        
+        Runs one $in query on chats and at most one on chat_members, however
+        many chats are asked for.
+        """
         chats_collection = await get_collection("chats")
         
-        # First check if user has permission to update
-        chat = await ChatService.get_chat_by_id(chat_id, user_id)
-        if not chat:
-            return None
+        unique_ids = list(dict.fromkeys(chat_ids))
+        if not unique_ids:
+            return {}
+        
+        cursor = chats_collection.find({"id": {"$in": unique_ids}}, ChatService.CHAT_PROJECTION)
+        chats = {chat_data["id"]: Chat(**chat_data) async for chat_data in cursor}
+        
+        accessible = {}
+        needs_membership = []
+        for chat_id, chat in chats.items():
+            if chat.type == ChatType.private:
+                if user_id in chat.participants:
+                    accessible[chat_id] = chat
+            elif chat.type == ChatType.channel and chat.is_public:
+                accessible[chat_id] = chat
+            else:
+                needs_membership.append(chat_id)
+        
+        if needs_membership:
+            member_of = await MembershipService.get_member_chat_ids(user_id, needs_membership)
+            accessible.update({chat_id: chats[chat_id] for chat_id in needs_membership if chat_id in member_of})
+        
+        return accessible
+    
+    @staticmethod
+    async def update_chat(chat_id: str, chat_update: ChatUpdate, user_id: str) -> Optional[Chat]:
+        """Update a chat (admins and the owner only) and return it in the same write"""
+        chats_collection = await get_collection("chats")
         
-        # Check if user is admin or owner
-        if user_id not in chat.admins and chat.owner != user_id:
-            return None
+        # Admins are known from chat_members; otherwise only the owner may write
+        query = {"id": chat_id}
+        if not await MembershipService.is_admin(chat_id, user_id):
+            query["owner"] = user_id
         
         update_data = {k: v for k, v in chat_update.dict().items() if v is not None}
+        update_data.update(folded_name_fields(update_data))
         update_data["updated_at"] = datetime.utcnow()
         
-        await chats_collection.update_one(
-            {"id": chat_id},
-            {"$set": update_data}
+        chat_data = await chats_collection.find_one_and_update(
+            query,
+            {"$set": update_data},
+            projection=ChatService.CHAT_PROJECTION,
+            return_document=ReturnDocument.AFTER
         )
+        if not chat_data:
+            # Not allowed (or gone): the chat itself may well exist, so forget rather than cache a miss
+            identity_map.discard("chats", chat_id)
+            return None
+        identity_map.remember("chats", chat_id, chat_data)
         
-        return await ChatService.get_chat_by_id(chat_id, user_id)
+        return Chat(**chat_data)
     
     @staticmethod
     async def delete_chat(chat_id: str, user_id: str) -> bool:
@@ -107,10 +187,16 @@ class ChatService:
             return False
         
         await chats_collection.delete_one({"id": chat_id})
+        await MembershipService.remove_all_members(chat_id)
+        await InboxService.remove_chat(chat_id)
+        identity_map.remember("chats", chat_id, None)
         
         # Also delete all messages in this chat
         messages_collection = await get_collection("messages")
         await messages_collection.delete_many({"chat_id": chat_id})
+        identity_map.discard("messages")
+        reactions_collection = await get_collection("message_reactions")
+        await reactions_collection.delete_many({"chat_id": chat_id})
         
         return True
     
@@ -119,7 +205,7 @@ class ChatService:
         """Join a public chat/channel"""
         chats_collection = await get_collection("chats")
         
-        chat_data = await chats_collection.find_one({"id": chat_id})
+        chat_data = await ChatService.load_chat_document(chat_id)
         if not chat_data:
             return False
         
@@ -129,19 +215,22 @@ class ChatService:
         if not chat.is_public and chat.type not in [ChatType.channel, ChatType.group]:
             return False
         
-        # Check if already a member
-        if user_id in chat.members:
+        # Single upsert; already being a member is a no-op
+        if not await MembershipService.add_member(chat_id, user_id):
             return True
+        await InboxService.add_entries(chat_id, chat.type.value, [user_id], chat.last_message_time, chat.last_message)
         
-        # Add user to members
+        counters = {"members_count": 1}
+        if chat.type == ChatType.channel:
+            counters["subscribers_count"] = 1
         await chats_collection.update_one(
             {"id": chat_id},
             {
-                "$addToSet": {"members": user_id},
-                "$inc": {"subscribers_count": 1},
+                "$inc": counters,
                 "$set": {"updated_at": datetime.utcnow()}
             }
         )
+        identity_map.discard("chats", chat_id)
         
         return True
     
@@ -158,63 +247,77 @@ class ChatService:
         if chat.owner == user_id:
             return False
         
-        # Remove from members/participants
+        if not await MembershipService.remove_member(chat_id, user_id):
+            # Public channel visitors have access without being members
+            return chat.type == ChatType.channel and chat.is_public
+        await InboxService.remove_entry(chat_id, user_id)
+        
+        counters = {"members_count": -1}
+        if chat.type == ChatType.channel:
+            counters["subscribers_count"] = -1
         update_query = {
-            "$pull": {"members": user_id, "participants": user_id, "admins": user_id},
+            "$inc": counters,
             "$set": {"updated_at": datetime.utcnow()}
         }
-        
-        if chat.type == ChatType.channel:
-            update_query["$inc"] = {"subscribers_count": -1}
+        if user_id in chat.participants:
+            update_query["$pull"] = {"participants": user_id}
         
         await chats_collection.update_one({"id": chat_id}, update_query)
+        identity_map.discard("chats", chat_id)
         
         return True
     
     @staticmethod
     async def update_last_message(chat_id: str, message_text: str, timestamp: datetime):
-        """Update chat's last message info"""
-        chats_collection = await get_collection("chats")
-        
-        await chats_collection.update_one(
-            {"id": chat_id},
-            {
-                "$set": {
-                    "last_message": message_text,
-                    "last_message_time": timestamp,
-                    "updated_at": timestamp
-                }
-            }
-        )
+        """Update chat's last message info (written behind by the last message coalescer)"""
+        await ChatService.update_last_messages({chat_id: (message_text, timestamp)})
     
     @staticmethod
-    def user_has_access(chat: Chat, user_id: str) -> bool:
+    async def update_last_messages(updates: Dict[str, Tuple[str, datetime]]):
+        """Update last message info of many chats (chat ID -> (text, timestamp)).
+
+        Updates are coalesced per chat and written in batches, so chat
+        documents may lag the newest message by LAST_MESSAGE_FLUSH_SECONDS.
+        """
+        if not updates:
+            return
+        
+        await last_message_coalescer.submit(updates)
+        for chat_id in updates:
+            identity_map.discard("chats", chat_id)
+    
+    @staticmethod
+    async def record_delivered_messages(message_dicts: List[dict]):
+        """Update last-message info of chats and inboxes for newly visible messages, one bulk write each"""
+        latest = {}
+        for message_dict in message_dicts:
+            current = latest.get(message_dict["chat_id"])
+            if current is None or message_dict["timestamp"] >= current["timestamp"]:
+                latest[message_dict["chat_id"]] = message_dict
+        if not latest:
+            return
+        
+        await ChatService.update_last_messages({
+            chat_id: (message_dict.get("text") or "Media", message_dict["timestamp"])
+            for chat_id, message_dict in latest.items()
+        })
+        await InboxService.record_messages([
+            (message_dict["chat_id"], message_dict["sender_id"], message_dict.get("text") or "Media", message_dict["timestamp"])
+            for message_dict in message_dicts
+        ])
+    
+    @staticmethod
+    async def user_has_access(chat: Chat, user_id: str) -> bool:
         """Check if user has access to a chat"""
         if chat.type == ChatType.private:
             return user_id in chat.participants
         elif chat.type == ChatType.channel and chat.is_public:
             return True
         else:
-            return user_id in chat.members
+            return await MembershipService.is_member(chat.id, user_id)
     
     @staticmethod
-    async def get_chats_by_type(user_id: str, chat_type: ChatType) -> List[Chat]:
-        """Get chats filtered by type"""
-        chats_collection = await get_collection("chats")
-        
-        query = {
-            "type": chat_type.value,
-            "$or": [
-                {"participants": user_id},
-                {"members": user_id},
-                {"is_public": True} if chat_type == ChatType.channel else {}
-            ],
-            "is_archived": {"$ne": True}
-        }
-        
-        cursor = chats_collection.find(query).sort("updated_at", -1)
-        chats = []
-        async for chat_data in cursor:
-            chats.append(Chat(**chat_data))
-        
-        return chats
\ No newline at end of file
+    async def get_chats_by_type(user_id: str, chat_type: ChatType, limit: int = 100, archived: bool = False) -> List[Chat]:
+        """Get a user's chats of one type from their inbox (archived per user), most recent activity first"""
+        chats, _ = await ChatService.get_user_chats_page(user_id, limit, archived=archived, chat_type=chat_type)
+        return chats
@@ -0,0 +1,124 @@
+from typing import Awaitable, Callable, List, Optional
+from datetime import datetime, timedelta
+from database import get_collection
+import asyncio
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Self-destruct configuration
+# Expiries closer together than this are hidden by the same sweep
+MESSAGE_EXPIRY_BATCH_SECONDS = float(os.getenv("MESSAGE_EXPIRY_BATCH_SECONDS", "1"))
+# Longest sleep between sweeps when no expiry is known (catches messages written by other processes)
+MESSAGE_EXPIRY_IDLE_SECONDS = float(os.getenv("MESSAGE_EXPIRY_IDLE_SECONDS", "30"))
+# Most expired messages hidden per delete round trip
+MESSAGE_EXPIRY_BATCH_SIZE = int(os.getenv("MESSAGE_EXPIRY_BATCH_SIZE", "500"))
+
+_DURATION_PATTERN = re.compile(r"^\s*(\d+)\s*([smhdw])\s*$")
+_DURATION_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
+def parse_self_destruct(value: Optional[str]) -> Optional[timedelta]:
+    """Parse a self-destruct timer such as "30s", "5m", "1h" or "1d".
+
+    Returns None when no timer is set and raises ValueError for malformed ones.
+    """
+    if not value:
+        return None
+    match = _DURATION_PATTERN.match(value.lower())
+    if not match or int(match.group(1)) <= 0:
+        raise ValueError(f"Invalid self-destruct timer: {value}")
+    return timedelta(**{_DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+class MessageExpirySweeper:
+    """Hides self-destructing messages as soon as their `expires_at` passes.
+
+    The TTL index on expires_at only removes the documents once sync tokens
+    older than their expiry are reset anyway (SYNC_TOMBSTONE_TTL_SECONDS), so
+    hiding them is up to the sweeper. It sleeps until the
+    next known expiry (plus MESSAGE_EXPIRY_BATCH_SECONDS, so a burst of secret
+    messages expires together) and then hides every expired message through
+    the same path as a delete (MessageService.hide_messages, passed to start()),
+    so the change feeds, caches, search index and realtime clients see it.
+    """
+
+    def __init__(self, batch_seconds: float, idle_seconds: float, batch_size: int):
+        self.batch = timedelta(seconds=batch_seconds)
+        self.idle = timedelta(seconds=idle_seconds)
+        self.batch_size = batch_size
+        self._hide_messages: Optional[Callable[[List[dict]], Awaitable[int]]] = None
+        self._next_sweep: Optional[datetime] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, hide_messages: Callable[[List[dict]], Awaitable[int]]):
+        self._hide_messages = hide_messages
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("✅ Message expiry sweeper started")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self, expires_at: datetime):
+        """Tell the sweeper about a message written in this process with an expiry"""
+        if self._wakeup is None:
+            return
+        if self._next_sweep is None or expires_at + self.batch < self._next_sweep:
+            self._wakeup.set()
+
+    async def sweep(self) -> int:
+        """Hide every message whose expiry has passed"""
+        messages_collection = await get_collection("messages")
+
+        now = datetime.utcnow()
+        hidden = 0
+        while True:
+            expired = await messages_collection.find(
+                {"expires_at": {"$lte": now}, "is_deleted": {"$ne": True}},
+                {"id": 1, "chat_id": 1, "_id": 0}
+            ).limit(self.batch_size).to_list(self.batch_size)
+            hidden += await self._hide_messages(expired)
+            if len(expired) < self.batch_size:
+                return hidden
+
+    async def _next_expiry(self) -> Optional[datetime]:
+        messages_collection = await get_collection("messages")
+
+        message_data = await messages_collection.find_one(
+            {"expires_at": {"$gt": datetime.utcnow()}, "is_deleted": {"$ne": True}},
+            {"expires_at": 1, "_id": 0},
+            sort=[("expires_at", 1)]
+        )
+        return message_data["expires_at"] if message_data else None
+
+    async def _run(self):
+        while True:
+            try:
+                expired = await self.sweep()
+                if expired:
+                    logger.info(f"✅ Hid {expired} self-destructed messages")
+
+                now = datetime.utcnow()
+                self._next_sweep = now + self.idle
+                next_expiry = await self._next_expiry()
+                if next_expiry and next_expiry + self.batch < self._next_sweep:
+                    self._next_sweep = next_expiry + self.batch
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max((self._next_sweep - now).total_seconds(), 0.01))
+                except asyncio.TimeoutError:
+                    pass
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Message expiry sweeper error: {e}")
+                await asyncio.sleep(1)
+
+message_expiry_sweeper = MessageExpirySweeper(MESSAGE_EXPIRY_BATCH_SECONDS, MESSAGE_EXPIRY_IDLE_SECONDS, MESSAGE_EXPIRY_BATCH_SIZE)
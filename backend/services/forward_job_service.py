@@ -0,0 +1,210 @@
+from typing import Iterable, List, Optional
+from collections import Counter
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from database import get_collection
+from models import ForwardJobStatus, ForwardJobState, Message
+from services.message_service import MessageService
+import asyncio
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Background forwarding configuration
+FORWARD_JOB_CHUNK_SIZE = int(os.getenv("FORWARD_JOB_CHUNK_SIZE", "500"))
+FORWARD_JOB_WORKERS = int(os.getenv("FORWARD_JOB_WORKERS", "4"))
+# Failures kept on the job document (the counters are always exact)
+FORWARD_JOB_MAX_REPORTED_FAILURES = 1000
+# A process renews the lease of its unfinished jobs every third of this; jobs whose lease
+# ran out belong to a process that died or restarted and are marked interrupted
+FORWARD_JOB_LEASE_SECONDS = float(os.getenv("FORWARD_JOB_LEASE_SECONDS", "60"))
+# Identifies this process as the owner of the jobs it queued
+FORWARD_JOB_WORKER_ID = str(uuid.uuid4())
+
+ACTIVE_JOB_STATES = [ForwardJobState.queued.value, ForwardJobState.running.value]
+
+class ForwardJobService:
+    """Forward jobs: one document per job in forward_jobs, updated as chunks finish.
+
+    Chunks only live in the memory of the process that created the job, so a
+    job is leased to that process (worker_id / lease_expires_at). Any process
+    marks jobs with an expired lease as interrupted.
+    """
+
+    @staticmethod
+    async def create_job(message: Message, target_chat_ids: List[str], user_id: str, sender_name: str, add_caption: Optional[str] = None) -> ForwardJobStatus:
+        """Create a forward job and queue its chunks for the background workers"""
+        jobs_collection = await get_collection("forward_jobs")
+
+        chunks = [
+            target_chat_ids[start:start + FORWARD_JOB_CHUNK_SIZE]
+            for start in range(0, len(target_chat_ids), FORWARD_JOB_CHUNK_SIZE)
+        ]
+        now = datetime.utcnow()
+        job_dict = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "message_id": message.id,
+            "status": ForwardJobState.queued.value if chunks else ForwardJobState.completed.value,
+            "total_targets": len(target_chat_ids),
+            "pending_chunks": len(chunks),
+            "total_sent": 0,
+            "total_failed": 0,
+            "failed_forwards": [],
+            "worker_id": FORWARD_JOB_WORKER_ID,
+            "lease_expires_at": now + timedelta(seconds=FORWARD_JOB_LEASE_SECONDS),
+            "created_at": now,
+            "updated_at": now,
+            "completed_at": None if chunks else now
+        }
+        await jobs_collection.insert_one(job_dict)
+
+        for chunk in chunks:
+            forward_job_queue.enqueue(job_dict["id"], message, chunk, user_id, sender_name, add_caption)
+
+        return ForwardJobStatus(**job_dict)
+
+    @staticmethod
+    async def get_job(job_id: str, user_id: str) -> Optional[ForwardJobStatus]:
+        """Get a forward job's progress (only its owner can see it)"""
+        jobs_collection = await get_collection("forward_jobs")
+
+        job_data = await jobs_collection.find_one({"id": job_id, "user_id": user_id})
+        if not job_data:
+            return None
+
+        return ForwardJobStatus(**job_data)
+
+    @staticmethod
+    async def record_chunk(job_id: str, sent: int, failed_forwards: List[dict]):
+        """Add one finished chunk's results to its job and complete the job after the last chunk.
+
+        Chunks of a job that was already marked interrupted are not recorded.
+        """
+        jobs_collection = await get_collection("forward_jobs")
+
+        now = datetime.utcnow()
+        job_data = await jobs_collection.find_one_and_update(
+            {"id": job_id, "status": {"$in": ACTIVE_JOB_STATES}},
+            {
+                "$inc": {"total_sent": sent, "total_failed": len(failed_forwards), "pending_chunks": -1},
+                "$push": {"failed_forwards": {"$each": failed_forwards, "$slice": FORWARD_JOB_MAX_REPORTED_FAILURES}},
+                "$set": {
+                    "status": ForwardJobState.running.value,
+                    "lease_expires_at": now + timedelta(seconds=FORWARD_JOB_LEASE_SECONDS),
+                    "updated_at": now
+                }
+            },
+            return_document=ReturnDocument.AFTER
+        )
+
+        if job_data and job_data["pending_chunks"] <= 0:
+            await jobs_collection.update_one(
+                {"id": job_id},
+                {"$set": {"status": ForwardJobState.completed.value, "completed_at": now, "updated_at": now}}
+            )
+
+    @staticmethod
+    async def renew_leases(job_ids: Iterable[str]):
+        """Extend the lease of unfinished jobs this process is still working on"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        jobs_collection = await get_collection("forward_jobs")
+
+        await jobs_collection.update_many(
+            {"id": {"$in": job_ids}, "worker_id": FORWARD_JOB_WORKER_ID, "status": {"$in": ACTIVE_JOB_STATES}},
+            {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=FORWARD_JOB_LEASE_SECONDS)}}
+        )
+
+    @staticmethod
+    async def fail_interrupted_jobs() -> int:
+        """Mark unfinished jobs whose owning process stopped renewing their lease as interrupted"""
+        jobs_collection = await get_collection("forward_jobs")
+
+        now = datetime.utcnow()
+        result = await jobs_collection.update_many(
+            {
+                "status": {"$in": ACTIVE_JOB_STATES},
+                "$or": [
+                    {"lease_expires_at": {"$lt": now}},
+                    # Jobs created before leases existed
+                    {"lease_expires_at": {"$exists": False}, "updated_at": {"$lt": now - timedelta(seconds=FORWARD_JOB_LEASE_SECONDS)}}
+                ]
+            },
+            {"$set": {"status": ForwardJobState.interrupted.value, "completed_at": now, "updated_at": now}}
+        )
+        return result.modified_count
+
+class ForwardJobQueue:
+    """In-process queue of forward chunks drained by a fixed number of workers.
+
+    A maintenance task renews the leases of the jobs with chunks still queued
+    here and marks jobs whose lease expired (in any process) as interrupted.
+    """
+
+    def __init__(self, workers: int, lease_seconds: float):
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        # Job ID -> chunks queued or being forwarded
+        self._active: Counter = Counter()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+        logger.info(f"✅ Started {self.workers} forward job workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, job_id: str, message: Message, chat_ids: List[str], user_id: str, sender_name: str, add_caption: Optional[str]):
+        if self._queue is None:
+            raise RuntimeError("Forward job queue is not running")
+        self._queue.put_nowait((job_id, message, chat_ids, user_id, sender_name, add_caption))
+        self._active[job_id] += 1
+
+    async def _worker(self):
+        while True:
+            job_id, message, chat_ids, user_id, sender_name, add_caption = await self._queue.get()
+            try:
+                successful_forwards, failed_forwards = await MessageService.forward_to_chats(
+                    message, chat_ids, user_id, sender_name, add_caption
+                )
+                await ForwardJobService.record_chunk(job_id, len(successful_forwards), failed_forwards)
+            except Exception as e:
+                logger.error(f"❌ Forward job {job_id} chunk failed: {e}")
+                try:
+                    await ForwardJobService.record_chunk(
+                        job_id, 0, [{"chat_id": chat_id, "error": str(e)} for chat_id in chat_ids]
+                    )
+                except Exception as record_error:
+                    logger.error(f"❌ Could not record failure of forward job {job_id}: {record_error}")
+            finally:
+                self._active[job_id] -= 1
+                if self._active[job_id] <= 0:
+                    del self._active[job_id]
+                self._queue.task_done()
+
+    async def _maintain(self):
+        while True:
+            try:
+                await asyncio.sleep(self.lease_seconds / 3)
+                await ForwardJobService.renew_leases(list(self._active))
+                interrupted = await ForwardJobService.fail_interrupted_jobs()
+                if interrupted:
+                    logger.info(f"⚠️ Marked {interrupted} forward jobs with an expired lease as interrupted")
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Forward job lease maintenance error: {e}")
+
+forward_job_queue = ForwardJobQueue(FORWARD_JOB_WORKERS, FORWARD_JOB_LEASE_SECONDS)
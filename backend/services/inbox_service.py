@@ -0,0 +1,317 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument, UpdateMany, UpdateOne
+from database import get_collection
+from indexes import SYNC_TOMBSTONE_TTL_SECONDS
+from models import ChatType, InboxEntry, InboxStateUpdate
+from pagination import encode_cursor, decode_cursor, keyset_filter
+import asyncio
+import identity_map
+
+class InboxService:
+    """Per-user view of each chat: one row per (user_id, chat_id).
+
+    Holds the state that differs between members of the same chat (pinned,
+    muted, archived, unread counter) plus the last activity time, so a user's
+    chat list is a single indexed range scan on (user_id, is_archived, last_activity).
+
+    Read state is a watermark: `last_read_at` is the timestamp of the newest
+    message the user has read, and everything at or before it counts as read.
+    """
+
+    # Upper bound when recounting unread messages
+    UNREAD_COUNT_LIMIT = 999
+
+    @staticmethod
+    async def add_entries(chat_id: str, chat_type: str, user_ids: Iterable[str], last_activity: Optional[datetime] = None, last_message: Optional[str] = None):
+        """Create inbox rows for users who joined a chat (existing rows are left untouched)"""
+        inbox_collection = await get_collection("inbox")
+
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {"user_id": user_id, "chat_id": chat_id},
+                {
+                    "$setOnInsert": {
+                        "chat_type": chat_type,
+                        "is_pinned": False,
+                        "is_muted": False,
+                        "is_archived": False,
+                        "unread_count": 0,
+                        "last_message": last_message,
+                        "last_activity": last_activity or now,
+                        "updated_at": now
+                    }
+                },
+                upsert=True
+            )
+            for user_id in dict.fromkeys(user_ids)
+        ]
+        if operations:
+            await inbox_collection.bulk_write(operations, ordered=False)
+        identity_map.discard("inbox")
+
+    @staticmethod
+    async def remove_entry(chat_id: str, user_id: str):
+        """Remove a chat from a user's inbox"""
+        inbox_collection = await get_collection("inbox")
+        result = await inbox_collection.delete_one({"user_id": user_id, "chat_id": chat_id})
+        identity_map.remember("inbox", (user_id, chat_id), None)
+        if result.deleted_count:
+            await InboxService.record_removals(chat_id, [user_id])
+
+    @staticmethod
+    async def remove_chat(chat_id: str):
+        """Remove a chat from every inbox"""
+        inbox_collection = await get_collection("inbox")
+        user_ids = [entry["user_id"] async for entry in inbox_collection.find({"chat_id": chat_id}, {"user_id": 1, "_id": 0})]
+        await inbox_collection.delete_many({"chat_id": chat_id})
+        identity_map.discard("inbox")
+        await InboxService.record_removals(chat_id, user_ids)
+
+    @staticmethod
+    async def record_removals(chat_id: str, user_ids: List[str]):
+        """Leave a tombstone per user so delta sync can tell clients the chat left their list"""
+        if not user_ids:
+            return
+        tombstones_collection = await get_collection("sync_tombstones")
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=SYNC_TOMBSTONE_TTL_SECONDS)
+        await tombstones_collection.insert_many([
+            {"user_id": user_id, "kind": "chat", "id": chat_id, "deleted_at": now, "expires_at": expires_at}
+            for user_id in user_ids
+        ])
+
+    @staticmethod
+    async def get_entry(user_id: str, chat_id: str) -> Optional[dict]:
+        """Get the raw inbox row of a user for a chat"""
+        inbox_collection = await get_collection("inbox")
+        return await identity_map.load(
+            "inbox",
+            (user_id, chat_id),
+            lambda: inbox_collection.find_one({"user_id": user_id, "chat_id": chat_id})
+        )
+
+    @staticmethod
+    async def record_message(chat_id: str, sender_id: str, message_text: str, timestamp: datetime):
+        """Bump last activity for every member and the unread counter for everyone but the sender"""
+        await InboxService.record_messages([(chat_id, sender_id, message_text, timestamp)])
+
+    @staticmethod
+    async def record_messages(messages: List[Tuple[str, str, str, datetime]]):
+        """Apply record_message for many (chat_id, sender_id, text, timestamp) in one bulk write.
+
+        Consecutive messages from the same sender in a chat are folded into a
+        single counter increment, so a burst costs a few writes per chat.
+        """
+        inbox_collection = await get_collection("inbox")
+
+        # Per chat, runs of (sender_id, count, text, timestamp) in timestamp order
+        runs_by_chat = {}
+        for chat_id, sender_id, message_text, timestamp in sorted(messages, key=lambda message: message[3]):
+            runs = runs_by_chat.setdefault(chat_id, [])
+            if runs and runs[-1][0] == sender_id:
+                runs[-1] = (sender_id, runs[-1][1] + 1, message_text, timestamp)
+            else:
+                runs.append((sender_id, 1, message_text, timestamp))
+
+        operations = []
+        for chat_id, runs in runs_by_chat.items():
+            _, _, last_text, last_timestamp = runs[-1]
+            operations.append(UpdateMany(
+                {"chat_id": chat_id},
+                {"$set": {"last_message": last_text, "last_activity": last_timestamp, "updated_at": last_timestamp}}
+            ))
+            for sender_id, count, _, timestamp in runs:
+                operations.extend([
+                    # The sender has implicitly read everything up to their own message
+                    UpdateOne(
+                        {"user_id": sender_id, "chat_id": chat_id},
+                        {"$set": {"unread_count": 0}, "$max": {"last_read_at": timestamp}}
+                    ),
+                    UpdateMany(
+                        {"chat_id": chat_id, "user_id": {"$ne": sender_id}},
+                        {"$inc": {"unread_count": count}}
+                    )
+                ])
+        if operations:
+            await inbox_collection.bulk_write(operations, ordered=True)
+        identity_map.discard("inbox")
+
+    @staticmethod
+    async def mark_read(user_id: str, chat_id: str, read_at: datetime, caught_up: bool = False) -> Optional[dict]:
+        """Advance a user's read watermark (it never moves backwards) and return the updated row.
+
+        With `caught_up` the unread counter is cleared in the same write.
+        """
+        inbox_collection = await get_collection("inbox")
+
+        update = {"$max": {"last_read_at": read_at}}
+        if caught_up:
+            update["$set"] = {"unread_count": 0, "updated_at": datetime.utcnow()}
+
+        entry = await inbox_collection.find_one_and_update(
+            {"user_id": user_id, "chat_id": chat_id},
+            update,
+            return_document=ReturnDocument.AFTER
+        )
+        identity_map.remember("inbox", (user_id, chat_id), entry)
+        return entry
+
+    @staticmethod
+    async def mark_read_many(user_id: str, read_ats: Dict[str, datetime]):
+        """Advance a user's read watermarks in many chats (chat ID -> read_at) with one bulk write.
+
+        Counters of chats read up to their last activity are cleared in the
+        same write; only chats left partly unread are recounted.
+        """
+        if not read_ats:
+            return
+
+        inbox_collection = await get_collection("inbox")
+
+        now = datetime.utcnow()
+        operations = []
+        for chat_id, read_at in read_ats.items():
+            operations.extend([
+                UpdateOne({"user_id": user_id, "chat_id": chat_id}, {"$max": {"last_read_at": read_at}}),
+                UpdateOne(
+                    {"user_id": user_id, "chat_id": chat_id, "last_activity": {"$lte": read_at}},
+                    {"$set": {"unread_count": 0, "updated_at": now}}
+                )
+            ])
+        await inbox_collection.bulk_write(operations, ordered=True)
+        for chat_id in read_ats:
+            identity_map.discard("inbox", (user_id, chat_id))
+
+        behind = await inbox_collection.find(
+            {"user_id": user_id, "chat_id": {"$in": list(read_ats)}, "unread_count": {"$gt": 0}},
+            {"chat_id": 1, "last_read_at": 1, "unread_count": 1, "_id": 0}
+        ).to_list(len(read_ats))
+        if not behind:
+            return
+
+        counts = await asyncio.gather(*[
+            InboxService.count_unread(user_id, entry["chat_id"], entry.get("last_read_at"))
+            for entry in behind
+        ])
+        recounted = [
+            UpdateOne({"user_id": user_id, "chat_id": entry["chat_id"]}, {"$set": {"unread_count": count, "updated_at": now}})
+            for entry, count in zip(behind, counts) if count != entry["unread_count"]
+        ]
+        if recounted:
+            await inbox_collection.bulk_write(recounted, ordered=False)
+
+    @staticmethod
+    async def count_unread(user_id: str, chat_id: str, last_read_at: Optional[datetime]) -> int:
+        """Count (up to UNREAD_COUNT_LIMIT) messages from others newer than a read watermark"""
+        messages_collection = await get_collection("messages")
+
+        query = {
+            "chat_id": chat_id,
+            "sender_id": {"$ne": user_id},
+            "is_deleted": {"$ne": True},
+            "is_scheduled": {"$ne": True}
+        }
+        if last_read_at:
+            query["timestamp"] = {"$gt": last_read_at}
+
+        return await messages_collection.count_documents(query, limit=InboxService.UNREAD_COUNT_LIMIT)
+
+    @staticmethod
+    async def get_readers(chat_id: str, timestamp: datetime, limit: int = 1000) -> List[str]:
+        """Get the users whose read watermark in a chat has reached a timestamp"""
+        inbox_collection = await get_collection("inbox")
+
+        cursor = inbox_collection.find(
+            {"chat_id": chat_id, "last_read_at": {"$gte": timestamp}},
+            {"user_id": 1, "_id": 0}
+        ).limit(limit)
+        return [entry["user_id"] async for entry in cursor]
+
+    @staticmethod
+    async def set_unread_count(user_id: str, chat_id: str, unread_count: int):
+        """Overwrite a user's unread counter for a chat"""
+        inbox_collection = await get_collection("inbox")
+        await inbox_collection.update_one(
+            {"user_id": user_id, "chat_id": chat_id},
+            {"$set": {"unread_count": unread_count, "updated_at": datetime.utcnow()}}
+        )
+        identity_map.discard("inbox", (user_id, chat_id))
+
+    @staticmethod
+    async def update_state(user_id: str, chat_id: str, state_update: InboxStateUpdate) -> Optional[InboxEntry]:
+        """Pin, mute or archive a chat for one user and return the row in the same write"""
+        inbox_collection = await get_collection("inbox")
+
+        update_data = {k: v for k, v in state_update.dict().items() if v is not None}
+        update_data["updated_at"] = datetime.utcnow()
+
+        entry = await inbox_collection.find_one_and_update(
+            {"user_id": user_id, "chat_id": chat_id},
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
+        )
+        if not entry:
+            identity_map.discard("inbox", (user_id, chat_id))
+            return None
+        identity_map.remember("inbox", (user_id, chat_id), entry)
+        return InboxEntry(**entry)
+
+    @staticmethod
+    async def list_entries(user_id: str, limit: int = 100, cursor: Optional[str] = None, archived: bool = False,
+                           chat_type: Optional[ChatType] = None) -> Tuple[List[InboxEntry], Optional[str]]:
+        """Get one page of a user's inbox (or archive), most recent activity first, optionally of one chat type.
+
+        Raises ValueError for malformed cursors.
+        """
+        inbox_collection = await get_collection("inbox")
+
+        query = {"user_id": user_id, "is_archived": archived}
+        if chat_type:
+            query["chat_type"] = chat_type.value
+        if cursor:
+            position = decode_cursor(cursor, 2)
+            if position is None:
+                raise ValueError("Invalid cursor")
+            query.update(keyset_filter(["last_activity", "chat_id"], position, -1))
+
+        limit = max(1, min(limit, 500))
+        rows = await inbox_collection.find(query).sort(
+            [("last_activity", -1), ("chat_id", -1)]
+        ).limit(limit + 1).to_list(limit + 1)
+        entries = [InboxEntry(**row) for row in rows]
+
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = encode_cursor(entries[-1].last_activity, entries[-1].chat_id)
+
+        return entries, next_cursor
+
+    @staticmethod
+    async def backfill_from_memberships() -> int:
+        """Build inbox rows from chat_members the first time the inbox collection is used"""
+        inbox_collection = await get_collection("inbox")
+        if await inbox_collection.estimated_document_count() > 0:
+            return 0
+
+        chats_collection = await get_collection("chats")
+        members_collection = await get_collection("chat_members")
+
+        backfilled = 0
+        async for chat_data in chats_collection.find({}, {"id": 1, "type": 1, "last_message": 1, "last_message_time": 1, "updated_at": 1}):
+            user_ids = [
+                membership["user_id"]
+                async for membership in members_collection.find({"chat_id": chat_data["id"]}, {"user_id": 1})
+            ]
+            await InboxService.add_entries(
+                chat_data["id"],
+                chat_data["type"],
+                user_ids,
+                chat_data.get("last_message_time") or chat_data.get("updated_at"),
+                chat_data.get("last_message")
+            )
+            backfilled += len(user_ids)
+
+        return backfilled
@@ -0,0 +1,120 @@
+from typing import Dict, Optional, Tuple
+from pymongo import UpdateOne
+from datetime import datetime
+from database import get_collection
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Last-message coalescing configuration
+# Updates to the same chat within this window collapse into one write
+LAST_MESSAGE_FLUSH_SECONDS = float(os.getenv("LAST_MESSAGE_FLUSH_SECONDS", "0.5"))
+# Flush early once this many chats are waiting
+LAST_MESSAGE_MAX_PENDING = int(os.getenv("LAST_MESSAGE_MAX_PENDING", "1000"))
+
+class LastMessageCoalescer:
+    """Write-behind buffer for chats' last_message / last_message_time.
+
+    Every delivered message used to rewrite its chat document; on a busy group
+    that is one write per message to the same document. Submissions are kept
+    per chat (newest timestamp wins) and flushed every LAST_MESSAGE_FLUSH_SECONDS
+    with one unordered bulk write. Each update only applies when it is newer
+    than what the chat already holds, so other processes' flushes can land in
+    any order. Pending updates are flushed on stop().
+
+    Before start() (scripts, tests) submissions are written immediately.
+    """
+
+    def __init__(self, flush_seconds: float, max_pending: int):
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._pending: Dict[str, Tuple[str, datetime]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("✅ Last message coalescer started")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._wakeup = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"❌ Failed to flush {len(self._pending)} last message updates on shutdown: {e}")
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def submit(self, updates: Dict[str, Tuple[str, datetime]]):
+        """Queue last message info (chat ID -> (text, timestamp)), keeping the newest per chat"""
+        for chat_id, (message_text, timestamp) in updates.items():
+            current = self._pending.get(chat_id)
+            if current is None or timestamp >= current[1]:
+                self._pending[chat_id] = (message_text, timestamp)
+
+        if self._wakeup is None:
+            await self.flush()
+        elif len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Write every pending update in one bulk write"""
+        if not self._pending:
+            return
+
+        updates, self._pending = self._pending, {}
+        try:
+            await LastMessageCoalescer.write(updates)
+        except BaseException:
+            # Put them back (also when cancelled mid-write) unless something newer arrived meanwhile
+            for chat_id, (message_text, timestamp) in updates.items():
+                current = self._pending.get(chat_id)
+                if current is None or timestamp > current[1]:
+                    self._pending[chat_id] = (message_text, timestamp)
+            raise
+
+    @staticmethod
+    async def write(updates: Dict[str, Tuple[str, datetime]]):
+        chats_collection = await get_collection("chats")
+
+        operations = [
+            UpdateOne(
+                # Never overwrite a newer last message
+                {"id": chat_id, "last_message_time": {"$not": {"$gt": timestamp}}},
+                {
+                    "$set": {
+                        "last_message": message_text,
+                        "last_message_time": timestamp,
+                        "updated_at": timestamp
+                    }
+                }
+            )
+            for chat_id, (message_text, timestamp) in updates.items()
+        ]
+        await chats_collection.bulk_write(operations, ordered=False)
+
+    async def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                await self.flush()
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Last message coalescer error: {e}")
+                await asyncio.sleep(1)
+
+last_message_coalescer = LastMessageCoalescer(LAST_MESSAGE_FLUSH_SECONDS, LAST_MESSAGE_MAX_PENDING)
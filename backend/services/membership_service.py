@@ -0,0 +1,195 @@
+from typing import Dict, List, Optional, Set
+from datetime import datetime
+from pymongo import UpdateOne
+from database import get_collection
+from models import ChatMember, ChatMembersPage, MemberRole
+from cache import TTLCache
+from services.realtime_hub import realtime_hub
+import identity_map
+import os
+
+# Short-lived cache of each user's chat IDs for latency-sensitive reads (typeahead)
+CHAT_IDS_CACHE_SIZE = int(os.getenv("CHAT_IDS_CACHE_SIZE", "10000"))
+CHAT_IDS_CACHE_TTL_SECONDS = float(os.getenv("CHAT_IDS_CACHE_TTL_SECONDS", "30"))
+chat_ids_cache = TTLCache(maxsize=CHAT_IDS_CACHE_SIZE, ttl=CHAT_IDS_CACHE_TTL_SECONDS)
+
+class MembershipService:
+    """Chat membership stored as one document per (chat_id, user_id).
+
+    Keeps chat documents small no matter how many members a group or channel
+    has: access checks are indexed point lookups instead of array scans.
+    """
+
+    @staticmethod
+    async def get_membership(chat_id: str, user_id: str) -> Optional[dict]:
+        """Get the membership document for a user in a chat"""
+        members_collection = await get_collection("chat_members")
+        return await identity_map.load(
+            "chat_members",
+            (chat_id, user_id),
+            lambda: members_collection.find_one({"chat_id": chat_id, "user_id": user_id})
+        )
+
+    @staticmethod
+    async def is_member(chat_id: str, user_id: str) -> bool:
+        """Check if a user is a member of a chat"""
+        return await MembershipService.get_membership(chat_id, user_id) is not None
+
+    @staticmethod
+    async def is_admin(chat_id: str, user_id: str) -> bool:
+        """Check if a user is an admin or the owner of a chat"""
+        membership = await MembershipService.get_membership(chat_id, user_id)
+        return membership is not None and membership.get("role") in (MemberRole.admin, MemberRole.owner)
+
+    @staticmethod
+    async def add_member(chat_id: str, user_id: str, role: MemberRole = MemberRole.member) -> bool:
+        """Add a user to a chat; returns False if they were already a member"""
+        members_collection = await get_collection("chat_members")
+
+        result = await members_collection.update_one(
+            {"chat_id": chat_id, "user_id": user_id},
+            {"$setOnInsert": {"role": role.value, "joined_at": datetime.utcnow()}},
+            upsert=True
+        )
+        identity_map.discard("chat_members", (chat_id, user_id))
+        chat_ids_cache.invalidate(user_id)
+        realtime_hub.add_member(chat_id, user_id)
+
+        return result.upserted_id is not None
+
+    @staticmethod
+    async def add_members(chat_id: str, roles: Dict[str, MemberRole]) -> int:
+        """Add several users (user ID -> role) to a chat in one bulk write; returns how many were new"""
+        members_collection = await get_collection("chat_members")
+
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {"chat_id": chat_id, "user_id": user_id},
+                {"$setOnInsert": {"role": role.value, "joined_at": now}},
+                upsert=True
+            )
+            for user_id, role in roles.items()
+        ]
+        if not operations:
+            return 0
+
+        result = await members_collection.bulk_write(operations, ordered=False)
+        identity_map.discard("chat_members")
+        for user_id in roles:
+            chat_ids_cache.invalidate(user_id)
+            realtime_hub.add_member(chat_id, user_id)
+
+        return result.upserted_count
+
+    @staticmethod
+    async def remove_member(chat_id: str, user_id: str) -> bool:
+        """Remove a user from a chat; returns False if they were not a member"""
+        members_collection = await get_collection("chat_members")
+
+        result = await members_collection.delete_one({"chat_id": chat_id, "user_id": user_id})
+        identity_map.remember("chat_members", (chat_id, user_id), None)
+        chat_ids_cache.invalidate(user_id)
+        realtime_hub.remove_member(chat_id, user_id)
+
+        return result.deleted_count > 0
+
+    @staticmethod
+    async def remove_all_members(chat_id: str):
+        """Remove every membership of a chat"""
+        members_collection = await get_collection("chat_members")
+        await members_collection.delete_many({"chat_id": chat_id})
+        identity_map.discard("chat_members")
+        chat_ids_cache.clear()
+        realtime_hub.remove_chat(chat_id)
+
+    @staticmethod
+    async def get_user_chat_ids(user_id: str) -> List[str]:
+        """Get the IDs of all chats a user is a member of"""
+        members_collection = await get_collection("chat_members")
+
+        cursor = members_collection.find({"user_id": user_id}, {"chat_id": 1, "_id": 0})
+        return [membership["chat_id"] async for membership in cursor]
+
+    @staticmethod
+    async def get_cached_user_chat_ids(user_id: str) -> List[str]:
+        """get_user_chat_ids through a cache that can lag other processes by CHAT_IDS_CACHE_TTL_SECONDS"""
+        chat_ids = chat_ids_cache.get(user_id)
+        if chat_ids is None:
+            chat_ids = await MembershipService.get_user_chat_ids(user_id)
+            chat_ids_cache.set(user_id, chat_ids)
+        return chat_ids
+
+    @staticmethod
+    async def get_member_chat_ids(user_id: str, chat_ids: List[str]) -> Set[str]:
+        """Get which of the given chats a user is a member of, in one query"""
+        members_collection = await get_collection("chat_members")
+
+        cursor = members_collection.find(
+            {"user_id": user_id, "chat_id": {"$in": chat_ids}},
+            {"chat_id": 1, "_id": 0}
+        )
+        return {membership["chat_id"] async for membership in cursor}
+
+    @staticmethod
+    async def list_members(chat_id: str, limit: int = 100, after: Optional[str] = None) -> ChatMembersPage:
+        """List a chat's members ordered by user ID, one page at a time"""
+        members_collection = await get_collection("chat_members")
+
+        query = {"chat_id": chat_id}
+        if after:
+            query["user_id"] = {"$gt": after}
+
+        limit = max(1, min(limit, 500))
+        cursor = members_collection.find(query).sort("user_id", 1).limit(limit + 1)
+        members = [ChatMember(**membership) async for membership in cursor]
+
+        next_cursor = None
+        if len(members) > limit:
+            members = members[:limit]
+            next_cursor = members[-1].user_id
+
+        return ChatMembersPage(members=members, next_cursor=next_cursor)
+
+    @staticmethod
+    async def migrate_embedded_members() -> int:
+        """Move legacy `members`/`admins` arrays out of chat documents into chat_members"""
+        chats_collection = await get_collection("chats")
+        members_collection = await get_collection("chat_members")
+
+        # Chats created before chat_members existed have no members_count
+        query = {"members_count": {"$exists": False}}
+        projection = {"id": 1, "members": 1, "admins": 1, "participants": 1, "owner": 1}
+        migrated = 0
+        async for chat_data in chats_collection.find(query, projection):
+            chat_id = chat_data["id"]
+            owner = chat_data.get("owner")
+            admins = set(chat_data.get("admins", []))
+            user_ids = dict.fromkeys(
+                chat_data.get("participants", []) + chat_data.get("members", []) + list(admins) + ([owner] if owner else [])
+            )
+            now = datetime.utcnow()
+
+            operations = []
+            for user_id in user_ids:
+                if user_id == owner:
+                    role = MemberRole.owner
+                elif user_id in admins:
+                    role = MemberRole.admin
+                else:
+                    role = MemberRole.member
+                operations.append(UpdateOne(
+                    {"chat_id": chat_id, "user_id": user_id},
+                    {"$setOnInsert": {"role": role.value, "joined_at": now}},
+                    upsert=True
+                ))
+
+            if operations:
+                await members_collection.bulk_write(operations, ordered=False)
+            await chats_collection.update_one(
+                {"id": chat_id},
+                {"$set": {"members_count": len(user_ids)}, "$unset": {"members": "", "admins": ""}}
+            )
+            migrated += 1
+
+        return migrated
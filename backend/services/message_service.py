@@ -1,40 +1,118 @@
-from typing import List, Optional
-from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+import asyncio
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from database import get_collection
-from models import Message, MessageCreate, MessageUpdate, MessageReactionUpdate, MessageType
+from models import Chat, ChatUpdates, Message, ReplyPreview, BulkMessageResult, MessageCreate, MessageUpdate, MessageReactionUpdate, MessageType, MessageReadReceipts, MessagePage, MessageSearchPage
+from pagination import encode_cursor, decode_cursor, keyset_filter
 from services.chat_service import ChatService
+from services.membership_service import MembershipService
+from services.inbox_service import InboxService
+from services.privacy_service import PrivacyService
+from services.scheduled_dispatcher import scheduled_dispatcher
+from services.expiry_sweeper import message_expiry_sweeper, parse_self_destruct
+from services.search_backend import NO_FILTERS, SearchFilters, search_backend
+from services.realtime_hub import realtime_hub
+from services.chat_sequencer import chat_sequencer
+from cache import TTLCache
+import identity_map
+import os
 import uuid
 
+# Reply previews by message ID, shared by every history page that quotes the message
+REPLY_PREVIEW_CACHE_SIZE = int(os.getenv("REPLY_PREVIEW_CACHE_SIZE", "10000"))
+REPLY_PREVIEW_CACHE_TTL_SECONDS = float(os.getenv("REPLY_PREVIEW_CACHE_TTL_SECONDS", "60"))
+reply_preview_cache = TTLCache(maxsize=REPLY_PREVIEW_CACHE_SIZE, ttl=REPLY_PREVIEW_CACHE_TTL_SECONDS)
+
 class MessageService:
+    # Longest accepted reaction (an emoji with modifiers, or a short custom code)
+    REACTION_MAX_LENGTH = 32
+    # Messages per "my reactions" lookup (a few history pages)
+    MY_REACTIONS_LIMIT = 500
+    # Changed messages returned by one updates call
+    UPDATES_LIMIT = 100
+    # Messages accepted by one bulk send
+    BULK_SEND_MAX_MESSAGES = 500
+    # Chats acknowledged by one bulk read
+    BULK_READ_MAX_CHATS = 500
+    # Characters of the quoted text kept in a reply preview
+    REPLY_PREVIEW_TEXT_LENGTH = 100
+    REPLY_PREVIEW_PROJECTION = {
+        "id": 1, "chat_id": 1, "sender_id": 1, "sender_name": 1, "text": 1,
+        "message_type": 1, "is_deleted": 1, "expires_at": 1, "_id": 0
+    }
+    
     @staticmethod
-    async def create_message(message_data: MessageCreate, sender_id: str, sender_name: str) -> Optional[Message]:
-        """Create a new message"""
+    async def load_message_document(message_id: str) -> Optional[dict]:
+        """Load a raw message document through the request identity map"""
         messages_collection = await get_collection("messages")
+        return await identity_map.load("messages", message_id, lambda: messages_collection.find_one({"id": message_id}))
+    
+    @staticmethod
+    def build_message_document(message_data: MessageCreate, chat: Chat, sender_id: str, sender_name: str) -> dict:
+        """Build the document for a new message in a chat the sender has access to.
         
-        # Verify user has access to chat
-        chat = await ChatService.get_chat_by_id(message_data.chat_id, sender_id)
-        if not chat:
-            return None
-        
-        # Check if it's a scheduled message
-        if message_data.scheduled_for and message_data.scheduled_for > datetime.utcnow():
-            is_scheduled = True
-        else:
-            is_scheduled = False
-        
+        Raises ValueError for a malformed self-destruct timer.
+        """
         message_dict = message_data.dict()
         message_dict["id"] = str(uuid.uuid4())
+        message_dict["chat_id"] = chat.id
         message_dict["sender_id"] = sender_id
         message_dict["sender_name"] = sender_name
         message_dict["timestamp"] = datetime.utcnow()
-        message_dict["is_scheduled"] = is_scheduled
-        message_dict["read_by"] = [sender_id]  # Mark as read by sender
+        message_dict["updated_at"] = message_dict["timestamp"]
+        
+        # Check if it's a scheduled message
+        message_dict["is_scheduled"] = bool(
+            message_data.scheduled_for and message_data.scheduled_for > message_dict["timestamp"]
+        )
+        
+        # Self-destruct timers start when the message becomes visible
+        self_destruct = parse_self_destruct(message_data.self_destruct)
+        if self_destruct:
+            visible_at = message_data.scheduled_for if message_dict["is_scheduled"] else message_dict["timestamp"]
+            message_dict["expires_at"] = visible_at + self_destruct
         
         # Handle bot commands
         if message_data.text and message_data.text.startswith('/') and chat.type == "bot":
             message_dict["is_bot_command"] = True
         
-        await messages_collection.insert_one(message_dict)
+        return message_dict
+    
+    @staticmethod
+    async def insert_messages(message_dicts: List[dict]) -> Dict[int, str]:
+        """Insert many messages with one unordered insert_many.
+        
+        Returns the errors by position in `message_dicts`; positions not in the
+        result were inserted.
+        """
+        if not message_dicts:
+            return {}
+        
+        messages_collection = await get_collection("messages")
+        try:
+            await messages_collection.insert_many(message_dicts, ordered=False)
+            return {}
+        except BulkWriteError as e:
+            return {error["index"]: error.get("errmsg", "Write error") for error in e.details.get("writeErrors", [])}
+    
+    @staticmethod
+    async def create_message(message_data: MessageCreate, sender_id: str, sender_name: str) -> Optional[Message]:
+        """Create a new message (raises ValueError for a malformed self-destruct timer)"""
+        messages_collection = await get_collection("messages")
+        
+        # Verify user has access to chat
+        chat = await ChatService.get_chat_by_id(message_data.chat_id, sender_id)
+        if not chat:
+            return None
+        
+        message_dict = MessageService.build_message_document(message_data, chat, sender_id, sender_name)
+        is_scheduled = message_dict["is_scheduled"]
+        
+        async with chat_sequencer.allocate_messages([message_dict]):
+            await messages_collection.insert_one(message_dict)
+        identity_map.remember("messages", message_dict["id"], message_dict)
         message = Message(**message_dict)
         
         # Update chat's last message (only if not scheduled)
@@ -44,45 +122,302 @@ class MessageService:
                 message_data.text or "Media", 
                 message.timestamp
             )
+            await InboxService.record_message(
+                message_data.chat_id,
+                sender_id,
+                message_data.text or "Media",
+                message.timestamp
+            )
+            search_backend.index_messages([message_dict])
+            realtime_hub.publish_messages("message.created", [message_dict])
+        else:
+            scheduled_dispatcher.notify(message.id, message.scheduled_for)
+        
+        if message.expires_at:
+            message_expiry_sweeper.notify(message.expires_at)
         
         return message
     
     @staticmethod
-    async def get_chat_messages(chat_id: str, user_id: str, limit: int = 50, before_message_id: Optional[str] = None) -> List[Message]:
-        """Get messages from a chat"""
+    async def create_messages(messages: List[MessageCreate], sender_id: str, sender_name: str) -> List[BulkMessageResult]:
+        """Send many messages, possibly to several chats, with one result per message.
+        
+        Access is checked once per distinct chat, the messages are inserted with
+        one insert_many and each chat's last message is updated once. Messages
+        keep their request order: timestamps in a chat are made strictly
+        increasing (BSON dates have millisecond precision).
+        """
+        results = [BulkMessageResult(index=position, chat_id=message_data.chat_id) for position, message_data in enumerate(messages)]
+        chats = await ChatService.get_accessible_chats([message_data.chat_id for message_data in messages], sender_id)
+        
+        positions = []
+        message_dicts = []
+        last_timestamps = {}
+        for position, message_data in enumerate(messages):
+            chat = chats.get(message_data.chat_id)
+            if not chat:
+                results[position].error = "Chat not found or no access"
+                continue
+            try:
+                message_dict = MessageService.build_message_document(message_data, chat, sender_id, sender_name)
+            except ValueError as e:
+                results[position].error = str(e)
+                continue
+            
+            timestamp = message_dict["timestamp"].replace(microsecond=message_dict["timestamp"].microsecond // 1000 * 1000)
+            previous = last_timestamps.get(chat.id)
+            if previous and timestamp <= previous:
+                timestamp = previous + timedelta(milliseconds=1)
+            message_dict["timestamp"] = message_dict["updated_at"] = last_timestamps[chat.id] = timestamp
+            positions.append(position)
+            message_dicts.append(message_dict)
+        
+        async with chat_sequencer.allocate_messages(message_dicts):
+            errors = await MessageService.insert_messages(message_dicts)
+        delivered = []
+        for inserted_position, (position, message_dict) in enumerate(zip(positions, message_dicts)):
+            if inserted_position in errors:
+                results[position].error = "Failed to create message"
+                continue
+            results[position].message_id = message_dict["id"]
+            if message_dict["is_scheduled"]:
+                scheduled_dispatcher.notify(message_dict["id"], message_dict["scheduled_for"])
+            else:
+                delivered.append(message_dict)
+            if message_dict.get("expires_at"):
+                message_expiry_sweeper.notify(message_dict["expires_at"])
+        
+        await ChatService.record_delivered_messages(delivered)
+        search_backend.index_messages(delivered)
+        realtime_hub.publish_messages("message.created", delivered)
+        return results
+    
+    @staticmethod
+    async def get_chat_messages(chat_id: str, user_id: str, limit: int = 50, before: Optional[str] = None, reply_previews: bool = False) -> List[Message]:
+        """Get messages from a chat; `before` is a cursor token or, for older clients, a message ID"""
+        if before and decode_cursor(before, 2) is None:
+            before_message = await MessageService.load_message_document(before)
+            before = encode_cursor(before_message["timestamp"], before_message["id"]) if before_message else None
+        
+        page = await MessageService.get_chat_messages_page(chat_id, user_id, limit, before=before, reply_previews=reply_previews)
+        return page.messages if page else []
+    
+    @staticmethod
+    async def get_chat_messages_page(
+        chat_id: str,
+        user_id: str,
+        limit: int = 50,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        around: Optional[str] = None,
+        reply_previews: bool = False
+    ) -> Optional[MessagePage]:
+        """Get a page of messages from a chat using keyset pagination on (timestamp, id).
+        
+        `before`/`after` are cursor tokens from a previous page; `around` is a message ID
+        to center the page on. With `reply_previews` every reply carries a preview
+        of the message it quotes. Raises ValueError for malformed cursors.
+        """
         # Verify user has access to chat
         chat = await ChatService.get_chat_by_id(chat_id, user_id)
         if not chat:
-            return []
+            return None
         
         messages_collection = await get_collection("messages")
+        limit = max(1, min(limit, 200))
         
-        query = {
+        base_query = {
             "chat_id": chat_id,
             "is_deleted": {"$ne": True},
             "is_scheduled": {"$ne": True}
         }
         
-        # Pagination - get messages before a specific message
-        if before_message_id:
-            before_message = await messages_collection.find_one({"id": before_message_id})
-            if before_message:
-                query["timestamp"] = {"$lt": before_message["timestamp"]}
+        async def fetch(position: Optional[list], direction: int, count: int, inclusive: bool = False) -> List[dict]:
+            query = dict(base_query)
+            if position:
+                query.update(keyset_filter(["timestamp", "id"], position, direction))
+                if inclusive:
+                    query["$or"].append({"timestamp": position[0], "id": position[1]})
+            sort = [("timestamp", direction), ("id", direction)]
+            return await messages_collection.find(query).sort(sort).limit(count).to_list(count)
+        
+        if around:
+            anchor = await MessageService.load_message_document(around)
+            if not anchor or anchor["chat_id"] != chat_id:
+                return MessagePage(messages=[])
+            position = [anchor["timestamp"], anchor["id"]]
+            older_count = limit // 2
+            newer_count = limit - older_count
+            older, newer = await asyncio.gather(
+                fetch(position, -1, older_count + 1),
+                fetch(position, 1, newer_count + 1, inclusive=True)
+            )
+            has_older = len(older) > older_count
+            has_newer = len(newer) > newer_count
+            rows = list(reversed(older[:older_count])) + newer[:newer_count]
+        elif after:
+            position = decode_cursor(after, 2)
+            if position is None:
+                raise ValueError("Invalid cursor")
+            rows = await fetch(position, 1, limit + 1)
+            has_older = True
+            has_newer = len(rows) > limit
+            rows = rows[:limit]
+        else:
+            position = None
+            if before:
+                position = decode_cursor(before, 2)
+                if position is None:
+                    raise ValueError("Invalid cursor")
+            rows = await fetch(position, -1, limit + 1)
+            has_older = len(rows) > limit
+            has_newer = position is not None
+            rows = list(reversed(rows[:limit]))
+        
+        messages = [Message(**message_data) for message_data in rows]
+        if reply_previews:
+            await MessageService.attach_reply_previews(chat_id, messages)
+        
+        # Return in chronological order with cursors for both directions
+        return MessagePage(
+            messages=messages,
+            older_cursor=encode_cursor(messages[0].timestamp, messages[0].id) if messages and has_older else None,
+            newer_cursor=encode_cursor(messages[-1].timestamp, messages[-1].id) if messages and has_newer else None
+        )
+    
+    @staticmethod
+    async def get_chat_updates(chat_id: str, user_id: str, since: Optional[int], limit: int = 100, timeout: float = 0) -> Optional[ChatUpdates]:
+        """Get the messages of a chat changed after sequence number `since`.
+        
+        When nothing changed yet, waits up to `timeout` seconds for a change
+        in this process (or for others' writes to land) before answering.
+        Without `since` only the chat's current sequence number is returned.
+        Returns None without access to the chat.
+        """
+        chat = await ChatService.get_chat_by_id(chat_id, user_id)
+        if not chat:
+            return None
+        if since is None:
+            return ChatUpdates(seq=await chat_sequencer.head(chat_id))
+        
+        limit = max(1, min(limit, MessageService.UPDATES_LIMIT))
+        watcher = chat_sequencer.watch(chat_id)
+        try:
+            updates = await MessageService.load_chat_updates(chat_id, since, limit)
+            if not updates.messages and timeout > 0:
+                try:
+                    await asyncio.wait_for(watcher.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                updates = await MessageService.load_chat_updates(chat_id, since, limit)
+            return updates
+        finally:
+            chat_sequencer.unwatch(chat_id, watcher)
+    
+    @staticmethod
+    async def load_chat_updates(chat_id: str, since: int, limit: int) -> ChatUpdates:
+        """The chat's recorded changes after `since` (stopping below numbers still
+        being written) and the current state of each changed message, in the
+        order of their latest change.
         
-        cursor = messages_collection.find(query).sort("timestamp", -1).limit(limit)
-        messages = []
-        async for message_data in cursor:
-            messages.append(Message(**message_data))
+        Deleted and expired messages are sent as tombstones.
+        """
+        messages_collection = await get_collection("messages")
         
-        # Return in chronological order
-        return list(reversed(messages))
+        changes = await chat_sequencer.changes(chat_id, since, limit + 1)
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        
+        # A message changed several times is sent once, at its latest change
+        latest_changes = {}
+        for change in changes:
+            latest_changes.pop(change["message_id"], None)
+            latest_changes[change["message_id"]] = change["seq"]
+        message_ids = list(latest_changes)
+        rows = await messages_collection.find(
+            {"id": {"$in": message_ids}, "chat_id": chat_id, "is_scheduled": {"$ne": True}}
+        ).to_list(len(message_ids))
+        rows_by_id = {message_data["id"]: message_data for message_data in rows}
+        
+        now = datetime.utcnow()
+        messages = [
+            MessageService.build_tombstone(message_data) if MessageService.is_hidden(message_data, now) else Message(**message_data)
+            for message_data in (rows_by_id.get(message_id) for message_id in message_ids) if message_data
+        ]
+        return ChatUpdates(
+            messages=messages,
+            seq=changes[-1]["seq"] if changes else since,
+            has_more=has_more
+        )
+    
+    @staticmethod
+    def is_hidden(message_data: dict, now: Optional[datetime] = None) -> bool:
+        """Deleted, or self-destructed but not swept yet"""
+        expires_at = message_data.get("expires_at")
+        return bool(message_data.get("is_deleted")) or (expires_at is not None and expires_at <= (now or datetime.utcnow()))
+    
+    @staticmethod
+    def build_tombstone(message_data: dict) -> Message:
+        """A hidden message as the change feeds send it: identity and position only, no content or reactions"""
+        return Message(
+            id=message_data["id"],
+            chat_id=message_data["chat_id"],
+            sender_id=message_data["sender_id"],
+            sender_name=message_data["sender_name"],
+            timestamp=message_data["timestamp"],
+            seq=message_data.get("seq"),
+            is_deleted=True
+        )
+    
+    @staticmethod
+    def build_reply_preview(message_data: dict) -> ReplyPreview:
+        """Reduce a quoted message to its preview (text of deleted or expired messages is dropped)"""
+        hidden = MessageService.is_hidden(message_data)
+        text = message_data.get("text")
+        return ReplyPreview(
+            id=message_data["id"],
+            sender_id=message_data["sender_id"],
+            sender_name=message_data["sender_name"],
+            text=None if hidden or text is None else text[:MessageService.REPLY_PREVIEW_TEXT_LENGTH],
+            message_type=message_data.get("message_type", MessageType.text),
+            is_deleted=bool(hidden)
+        )
+    
+    @staticmethod
+    async def attach_reply_previews(chat_id: str, messages: List[Message]):
+        """Fill `reply_preview` on replies, loading every uncached quoted message with one $in query.
+        
+        Only messages from the same chat are previewed, so a reply never reveals another chat.
+        """
+        reply_ids = {message.reply_to for message in messages if message.reply_to}
+        previews = {}
+        missing = []
+        for reply_id in reply_ids:
+            cached = reply_preview_cache.get(reply_id)
+            if cached is None:
+                missing.append(reply_id)
+            else:
+                previews[reply_id] = cached
+        
+        if missing:
+            messages_collection = await get_collection("messages")
+            cursor = messages_collection.find({"id": {"$in": missing}}, MessageService.REPLY_PREVIEW_PROJECTION)
+            async for message_data in cursor:
+                entry = (message_data["chat_id"], MessageService.build_reply_preview(message_data))
+                previews[message_data["id"]] = entry
+                # Self-destructing messages must disappear on time, so they are never cached
+                if not message_data.get("expires_at"):
+                    reply_preview_cache.set(message_data["id"], entry)
+        
+        for message in messages:
+            entry = previews.get(message.reply_to) if message.reply_to else None
+            if entry and entry[0] == chat_id:
+                message.reply_preview = entry[1]
     
     @staticmethod
     async def get_message_by_id(message_id: str, user_id: str) -> Optional[Message]:
         """Get a specific message by ID"""
-        messages_collection = await get_collection("messages")
-        
-        message_data = await messages_collection.find_one({"id": message_id})
+        message_data = await MessageService.load_message_document(message_id)
         if not message_data:
             return None
         
@@ -97,9 +432,10 @@ class MessageService:
     
     @staticmethod
     async def update_message(message_id: str, message_update: MessageUpdate, user_id: str) -> Optional[Message]:
-        """Update a message (only sender can edit)"""
+        """Update a message (only the sender can edit) and return it in the same write"""
         messages_collection = await get_collection("messages")
         
+        # The sender must still have access to the chat (e.g. not have left the group)
         message = await MessageService.get_message_by_id(message_id, user_id)
         if not message or message.sender_id != user_id:
             return None
@@ -107,19 +443,30 @@ class MessageService:
         update_data = {k: v for k, v in message_update.dict().items() if v is not None}
         update_data["is_edited"] = True
         update_data["edited_at"] = datetime.utcnow()
+        update_data["updated_at"] = update_data["edited_at"]
+        
+        # The filter repeats authorship and skips messages deleted since they were loaded;
+        # the sequence number lands in the same write ($max: a concurrent later change may be first)
+        async with chat_sequencer.allocate({message.chat_id: [message_id]}) as firsts:
+            message_data = await messages_collection.find_one_and_update(
+                {"id": message_id, "sender_id": user_id, "is_deleted": {"$ne": True}},
+                {"$set": update_data, "$max": {"seq": firsts[message.chat_id]}},
+                return_document=ReturnDocument.AFTER
+            )
+        if not message_data:
+            identity_map.discard("messages", message_id)
+            return None
+        identity_map.remember("messages", message_id, message_data)
+        reply_preview_cache.invalidate(message_id)
         
-        await messages_collection.update_one(
-            {"id": message_id},
-            {"$set": update_data}
-        )
-        
-        return await MessageService.get_message_by_id(message_id, user_id)
+        if not message_data.get("is_scheduled"):
+            search_backend.index_messages([message_data])
+            realtime_hub.publish_messages("message.updated", [message_data])
+        return Message(**message_data)
     
     @staticmethod
     async def delete_message(message_id: str, user_id: str) -> bool:
         """Delete a message (sender or chat admin can delete)"""
-        messages_collection = await get_collection("messages")
-        
         message = await MessageService.get_message_by_id(message_id, user_id)
         if not message:
             return False
@@ -131,23 +478,55 @@ class MessageService:
         # Check if user can delete (sender, admin, or owner)
         can_delete = (
             message.sender_id == user_id or 
-            user_id in chat.admins or 
-            chat.owner == user_id
+            chat.owner == user_id or 
+            await MembershipService.is_admin(chat.id, user_id)
         )
         
         if not can_delete:
             return False
         
-        await messages_collection.update_one(
-            {"id": message_id},
-            {"$set": {"is_deleted": True, "updated_at": datetime.utcnow()}}
-        )
-        
+        await MessageService.hide_messages([{"id": message_id, "chat_id": chat.id}])
         return True
     
+    @staticmethod
+    async def hide_messages(message_dicts: List[dict]) -> int:
+        """Soft-delete messages (dicts with `id` and `chat_id`) and tell every reader about it.
+        
+        Shared by deletes and self-destruct expiry: each message gets a new
+        chat sequence number, leaves the caches and the search index, and a
+        `message.deleted` event goes out. Returns how many were hidden.
+        """
+        messages_collection = await get_collection("messages")
+        if not message_dicts:
+            return 0
+        
+        now = datetime.utcnow()
+        message_ids_by_chat: Dict[str, List[str]] = {}
+        for message_dict in message_dicts:
+            message_ids_by_chat.setdefault(message_dict["chat_id"], []).append(message_dict["id"])
+        async with chat_sequencer.allocate(message_ids_by_chat) as firsts:
+            next_seqs = dict(firsts)
+            updates = []
+            for message_dict in message_dicts:
+                updates.append(UpdateOne(
+                    {"id": message_dict["id"]},
+                    {"$set": {"is_deleted": True, "updated_at": now}, "$max": {"seq": next_seqs[message_dict["chat_id"]]}}
+                ))
+                next_seqs[message_dict["chat_id"]] += 1
+            await messages_collection.bulk_write(updates, ordered=False)
+        
+        message_ids = [message_dict["id"] for message_dict in message_dicts]
+        for message_id in message_ids:
+            identity_map.discard("messages", message_id)
+            reply_preview_cache.invalidate(message_id)
+        search_backend.remove_messages(message_ids)
+        for message_dict in message_dicts:
+            realtime_hub.publish(message_dict["chat_id"], "message.deleted", {"message_id": message_dict["id"]})
+        return len(message_dicts)
+    
     @staticmethod
     async def mark_as_read(chat_id: str, user_id: str, message_ids: List[str] = None) -> bool:
-        """Mark messages as read"""
+        """Mark messages as read by advancing the user's read watermark for the chat"""
         messages_collection = await get_collection("messages")
         
         # Verify user has access to chat
@@ -155,90 +534,232 @@ class MessageService:
         if not chat:
             return False
         
-        query = {"chat_id": chat_id}
-        if message_ids:
-            query["id"] = {"$in": message_ids}
+        if not message_ids:
+            # Mark everything as read: one write, no per-message updates
+            await InboxService.mark_read(user_id, chat_id, datetime.utcnow(), caught_up=True)
+            return True
+        
+        # The watermark moves to the newest of the given messages
+        if len(message_ids) == 1:
+            newest = await MessageService.load_message_document(message_ids[0])
+            if newest and newest["chat_id"] != chat_id:
+                newest = None
         else:
-            # Mark all unread messages as read
-            query["read_by"] = {"$ne": user_id}
+            newest = await messages_collection.find_one(
+                {"chat_id": chat_id, "id": {"$in": message_ids}},
+                {"timestamp": 1},
+                sort=[("timestamp", -1)]
+            )
+        if not newest:
+            return True
         
-        await messages_collection.update_many(
-            query,
-            {"$addToSet": {"read_by": user_id}}
-        )
+        entry = await InboxService.mark_read(user_id, chat_id, newest["timestamp"])
+        if not entry:
+            return True
+        
+        # Refresh the user's unread counter for this chat
+        if entry["last_read_at"] >= entry["last_activity"]:
+            unread_count = 0
+        else:
+            unread_count = await InboxService.count_unread(user_id, chat_id, entry["last_read_at"])
+        if unread_count != entry.get("unread_count"):
+            await InboxService.set_unread_count(user_id, chat_id, unread_count)
         
         return True
     
     @staticmethod
-    async def add_reaction(message_id: str, emoji: str, user_id: str) -> Optional[Message]:
-        """Add reaction to a message"""
+    async def mark_many_as_read(reads: Dict[str, str], user_id: str) -> Tuple[List[str], List[Dict[str, str]]]:
+        """Mark chats as read up to a message each (chat ID -> message ID).
+        
+        Access to every chat is checked at once, the messages are loaded with
+        one $in query and the read watermarks are written in one bulk write.
+        Returns the chat IDs marked and the per-chat failures.
+        """
         messages_collection = await get_collection("messages")
         
+        chats = await ChatService.get_accessible_chats(list(reads), user_id)
+        cursor = messages_collection.find(
+            {"id": {"$in": [message_id for chat_id, message_id in reads.items() if chat_id in chats]}},
+            {"id": 1, "chat_id": 1, "timestamp": 1, "_id": 0}
+        )
+        messages = {message_data["id"]: message_data async for message_data in cursor}
+        
+        read_ats = {}
+        failed = []
+        for chat_id, message_id in reads.items():
+            message_data = messages.get(message_id)
+            if chat_id not in chats:
+                failed.append({"chat_id": chat_id, "error": "Chat not found or no access"})
+            elif not message_data or message_data["chat_id"] != chat_id:
+                failed.append({"chat_id": chat_id, "error": "Message not found"})
+            else:
+                read_ats[chat_id] = message_data["timestamp"]
+        
+        await InboxService.mark_read_many(user_id, read_ats)
+        return list(read_ats), failed
+    
+    @staticmethod
+    async def get_read_receipts(message_id: str, user_id: str) -> Optional[MessageReadReceipts]:
+        """Get who has read a message, derived from the members' read watermarks"""
         message = await MessageService.get_message_by_id(message_id, user_id)
         if not message:
             return None
         
-        # Check if user already reacted with this emoji
-        await messages_collection.update_one(
-            {
-                "id": message_id,
-                "reactions.emoji": {"$ne": emoji}
-            },
-            {
-                "$push": {
-                    "reactions": {
-                        "emoji": emoji,
-                        "users": [user_id],
-                        "count": 1
-                    }
-                }
-            }
+        readers = [
+            reader_id for reader_id in await InboxService.get_readers(message.chat_id, message.timestamp)
+            if reader_id != message.sender_id
+        ]
+        
+        # Only show readers whose privacy settings let the viewer see their receipts
+        matrix = await PrivacyService.get_visibility_matrix(readers, [user_id]) if readers else {}
+        visible_readers = [reader_id for reader_id in readers if matrix[reader_id][user_id].read_receipts]
+        
+        return MessageReadReceipts(
+            message_id=message.id,
+            read_by=visible_readers,
+            read_count=len(visible_readers)
         )
+    
+    @staticmethod
+    def validate_reaction(emoji: str):
+        """Raise ValueError for emoji that cannot be a key of `reaction_counts`"""
+        if not emoji or len(emoji) > MessageService.REACTION_MAX_LENGTH or "." in emoji or emoji.startswith("$"):
+            raise ValueError("Invalid reaction")
+    
+    @staticmethod
+    async def convert_legacy_reactions(message_data: dict):
+        """Move a message's embedded reactions[].users into message_reactions rows and counters"""
+        if not message_data.get("reactions"):
+            return
+        
+        reactions_collection = await get_collection("message_reactions")
+        messages_collection = await get_collection("messages")
+        
+        now = datetime.utcnow()
+        rows = [
+            {"message_id": message_data["id"], "chat_id": message_data["chat_id"], "user_id": user_id, "emoji": reaction["emoji"], "created_at": now}
+            for reaction in message_data["reactions"] for user_id in reaction.get("users", [])
+        ]
+        if rows:
+            try:
+                await reactions_collection.insert_many(rows, ordered=False)
+            except BulkWriteError:
+                pass  # Rows another request already converted
         
-        # Update existing reaction
+        counts = {}
+        for row in rows:
+            counts[row["emoji"]] = counts.get(row["emoji"], 0) + 1
         await messages_collection.update_one(
-            {
-                "id": message_id,
-                "reactions.emoji": emoji,
-                "reactions.users": {"$ne": user_id}
-            },
-            {
-                "$push": {"reactions.$.users": user_id},
-                "$inc": {"reactions.$.count": 1}
-            }
+            {"id": message_data["id"], "reactions.0": {"$exists": True}},
+            {"$set": {"reaction_counts": counts, "updated_at": now}, "$unset": {"reactions": ""}}
         )
+        identity_map.discard("messages", message_data["id"])
+    
+    @staticmethod
+    async def add_reaction(message_id: str, emoji: str, user_id: str) -> Optional[Message]:
+        """Add reaction to a message.
         
-        return await MessageService.get_message_by_id(message_id, user_id)
+        The unique (message_id, user_id, emoji) row decides whether this is a new
+        reaction; only then are the message's counts recounted. Raises ValueError
+        for invalid emoji.
+        """
+        MessageService.validate_reaction(emoji)
+        message = await MessageService.get_message_by_id(message_id, user_id)
+        if not message:
+            return None
+        await MessageService.convert_legacy_reactions(await MessageService.load_message_document(message_id))
+        
+        reactions_collection = await get_collection("message_reactions")
+        try:
+            await reactions_collection.insert_one({
+                "message_id": message_id,
+                "chat_id": message.chat_id,
+                "user_id": user_id,
+                "emoji": emoji,
+                "created_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            # Already reacted with this emoji
+            return Message(**await MessageService.load_message_document(message_id))
+        
+        return MessageService.publish_reactions(await MessageService.recount_reactions(message_id, message.chat_id))
     
     @staticmethod
     async def remove_reaction(message_id: str, emoji: str, user_id: str) -> Optional[Message]:
-        """Remove reaction from a message"""
-        messages_collection = await get_collection("messages")
-        
+        """Remove reaction from a message (raises ValueError for invalid emoji)"""
+        MessageService.validate_reaction(emoji)
         message = await MessageService.get_message_by_id(message_id, user_id)
         if not message:
             return None
+        await MessageService.convert_legacy_reactions(await MessageService.load_message_document(message_id))
         
-        # Remove user from reaction
-        await messages_collection.update_one(
-            {
-                "id": message_id,
-                "reactions.emoji": emoji,
-                "reactions.users": user_id
-            },
-            {
-                "$pull": {"reactions.$.users": user_id},
-                "$inc": {"reactions.$.count": -1}
-            }
-        )
+        reactions_collection = await get_collection("message_reactions")
+        result = await reactions_collection.delete_one({"message_id": message_id, "user_id": user_id, "emoji": emoji})
+        if not result.deleted_count:
+            # Had not reacted with this emoji
+            return Message(**await MessageService.load_message_document(message_id))
         
-        # Remove reaction if no users left
-        await messages_collection.update_one(
-            {"id": message_id},
-            {"$pull": {"reactions": {"count": 0}}}
-        )
+        return MessageService.publish_reactions(await MessageService.recount_reactions(message_id, message.chat_id))
+    
+    @staticmethod
+    async def recount_reactions(message_id: str, chat_id: str) -> Optional[dict]:
+        """Store a message's reaction counts as counted from its message_reactions rows.
+        
+        The counts are written only if no recount with a later chat sequence
+        number got there first. That recount started after this one's row
+        write, so its counts include it: whatever the interleaving, the last
+        stored counts match the rows.
+        """
+        reactions_collection = await get_collection("message_reactions")
+        messages_collection = await get_collection("messages")
         
-        return await MessageService.get_message_by_id(message_id, user_id)
+        async with chat_sequencer.allocate({chat_id: [message_id]}) as firsts:
+            seq = firsts[chat_id]
+            counts = {
+                group["_id"]: group["count"]
+                async for group in reactions_collection.aggregate([
+                    {"$match": {"message_id": message_id}},
+                    {"$group": {"_id": "$emoji", "count": {"$sum": 1}}}
+                ])
+            }
+            message_data = await messages_collection.find_one_and_update(
+                {"id": message_id, "$or": [{"reaction_seq": None}, {"reaction_seq": {"$lt": seq}}]},
+                {
+                    "$set": {"reaction_counts": counts, "reaction_seq": seq, "updated_at": datetime.utcnow()},
+                    "$max": {"seq": seq}
+                },
+                return_document=ReturnDocument.AFTER
+            )
+        if message_data is None:
+            # A later recount won; it already holds this change
+            identity_map.discard("messages", message_id)
+            return await MessageService.load_message_document(message_id)
+        identity_map.remember("messages", message_id, message_data)
+        return message_data
+    
+    @staticmethod
+    def publish_reactions(message_data: Optional[dict]) -> Optional[Message]:
+        """Push a message's new reaction counts to its chat and return the message"""
+        if not message_data:
+            return None
+        message = Message(**message_data)
+        realtime_hub.publish(message.chat_id, "message.reactions", {"message_id": message.id, "reactions": message.reactions})
+        return message
+    
+    @staticmethod
+    async def get_my_reactions(message_ids: List[str], user_id: str) -> Dict[str, List[str]]:
+        """Get the user's own reactions (message ID -> emoji) for a page of messages in one query"""
+        reactions_collection = await get_collection("message_reactions")
+        
+        message_ids = list(dict.fromkeys(message_ids))[:MessageService.MY_REACTIONS_LIMIT]
+        my_reactions = {}
+        cursor = reactions_collection.find(
+            {"user_id": user_id, "message_id": {"$in": message_ids}},
+            {"message_id": 1, "emoji": 1, "_id": 0}
+        )
+        async for row in cursor:
+            my_reactions.setdefault(row["message_id"], []).append(row["emoji"])
+        return my_reactions
     
     @staticmethod
     async def forward_message_unlimited(message_id: str, target_chat_ids: List[str], user_id: str, sender_name: str, add_caption: Optional[str] = None) -> dict:
@@ -252,13 +773,42 @@ class MessageService:
                 "total_failed": 1
             }
         
+        successful_forwards, failed_forwards = await MessageService.forward_to_chats(
+            original_message, target_chat_ids, user_id, sender_name, add_caption
+        )
+        
+        return {
+            "successful_forwards": successful_forwards,
+            "failed_forwards": failed_forwards,
+            "total_sent": len(successful_forwards),
+            "total_failed": len(failed_forwards)
+        }
+    
+    @staticmethod
+    async def forward_to_chats(original_message: Message, target_chat_ids: List[str], user_id: str, sender_name: str, add_caption: Optional[str] = None) -> Tuple[List[str], List[Dict[str, str]]]:
+        """Forward a message to a batch of chats.
+        
+        Access is checked for all targets at once, the copies are inserted with a
+        single insert_many and the chats' last-message fields are updated in bulk.
+        Returns the successful chat IDs and the per-chat failures.
+        """
         successful_forwards = []
         failed_forwards = []
         
-        for target_chat_id in target_chat_ids:
-            try:
-                # Check if user has access to target chat
-                target_chat = await ChatService.get_chat_by_id(target_chat_id, user_id)
+        try:
+            # Check which target chats the user has access to
+            target_chats = await ChatService.get_accessible_chats(target_chat_ids, user_id)
+            
+            # Prepare message text
+            message_text = original_message.text
+            if add_caption and add_caption.strip():
+                message_text = f"{add_caption}\n\n--- Mensagem encaminhada ---\n{original_message.text}"
+            
+            # Build every forwarded copy with the forward metadata already set
+            targets = []
+            message_dicts = []
+            for target_chat_id in target_chat_ids:
+                target_chat = target_chats.get(target_chat_id)
                 if not target_chat:
                     failed_forwards.append({
                         "chat_id": target_chat_id,
@@ -266,66 +816,87 @@ class MessageService:
                     })
                     continue
                 
-                # Prepare message text
-                message_text = original_message.text
-                if add_caption and add_caption.strip():
-                    message_text = f"{add_caption}\n\n--- Mensagem encaminhada ---\n{original_message.text}"
-                
-                # Create forwarded message
                 forwarded_data = MessageCreate(
                     chat_id=target_chat_id,
                     text=message_text,
                     message_type=original_message.message_type,
                     media_url=original_message.media_url
                 )
-                
-                message = await MessageService.create_message(forwarded_data, user_id, sender_name)
-                if message:
-                    # Mark as forwarded
-                    messages_collection = await get_collection("messages")
-                    await messages_collection.update_one(
-                        {"id": message.id},
-                        {"$set": {"forwarded_from": original_message.sender_id, "is_forwarded": True}}
-                    )
-                    successful_forwards.append(target_chat_id)
-                else:
+                message_dict = MessageService.build_message_document(forwarded_data, target_chat, user_id, sender_name)
+                message_dict["forwarded_from"] = original_message.sender_id
+                message_dict["is_forwarded"] = True
+                targets.append(target_chat_id)
+                message_dicts.append(message_dict)
+            
+            async with chat_sequencer.allocate_messages(message_dicts):
+                errors = await MessageService.insert_messages(message_dicts)
+            delivered = []
+            for position, target_chat_id in enumerate(targets):
+                if position in errors:
                     failed_forwards.append({
                         "chat_id": target_chat_id,
                         "error": "Failed to create forwarded message"
                     })
-                
-            except Exception as e:
-                failed_forwards.append({
-                    "chat_id": target_chat_id,
-                    "error": str(e)
-                })
+                else:
+                    successful_forwards.append(target_chat_id)
+                    delivered.append(message_dicts[position])
+            
+            await ChatService.record_delivered_messages(delivered)
+            search_backend.index_messages(delivered)
+            realtime_hub.publish_messages("message.created", delivered)
+        
+        except Exception as e:
+            reported = set(successful_forwards) | {failure["chat_id"] for failure in failed_forwards}
+            failed_forwards.extend(
+                {"chat_id": target_chat_id, "error": str(e)}
+                for target_chat_id in target_chat_ids if target_chat_id not in reported
+            )
         
-        return {
-            "successful_forwards": successful_forwards,
-            "failed_forwards": failed_forwards,
-            "total_sent": len(successful_forwards),
-            "total_failed": len(failed_forwards)
-        }
+        return successful_forwards, failed_forwards
     
     @staticmethod
     async def search_messages(query: str, chat_id: Optional[str] = None, user_id: str = None, limit: int = 50) -> List[Message]:
-        """Search messages by text"""
-        messages_collection = await get_collection("messages")
-        
-        search_query = {
-            "$text": {"$search": query},
-            "is_deleted": {"$ne": True}
-        }
-        
+        """Search messages by text (first page of search_messages_page)"""
+        page = await MessageService.search_messages_page(query, user_id, chat_id, limit)
+        return page.messages
+    
+    @staticmethod
+    async def get_search_scope(user_id: str, chat_id: Optional[str] = None) -> List[str]:
+        """Get the chats a search may cover: `chat_id` if the user can access it, otherwise every chat they belong to"""
         if chat_id:
-            # Verify user has access to chat
             chat = await ChatService.get_chat_by_id(chat_id, user_id)
-            if chat:
-                search_query["chat_id"] = chat_id
-        
-        cursor = messages_collection.find(search_query).sort("timestamp", -1).limit(limit)
-        messages = []
-        async for message_data in cursor:
-            messages.append(Message(**message_data))
+            return [chat.id] if chat else []
+        return await MembershipService.get_user_chat_ids(user_id)
+    
+    @staticmethod
+    async def search_messages_page(
+        query: str,
+        user_id: str,
+        chat_id: Optional[str] = None,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        filters: SearchFilters = NO_FILTERS
+    ) -> MessageSearchPage:
+        """Search the messages of chats the user belongs to, most relevant first.
+        
+        The chat scope (see get_search_scope) is part of the query. Pages are
+        ordered by (relevance, timestamp, id) and `cursor` continues after the
+        last result of a previous page. Matching is done by the configured
+        search backend. Raises ValueError for malformed cursors.
+        """
+        limit = max(1, min(limit, 100))
+        
+        chat_ids = await MessageService.get_search_scope(user_id, chat_id)
+        if not chat_ids or not query.strip():
+            return MessageSearchPage(messages=[])
+        
+        return await search_backend.search(query, chat_ids, limit, cursor, filters)
+    
+    @staticmethod
+    async def search_typeahead(prefix: str, user_id: str, limit: int = 10) -> List[str]:
+        """Complete the last word of `prefix` from the user's chats, answered from memory.
         
-        return messages
\ No newline at end of file
+        Only available when search_backend.supports_typeahead.
+        """
+        chat_ids = await MembershipService.get_cached_user_chat_ids(user_id)
+        return search_backend.typeahead(prefix, chat_ids, max(1, min(limit, 50)))
@@ -0,0 +1,207 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from database import get_collection
+from auth import invalidate_cached_user
+from models import UserPresence
+from services.privacy_service import PrivacyService, PrivacyVisibility
+from services.realtime_hub import realtime_hub
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Presence configuration
+# A user without an open WebSocket goes offline this long after their last heartbeat
+PRESENCE_TTL_SECONDS = float(os.getenv("PRESENCE_TTL_SECONDS", "60"))
+# A typing indicator lasts this long unless it is refreshed
+TYPING_TTL_SECONDS = float(os.getenv("TYPING_TTL_SECONDS", "6"))
+# How often last_seen / is_online changes are written to users
+PRESENCE_FLUSH_SECONDS = float(os.getenv("PRESENCE_FLUSH_SECONDS", "5"))
+
+class PresenceStore:
+    """Online state and typing indicators kept in memory with TTL expiry.
+
+    Heartbeats only touch memory. Online/offline transitions are pushed to the
+    WebSocket connections watching the user, filtered by the user's privacy
+    settings in one visibility matrix for all watchers, and the resulting is_online /
+    last_seen values are written to users in one bulk write every
+    PRESENCE_FLUSH_SECONDS (newest last_seen wins). Typing indicators are
+    pushed to the chat when they start and when they expire.
+
+    State is per process; other processes see presence through the flushed
+    users documents.
+    """
+
+    def __init__(self, ttl_seconds: float, typing_ttl_seconds: float, flush_seconds: float):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.typing_ttl = timedelta(seconds=typing_ttl_seconds)
+        self.flush_seconds = flush_seconds
+        # User ID -> time of the last heartbeat (present while online)
+        self._online: Dict[str, datetime] = {}
+        # (chat ID, user ID) -> when the indicator expires
+        self._typing: Dict[Tuple[str, str], datetime] = {}
+        # User ID -> (is_online, last_seen) waiting to be written
+        self._pending: Dict[str, Tuple[bool, datetime]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info("✅ Presence store started")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Everyone this process knew as online goes offline now
+        now = datetime.utcnow()
+        for user_id in list(self._online):
+            self._pending[user_id] = (False, now)
+        self._online.clear()
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"❌ Failed to flush {len(self._pending)} presence updates on shutdown: {e}")
+
+    async def heartbeat(self, user_id: str):
+        """Mark a user online (or keep them online) as of now"""
+        now = datetime.utcnow()
+        was_online = user_id in self._online
+        self._online[user_id] = now
+        if not was_online:
+            self._pending[user_id] = (True, now)
+            await self.publish_presence(user_id, True, now)
+
+    async def went_offline(self, user_id: str):
+        """Mark a user offline right away, e.g. when their last WebSocket closes"""
+        if user_id not in self._online or realtime_hub.is_connected(user_id):
+            return
+        now = datetime.utcnow()
+        del self._online[user_id]
+        self._pending[user_id] = (False, now)
+        await self.publish_presence(user_id, False, now)
+
+    @staticmethod
+    def visible_presence(user_id: str, is_online: bool, last_seen: Optional[datetime], viewer_id: str,
+                         visibility: PrivacyVisibility) -> UserPresence:
+        """Presence with the fields the viewer may not see left out (users always see their own)"""
+        is_self = viewer_id == user_id
+        return UserPresence(
+            user_id=user_id,
+            is_online=is_online if is_self or visibility.online_status else None,
+            last_seen=last_seen if is_self or visibility.last_seen else None
+        )
+
+    async def get_presence(self, user_id: str, viewer_id: str) -> Optional[UserPresence]:
+        """A user's presence as `viewer_id` may see it (None for unknown users)"""
+        presences = await self.get_presences([user_id], viewer_id)
+        return presences[0] if presences else None
+
+    async def get_presences(self, user_ids: Iterable[str], viewer_id: str) -> List[UserPresence]:
+        """Presence of many users as `viewer_id` may see it, skipping unknown users.
+
+        Users offline in this process are read in one query, and privacy is
+        evaluated for all of them in one visibility matrix.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        states = {user_id: (True, self._online[user_id]) for user_id in user_ids if user_id in self._online}
+        offline_ids = [user_id for user_id in user_ids if user_id not in states]
+        if offline_ids:
+            users_collection = await get_collection("users")
+            cursor = users_collection.find({"id": {"$in": offline_ids}}, {"id": 1, "is_online": 1, "last_seen": 1, "_id": 0})
+            async for user_data in cursor:
+                states[user_data["id"]] = (user_data.get("is_online", False), user_data.get("last_seen"))
+        if not states:
+            return []
+
+        matrix = await PrivacyService.get_visibility_matrix(states, [viewer_id])
+        return [
+            self.visible_presence(user_id, *states[user_id], viewer_id, matrix[user_id][viewer_id])
+            for user_id in user_ids if user_id in states
+        ]
+
+    def typing(self, chat_id: str, user_id: str):
+        """Show a typing indicator in a chat for TYPING_TTL_SECONDS (pushed only when it starts)"""
+        key = (chat_id, user_id)
+        is_new = key not in self._typing
+        self._typing[key] = datetime.utcnow() + self.typing_ttl
+        if is_new:
+            realtime_hub.publish(chat_id, "typing", {"user_id": user_id, "is_typing": True})
+
+    def stopped_typing(self, chat_id: str, user_id: str):
+        if self._typing.pop((chat_id, user_id), None) is not None:
+            realtime_hub.publish(chat_id, "typing", {"user_id": user_id, "is_typing": False})
+
+    async def publish_presence(self, user_id: str, is_online: bool, at: datetime):
+        """Push a transition to the user's watchers, each seeing only what the user's privacy settings allow"""
+        watchers = realtime_hub.presence_watchers.get(user_id)
+        if not watchers:
+            return
+
+        watchers = list(watchers)
+        visibility = (await PrivacyService.get_visibility_matrix(
+            [user_id], [watcher.user_id for watcher in watchers]
+        ))[user_id]
+        for watcher in watchers:
+            presence = self.visible_presence(user_id, is_online, at, watcher.user_id, visibility[watcher.user_id])
+            if presence.is_online is not None or presence.last_seen is not None:
+                realtime_hub.send(watcher, "presence", presence.dict())
+
+    async def flush(self):
+        """Write pending is_online / last_seen changes in one bulk write"""
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        users_collection = await get_collection("users")
+        try:
+            await users_collection.bulk_write([
+                UpdateOne({"id": user_id}, {"$set": {"is_online": is_online}, "$max": {"last_seen": last_seen}})
+                for user_id, (is_online, last_seen) in pending.items()
+            ], ordered=False)
+        except BaseException:
+            # Put them back unless a newer change arrived meanwhile
+            for user_id, change in pending.items():
+                self._pending.setdefault(user_id, change)
+            raise
+        for user_id in pending:
+            invalidate_cached_user(user_id)
+
+    async def expire(self):
+        """Take users whose heartbeat lapsed offline and end stale typing indicators"""
+        now = datetime.utcnow()
+        for user_id, last_heartbeat in list(self._online.items()):
+            if realtime_hub.is_connected(user_id):
+                self._online[user_id] = now
+            elif last_heartbeat + self.ttl <= now:
+                del self._online[user_id]
+                self._pending[user_id] = (False, last_heartbeat)
+                await self.publish_presence(user_id, False, last_heartbeat)
+
+        for (chat_id, user_id), expires_at in list(self._typing.items()):
+            if expires_at <= now:
+                self.stopped_typing(chat_id, user_id)
+
+    def stats(self) -> dict:
+        return {"online": len(self._online), "typing": len(self._typing), "pending_writes": len(self._pending)}
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_flush = loop.time() + self.flush_seconds
+        while True:
+            try:
+                await asyncio.sleep(1)
+                await self.expire()
+                if loop.time() >= next_flush:
+                    next_flush = loop.time() + self.flush_seconds
+                    await self.flush()
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Presence store error: {e}")
+                await asyncio.sleep(1)
+
+presence_store = PresenceStore(PRESENCE_TTL_SECONDS, TYPING_TTL_SECONDS, PRESENCE_FLUSH_SECONDS)
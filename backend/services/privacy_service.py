@@ -1,10 +1,55 @@
-from typing import List, Optional
+from typing import Dict, Iterable, List, NamedTuple, Optional
 from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from database import get_collection
 from models import UserPrivacySettings, ContactPrivacySettings, ContactPrivacyUpdate, User
 import uuid
 
+class PrivacyVisibility(NamedTuple):
+    """What one viewer may see of one target user"""
+    read_receipts: bool
+    last_seen: bool
+    online_status: bool
+
 class PrivacyService:
+    @staticmethod
+    def default_privacy_settings(user_id: str) -> dict:
+        """Document for a user who has never changed their privacy settings"""
+        now = datetime.utcnow()
+        return {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "default_show_read_receipts": True,
+            "default_show_last_seen": True, 
+            "default_show_online_status": True,
+            "contact_settings": [],
+            "created_at": now,
+            "updated_at": now
+        }
+    
+    @staticmethod
+    async def upsert_privacy_settings(user_id: str, update: dict, query: Optional[dict] = None) -> dict:
+        """Apply an update to a user's settings document, creating it with defaults first if needed.
+        
+        Returns the document after the update, in the same round trip.
+        """
+        privacy_collection = await get_collection("user_privacy_settings")
+        
+        # Defaults go in $setOnInsert, minus the fields the update itself writes
+        updated_fields = {field.split(".")[0] for operator in update.values() for field in operator}
+        defaults = {
+            field: value for field, value in PrivacyService.default_privacy_settings(user_id).items()
+            if field not in updated_fields
+        }
+        
+        return await privacy_collection.find_one_and_update(
+            {"user_id": user_id, **(query or {})},
+            {**update, "$setOnInsert": defaults},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    
     @staticmethod
     async def get_user_privacy_settings(user_id: str) -> UserPrivacySettings:
         """Get user's privacy settings"""
@@ -12,120 +57,138 @@ class PrivacyService:
         
         privacy_data = await privacy_collection.find_one({"user_id": user_id})
         if not privacy_data:
-            # Create default privacy settings
-            default_settings = {
-                "id": str(uuid.uuid4()),
-                "user_id": user_id,
-                "default_show_read_receipts": True,
-                "default_show_last_seen": True, 
-                "default_show_online_status": True,
-                "contact_settings": [],
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow()
-            }
-            await privacy_collection.insert_one(default_settings)
-            return UserPrivacySettings(**default_settings)
+            # Create default privacy settings (an upsert, so concurrent first reads agree)
+            privacy_data = await PrivacyService.upsert_privacy_settings(user_id, {})
         
         return UserPrivacySettings(**privacy_data)
     
     @staticmethod
     async def update_global_privacy_settings(user_id: str, updates: dict) -> UserPrivacySettings:
         """Update global privacy settings"""
-        privacy_collection = await get_collection("user_privacy_settings")
-        
         update_data = {k: v for k, v in updates.items() if v is not None}
         update_data["updated_at"] = datetime.utcnow()
         
-        await privacy_collection.update_one(
-            {"user_id": user_id},
-            {"$set": update_data}
-        )
-        
-        return await PrivacyService.get_user_privacy_settings(user_id)
+        privacy_data = await PrivacyService.upsert_privacy_settings(user_id, {"$set": update_data})
+        return UserPrivacySettings(**privacy_data)
     
     @staticmethod
     async def update_contact_privacy_settings(user_id: str, contact_update: ContactPrivacyUpdate) -> UserPrivacySettings:
         """Update privacy settings for a specific contact"""
         privacy_collection = await get_collection("user_privacy_settings")
         
-        # Get current settings
-        privacy_settings = await PrivacyService.get_user_privacy_settings(user_id)
-        
-        # Find existing contact settings
-        contact_settings = privacy_settings.contact_settings
-        existing_contact_index = None
-        
-        for i, contact in enumerate(contact_settings):
-            if contact.contact_user_id == contact_update.contact_user_id:
-                existing_contact_index = i
-                break
-        
-        # Prepare update data
         update_data = {k: v for k, v in contact_update.dict().items() if v is not None and k != 'contact_user_id'}
+        now = datetime.utcnow()
         
-        if existing_contact_index is not None:
-            # Update existing contact settings
-            for key, value in update_data.items():
-                contact_settings[existing_contact_index].__dict__[key] = value
-        else:
+        # Update existing contact settings in place
+        privacy_data = await privacy_collection.find_one_and_update(
+            {"user_id": user_id, "contact_settings.contact_user_id": contact_update.contact_user_id},
+            {
+                "$set": {
+                    **{f"contact_settings.$.{key}": value for key, value in update_data.items()},
+                    "updated_at": now
+                }
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        
+        if not privacy_data:
             # Create new contact settings
             new_contact_settings = ContactPrivacySettings(
                 contact_user_id=contact_update.contact_user_id,
                 **update_data
             )
-            contact_settings.append(new_contact_settings)
+            try:
+                privacy_data = await PrivacyService.upsert_privacy_settings(
+                    user_id,
+                    {"$push": {"contact_settings": new_contact_settings.dict()}, "$set": {"updated_at": now}},
+                    {"contact_settings.contact_user_id": {"$ne": contact_update.contact_user_id}}
+                )
+            except DuplicateKeyError:
+                # Another request added this contact first; apply ours on top of it
+                return await PrivacyService.update_contact_privacy_settings(user_id, contact_update)
         
-        # Update in database
-        await privacy_collection.update_one(
-            {"user_id": user_id},
-            {
-                "$set": {
-                    "contact_settings": [setting.dict() for setting in contact_settings],
-                    "updated_at": datetime.utcnow()
-                }
-            }
+        return UserPrivacySettings(**privacy_data)
+    
+    @staticmethod
+    def evaluate_visibility(
+        target_privacy: UserPrivacySettings,
+        overrides: Dict[str, ContactPrivacySettings],
+        viewer_id: str
+    ) -> PrivacyVisibility:
+        """Apply the target's contact override for the viewer, falling back to the global settings"""
+        contact = overrides.get(viewer_id)
+        if contact:
+            return PrivacyVisibility(
+                read_receipts=contact.show_read_receipts_to_contact,
+                last_seen=contact.show_last_seen_to_contact,
+                online_status=contact.show_online_status_to_contact
+            )
+        return PrivacyVisibility(
+            read_receipts=target_privacy.default_show_read_receipts,
+            last_seen=target_privacy.default_show_last_seen,
+            online_status=target_privacy.default_show_online_status
         )
+    
+    @staticmethod
+    async def get_visibility(viewer_id: str, target_id: str) -> PrivacyVisibility:
+        target_privacy = await PrivacyService.get_user_privacy_settings(target_id)
+        overrides = {contact.contact_user_id: contact for contact in target_privacy.contact_settings}
+        return PrivacyService.evaluate_visibility(target_privacy, overrides, viewer_id)
+    
+    @staticmethod
+    async def get_privacy_settings_many(user_ids: Iterable[str]) -> Dict[str, UserPrivacySettings]:
+        """Settings of many users in one query.
         
-        return await PrivacyService.get_user_privacy_settings(user_id)
+        Users who never changed their settings get the defaults without a
+        document being created for them.
+        """
+        privacy_collection = await get_collection("user_privacy_settings")
+        
+        user_ids = list(dict.fromkeys(user_ids))
+        settings = {
+            privacy_data["user_id"]: UserPrivacySettings(**privacy_data)
+            async for privacy_data in privacy_collection.find({"user_id": {"$in": user_ids}})
+        }
+        for user_id in user_ids:
+            if user_id not in settings:
+                settings[user_id] = UserPrivacySettings(**PrivacyService.default_privacy_settings(user_id))
+        return settings
+    
+    @staticmethod
+    async def get_visibility_matrix(
+        target_ids: Iterable[str],
+        viewer_ids: Iterable[str]
+    ) -> Dict[str, Dict[str, PrivacyVisibility]]:
+        """What every viewer may see of every target, as matrix[target_id][viewer_id].
+        
+        One query loads all targets' settings and their contact overrides are
+        indexed by viewer, so a group of N members costs one read and O(N)
+        lookups instead of N reads and N list scans.
+        """
+        viewer_ids = list(dict.fromkeys(viewer_ids))
+        matrix = {}
+        for target_id, target_privacy in (await PrivacyService.get_privacy_settings_many(target_ids)).items():
+            overrides = {contact.contact_user_id: contact for contact in target_privacy.contact_settings}
+            matrix[target_id] = {
+                viewer_id: PrivacyService.evaluate_visibility(target_privacy, overrides, viewer_id)
+                for viewer_id in viewer_ids
+            }
+        return matrix
     
     @staticmethod
     async def can_see_read_receipt(sender_id: str, receiver_id: str) -> bool:
         """Check if sender can see read receipt from receiver"""
-        receiver_privacy = await PrivacyService.get_user_privacy_settings(receiver_id)
-        
-        # Check contact-specific settings
-        for contact in receiver_privacy.contact_settings:
-            if contact.contact_user_id == sender_id:
-                return contact.show_read_receipts_to_contact
-        
-        # Fall back to global settings
-        return receiver_privacy.default_show_read_receipts
+        return (await PrivacyService.get_visibility(sender_id, receiver_id)).read_receipts
     
     @staticmethod
     async def can_see_last_seen(viewer_id: str, target_id: str) -> bool:
         """Check if viewer can see target's last seen"""
-        target_privacy = await PrivacyService.get_user_privacy_settings(target_id)
-        
-        # Check contact-specific settings
-        for contact in target_privacy.contact_settings:
-            if contact.contact_user_id == viewer_id:
-                return contact.show_last_seen_to_contact
-        
-        # Fall back to global settings
-        return target_privacy.default_show_last_seen
+        return (await PrivacyService.get_visibility(viewer_id, target_id)).last_seen
     
     @staticmethod
     async def can_see_online_status(viewer_id: str, target_id: str) -> bool:
         """Check if viewer can see target's online status"""
-        target_privacy = await PrivacyService.get_user_privacy_settings(target_id)
-        
-        # Check contact-specific settings
-        for contact in target_privacy.contact_settings:
-            if contact.contact_user_id == viewer_id:
-                return contact.show_online_status_to_contact
-        
-        # Fall back to global settings
-        return target_privacy.default_show_online_status
+        return (await PrivacyService.get_visibility(viewer_id, target_id)).online_status
     
     @staticmethod
     async def get_contact_privacy_settings(user_id: str, contact_id: str) -> ContactPrivacySettings:
@@ -0,0 +1,181 @@
+from typing import Dict, Iterable, List, Optional, Set
+from fastapi.encoders import jsonable_encoder
+from models import Message
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Realtime configuration
+# Events buffered per connection; a client that falls this far behind is disconnected
+REALTIME_QUEUE_SIZE = int(os.getenv("REALTIME_QUEUE_SIZE", "256"))
+# Chats one connection may follow (its own chats plus explicitly subscribed ones)
+REALTIME_MAX_SUBSCRIPTIONS = int(os.getenv("REALTIME_MAX_SUBSCRIPTIONS", "5000"))
+
+class Subscriber:
+    """One WebSocket connection: the chats it follows and its bounded outgoing queue"""
+
+    def __init__(self, user_id: str, queue_size: int):
+        self.user_id = user_id
+        self.chat_ids: Set[str] = set()
+        self.watched_user_ids: Set[str] = set()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.evicted = asyncio.Event()
+
+    async def next_event(self) -> Optional[str]:
+        """Wait for the next encoded event; None once the subscriber was evicted"""
+        if self.evicted.is_set():
+            return None
+        get = asyncio.ensure_future(self.queue.get())
+        evicted = asyncio.ensure_future(self.evicted.wait())
+        try:
+            await asyncio.wait([get, evicted], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            evicted.cancel()
+            if not get.done():
+                get.cancel()
+        return None if self.evicted.is_set() else get.result()
+
+class RealtimeHub:
+    """In-process fan-out of chat events to WebSocket subscribers.
+
+    Maps chat IDs to the connections following them. publish() encodes an
+    event once and puts it on every follower's bounded queue without
+    awaiting; a connection whose queue is full is evicted (it reconnects and
+    catches up through the history endpoints) so one slow client never holds
+    up the write path or grows memory.
+
+    Subscribers only see events published by this process.
+    """
+
+    def __init__(self, queue_size: int, max_subscriptions: int):
+        self.queue_size = queue_size
+        self.max_subscriptions = max_subscriptions
+        self.subscriptions: Dict[str, Set[Subscriber]] = {}
+        self.subscribers_by_user: Dict[str, Set[Subscriber]] = {}
+        # User ID -> connections watching that user's presence
+        self.presence_watchers: Dict[str, Set[Subscriber]] = {}
+        self.evictions = 0
+
+    def connect(self, user_id: str, chat_ids: Iterable[str]) -> Subscriber:
+        subscriber = Subscriber(user_id, self.queue_size)
+        self.subscribers_by_user.setdefault(user_id, set()).add(subscriber)
+        self.subscribe(subscriber, chat_ids)
+        return subscriber
+
+    def disconnect(self, subscriber: Subscriber):
+        self.unsubscribe(subscriber, list(subscriber.chat_ids))
+        self.unwatch_presence(subscriber, list(subscriber.watched_user_ids))
+        connections = self.subscribers_by_user.get(subscriber.user_id)
+        if connections is not None:
+            connections.discard(subscriber)
+            if not connections:
+                del self.subscribers_by_user[subscriber.user_id]
+
+    def subscribe(self, subscriber: Subscriber, chat_ids: Iterable[str]) -> List[str]:
+        """Follow chats (access must already be checked); returns the chats added"""
+        added = []
+        for chat_id in chat_ids:
+            if len(subscriber.chat_ids) >= self.max_subscriptions:
+                break
+            if chat_id not in subscriber.chat_ids:
+                subscriber.chat_ids.add(chat_id)
+                self.subscriptions.setdefault(chat_id, set()).add(subscriber)
+                added.append(chat_id)
+        return added
+
+    def unsubscribe(self, subscriber: Subscriber, chat_ids: Iterable[str]):
+        for chat_id in chat_ids:
+            subscriber.chat_ids.discard(chat_id)
+            followers = self.subscriptions.get(chat_id)
+            if followers is not None:
+                followers.discard(subscriber)
+                if not followers:
+                    del self.subscriptions[chat_id]
+
+    def watch_presence(self, subscriber: Subscriber, user_ids: Iterable[str]) -> List[str]:
+        """Receive presence events of users (shares the subscription limit); returns the users added"""
+        added = []
+        for user_id in user_ids:
+            if len(subscriber.chat_ids) + len(subscriber.watched_user_ids) >= self.max_subscriptions:
+                break
+            if user_id not in subscriber.watched_user_ids:
+                subscriber.watched_user_ids.add(user_id)
+                self.presence_watchers.setdefault(user_id, set()).add(subscriber)
+                added.append(user_id)
+        return added
+
+    def unwatch_presence(self, subscriber: Subscriber, user_ids: Iterable[str]):
+        for user_id in user_ids:
+            subscriber.watched_user_ids.discard(user_id)
+            watchers = self.presence_watchers.get(user_id)
+            if watchers is not None:
+                watchers.discard(subscriber)
+                if not watchers:
+                    del self.presence_watchers[user_id]
+
+    def is_connected(self, user_id: str) -> bool:
+        return user_id in self.subscribers_by_user
+
+    def add_member(self, chat_id: str, user_id: str):
+        """Start following a chat on every connection of a user who just joined it"""
+        for subscriber in list(self.subscribers_by_user.get(user_id, ())):
+            self.subscribe(subscriber, [chat_id])
+
+    def remove_member(self, chat_id: str, user_id: str):
+        """Stop a user who lost access to a chat from receiving its events"""
+        for subscriber in list(self.subscribers_by_user.get(user_id, ())):
+            self.unsubscribe(subscriber, [chat_id])
+
+    def remove_chat(self, chat_id: str):
+        for subscriber in list(self.subscriptions.get(chat_id, ())):
+            self.unsubscribe(subscriber, [chat_id])
+
+    def evict(self, subscriber: Subscriber):
+        self.disconnect(subscriber)
+        subscriber.evicted.set()
+        self.evictions += 1
+        logger.info(f"⚠️ Evicted slow realtime subscriber of user {subscriber.user_id}")
+
+    def close_all(self):
+        for connections in list(self.subscribers_by_user.values()):
+            for subscriber in list(connections):
+                self.disconnect(subscriber)
+                subscriber.evicted.set()
+
+    def publish(self, chat_id: str, event_type: str, data: dict):
+        """Queue an event for every connection following `chat_id` (never blocks)"""
+        followers = self.subscriptions.get(chat_id)
+        if not followers:
+            return
+
+        encoded = json.dumps({"type": event_type, "chat_id": chat_id, "data": jsonable_encoder(data)})
+        for subscriber in list(followers):
+            self._enqueue(subscriber, encoded)
+
+    def send(self, subscriber: Subscriber, event_type: str, data: dict):
+        """Queue a reply for one connection, behind the events already queued for it"""
+        self._enqueue(subscriber, json.dumps({"type": event_type, "data": jsonable_encoder(data)}))
+
+    def _enqueue(self, subscriber: Subscriber, encoded: str):
+        try:
+            subscriber.queue.put_nowait(encoded)
+        except asyncio.QueueFull:
+            self.evict(subscriber)
+
+    def publish_messages(self, event_type: str, messages: Iterable[dict]):
+        """Publish raw message documents (or their post-images) to their chats"""
+        for message_data in messages:
+            if message_data["chat_id"] in self.subscriptions:
+                self.publish(message_data["chat_id"], event_type, {"message": Message(**message_data)})
+
+    def stats(self) -> dict:
+        return {
+            "connections": sum(len(connections) for connections in self.subscribers_by_user.values()),
+            "chats": len(self.subscriptions),
+            "evictions": self.evictions
+        }
+
+realtime_hub = RealtimeHub(REALTIME_QUEUE_SIZE, REALTIME_MAX_SUBSCRIPTIONS)
@@ -0,0 +1,163 @@
+from typing import List, Optional, Set, Tuple
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from database import get_collection
+from services.chat_service import ChatService
+from services.search_backend import search_backend
+from services.realtime_hub import realtime_hub
+from services.chat_sequencer import chat_sequencer
+import identity_map
+import asyncio
+import heapq
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Scheduled delivery configuration
+SCHEDULER_WINDOW_SECONDS = float(os.getenv("SCHEDULER_WINDOW_SECONDS", "60"))
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", "30"))
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "500"))
+
+class ScheduledMessageDispatcher:
+    """Delivers scheduled messages when their `scheduled_for` time comes.
+
+    Upcoming sends are loaded one window at a time from the
+    (is_scheduled, scheduled_for) index into an in-memory heap; the loop then
+    sleeps until the next send is due, the window ends, or a new scheduled
+    message wakes it up. Several processes can run a dispatcher at once: a
+    message is only delivered by the process holding its lease, and a lease
+    left by a dead process expires after SCHEDULER_LEASE_SECONDS.
+    """
+
+    def __init__(self, window_seconds: float, lease_seconds: float, batch_size: int):
+        self.window = timedelta(seconds=window_seconds)
+        self.lease = timedelta(seconds=lease_seconds)
+        self.batch_size = batch_size
+        self.owner = str(uuid.uuid4())
+        self._heap: List[Tuple[datetime, str]] = []
+        self._queued: Set[str] = set()
+        self._window_end: Optional[datetime] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._window_end = None
+        self._task = asyncio.create_task(self._run())
+        logger.info("✅ Scheduled message dispatcher started")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self, message_id: str, scheduled_for: datetime):
+        """Tell the dispatcher about a message scheduled in this process"""
+        if self._wakeup is None or self._window_end is None or scheduled_for > self._window_end:
+            # Picked up when its window is loaded
+            return
+        self._push(scheduled_for, message_id)
+        self._wakeup.set()
+
+    def _push(self, scheduled_for: datetime, message_id: str):
+        if message_id not in self._queued:
+            self._queued.add(message_id)
+            heapq.heappush(self._heap, (scheduled_for, message_id))
+
+    async def _load_window(self, now: datetime):
+        """Load every undelivered message due before the end of the next window"""
+        messages_collection = await get_collection("messages")
+
+        self._window_end = now + self.window
+        cursor = messages_collection.find(
+            {"is_scheduled": True, "scheduled_for": {"$lte": self._window_end}},
+            {"id": 1, "scheduled_for": 1, "_id": 0}
+        ).sort("scheduled_for", 1)
+        async for message_data in cursor:
+            self._push(message_data["scheduled_for"], message_data["id"])
+
+    async def _run(self):
+        while True:
+            try:
+                now = datetime.utcnow()
+                if self._window_end is None or now >= self._window_end:
+                    await self._load_window(now)
+
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                    _, message_id = heapq.heappop(self._heap)
+                    self._queued.discard(message_id)
+                    due.append(message_id)
+                if due:
+                    await self.deliver(due)
+                    continue
+
+                next_wakeup = self._window_end
+                if self._heap and self._heap[0][0] < next_wakeup:
+                    next_wakeup = self._heap[0][0]
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max((next_wakeup - now).total_seconds(), 0.01))
+                except asyncio.TimeoutError:
+                    pass
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Scheduled message dispatcher error: {e}")
+                await asyncio.sleep(1)
+
+    async def deliver(self, message_ids: List[str]) -> int:
+        """Claim a batch of due messages under a lease, make them visible and update their chats.
+
+        Returns how many messages this dispatcher delivered.
+        """
+        messages_collection = await get_collection("messages")
+
+        now = datetime.utcnow()
+        await messages_collection.update_many(
+            {
+                "id": {"$in": message_ids},
+                "is_scheduled": True,
+                "$or": [{"dispatch_lease_until": None}, {"dispatch_lease_until": {"$lt": now}}]
+            },
+            {"$set": {"dispatch_owner": self.owner, "dispatch_lease_until": now + self.lease}}
+        )
+        claimed = await messages_collection.find(
+            {"id": {"$in": message_ids}, "is_scheduled": True, "dispatch_owner": self.owner}
+        ).to_list(len(message_ids))
+        if not claimed:
+            return 0
+
+        # Delivered messages take their place in history at the scheduled time
+        for message_data in claimed:
+            message_data["is_scheduled"] = False
+            message_data["timestamp"] = message_data["scheduled_for"]
+            message_data["updated_at"] = now
+        async with chat_sequencer.allocate_messages(claimed):
+            # Only while the lease still holds: past it another dispatcher may have claimed and delivered the row
+            leased = {"dispatch_owner": self.owner, "dispatch_lease_until": {"$gt": datetime.utcnow()}}
+            written = await asyncio.gather(*[
+                messages_collection.find_one_and_update(
+                    {"id": message_data["id"], **leased},
+                    {
+                        "$set": {"is_scheduled": False, "timestamp": message_data["timestamp"], "updated_at": now, "seq": message_data["seq"]},
+                        "$unset": {"dispatch_owner": "", "dispatch_lease_until": ""}
+                    },
+                    return_document=ReturnDocument.AFTER
+                )
+                for message_data in claimed
+            ])
+        for message_data in claimed:
+            identity_map.discard("messages", message_data["id"])
+
+        delivered = [message_data for message_data in written if message_data and not message_data.get("is_deleted")]
+        await ChatService.record_delivered_messages(delivered)
+        search_backend.index_messages(delivered)
+        realtime_hub.publish_messages("message.created", delivered)
+        return len(delivered)
+
+scheduled_dispatcher = ScheduledMessageDispatcher(SCHEDULER_WINDOW_SECONDS, SCHEDULER_LEASE_SECONDS, SCHEDULER_BATCH_SIZE)
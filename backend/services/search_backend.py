@@ -0,0 +1,504 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from pathlib import Path
+from pymongo.errors import ExecutionTimeout
+from database import get_collection
+from models import Message, MessageSearchPage
+from pagination import encode_cursor, decode_cursor, keyset_filter
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import tempfile
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# Search configuration
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "mongo")  # "mongo" ($text index) or "inverted" (in-process index)
+# Time budget of a single Mongo search query
+SEARCH_MAX_TIME_MS = int(os.getenv("SEARCH_MAX_TIME_MS", "2000"))
+SEARCH_SNAPSHOT_PATH = os.getenv("SEARCH_SNAPSHOT_PATH", str(Path(__file__).resolve().parent.parent / "search_index.json.gz"))
+SEARCH_SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("SEARCH_SNAPSHOT_INTERVAL_SECONDS", "300"))
+# How often the inverted index picks up messages written by other processes
+SEARCH_SYNC_INTERVAL_SECONDS = float(os.getenv("SEARCH_SYNC_INTERVAL_SECONDS", "5"))
+# Catch-up queries look back this far to cover clock skew and in-flight writes
+SEARCH_SYNC_OVERLAP = timedelta(seconds=5)
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+_EPOCH = datetime(1970, 1, 1)
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents, so "Conversa" and "convérsa" compare equal"""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def folded_name_fields(document: dict) -> dict:
+    """Folded copies of a chat's or user's name fields, which name prefix search matches.
+
+    A case-sensitive anchored $regex on these is a bounded index scan; a
+    case-insensitive one on the original fields is not.
+    """
+    return {f"{field}_folded": fold(document[field]) for field in ("name", "username") if document.get(field)}
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Split text into folded word tokens"""
+    return _TOKEN_PATTERN.findall(fold(text)) if text else []
+
+def _to_seconds(value: Optional[datetime]) -> Optional[float]:
+    return (value - _EPOCH).total_seconds() if value else None
+
+class SearchFilters(NamedTuple):
+    """Optional message filters applied together with the text match"""
+    message_type: Optional[str] = None
+    date_from: Optional[datetime] = None
+    date_to: Optional[datetime] = None
+
+    def to_query(self) -> dict:
+        """Mongo conditions for these filters"""
+        query = {}
+        if self.message_type:
+            query["message_type"] = self.message_type
+        if self.date_from or self.date_to:
+            query["timestamp"] = {}
+            if self.date_from:
+                query["timestamp"]["$gte"] = self.date_from
+            if self.date_to:
+                query["timestamp"]["$lte"] = self.date_to
+        return query
+
+    def matches(self, message_type: Optional[str], timestamp: float) -> bool:
+        """Check an indexed message (timestamp in epoch seconds) against these filters"""
+        if self.message_type and message_type != self.message_type:
+            return False
+        if self.date_from and timestamp < _to_seconds(self.date_from):
+            return False
+        if self.date_to and timestamp > _to_seconds(self.date_to):
+            return False
+        return True
+
+NO_FILTERS = SearchFilters()
+
+class SearchBackend(ABC):
+    """Message search engine behind MessageService.search_messages_page.
+
+    The caller resolves which chats the user may search; backends only see
+    those chat IDs. The write paths report new, edited and deleted messages
+    through index_messages/remove_messages, which backends that read Mongo
+    directly can ignore. Backends with `supports_typeahead` also implement
+    typeahead(); the typeahead endpoint only exists for them.
+    """
+
+    supports_typeahead = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def search(self, query: str, chat_ids: List[str], limit: int, cursor: Optional[str] = None, filters: SearchFilters = NO_FILTERS) -> MessageSearchPage:
+        """Get one page of results, most relevant first; raises ValueError for malformed cursors"""
+
+    @abstractmethod
+    async def count(self, query: str, chat_ids: List[str], limit: int, filters: SearchFilters = NO_FILTERS) -> int:
+        """Count matching messages, stopping at `limit`"""
+
+    def index_messages(self, message_dicts: Iterable[dict]):
+        pass
+
+    def remove_messages(self, message_ids: Iterable[str]):
+        pass
+
+class MongoSearchBackend(SearchBackend):
+    """Whole-word search on the messages $text index"""
+
+    @staticmethod
+    def _match(query: str, chat_ids: List[str], filters: SearchFilters) -> dict:
+        return {
+            "$text": {"$search": query},
+            "chat_id": {"$in": chat_ids},
+            "is_deleted": {"$ne": True},
+            "is_scheduled": {"$ne": True},
+            **filters.to_query()
+        }
+
+    async def search(self, query: str, chat_ids: List[str], limit: int, cursor: Optional[str] = None, filters: SearchFilters = NO_FILTERS) -> MessageSearchPage:
+        messages_collection = await get_collection("messages")
+
+        pipeline = [
+            {"$match": self._match(query, chat_ids, filters)},
+            {"$addFields": {"score": {"$meta": "textScore"}}}
+        ]
+        if cursor:
+            position = decode_cursor(cursor, 3)
+            if position is None:
+                raise ValueError("Invalid cursor")
+            pipeline.append({"$match": keyset_filter(["score", "timestamp", "id"], position, -1)})
+        pipeline.extend([
+            {"$sort": {"score": -1, "timestamp": -1, "id": -1}},
+            {"$limit": limit + 1}
+        ])
+
+        try:
+            rows = await messages_collection.aggregate(pipeline, maxTimeMS=SEARCH_MAX_TIME_MS).to_list(limit + 1)
+        except ExecutionTimeout:
+            return MessageSearchPage(messages=[], timed_out=True)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["score"], rows[-1]["timestamp"], rows[-1]["id"])
+
+        return MessageSearchPage(
+            messages=[Message(**message_data) for message_data in rows],
+            next_cursor=next_cursor
+        )
+
+    async def count(self, query: str, chat_ids: List[str], limit: int, filters: SearchFilters = NO_FILTERS) -> int:
+        messages_collection = await get_collection("messages")
+        return await messages_collection.count_documents(
+            self._match(query, chat_ids, filters), limit=limit, maxTimeMS=SEARCH_MAX_TIME_MS
+        )
+
+class InvertedIndex:
+    """Compact in-memory inverted index over message text.
+
+    Words are folded (lowercase, no accents). Each word has postings grouped
+    by chat (word -> chat_id -> message IDs), so a lookup only touches the
+    chats being searched. Edge n-grams map every prefix of a word of
+    MIN_GRAM..MAX_GRAM characters to the words that start with it, which makes
+    prefix matching a dictionary lookup.
+    """
+
+    MIN_GRAM = 2
+    MAX_GRAM = 12
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self):
+        # message_id -> (chat_id, timestamp, expires_at, message_type, words); times are epoch seconds
+        self.documents: Dict[str, Tuple[str, float, Optional[float], Optional[str], Tuple[str, ...]]] = {}
+        self.postings: Dict[str, Dict[str, Set[str]]] = {}
+        self.grams: Dict[str, Set[str]] = {}
+        # Folded word -> a spelling seen in a message, used for suggestions
+        self.spellings: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def add(self, message_id: str, chat_id: str, text: Optional[str], timestamp: float, expires_at: Optional[float] = None, message_type: Optional[str] = None):
+        """Index a message, replacing a previous version of it"""
+        self.remove(message_id)
+        words = {}
+        for token in _TOKEN_PATTERN.findall(text or ""):
+            words.setdefault(fold(token), token.lower())
+        if not words:
+            return
+
+        self.documents[message_id] = (chat_id, timestamp, expires_at, message_type, tuple(words))
+        for word, spelling in words.items():
+            chats = self.postings.get(word)
+            if chats is None:
+                chats = self.postings[word] = {}
+                self.spellings[word] = spelling
+                for length in range(self.MIN_GRAM, min(len(word), self.MAX_GRAM) + 1):
+                    self.grams.setdefault(word[:length], set()).add(word)
+            chats.setdefault(chat_id, set()).add(message_id)
+
+    def remove(self, message_id: str):
+        document = self.documents.pop(message_id, None)
+        if document is None:
+            return
+
+        chat_id, _, _, _, words = document
+        for word in words:
+            chats = self.postings[word]
+            message_ids = chats[chat_id]
+            message_ids.discard(message_id)
+            if message_ids:
+                continue
+            del chats[chat_id]
+            if chats:
+                continue
+            del self.postings[word]
+            del self.spellings[word]
+            for length in range(self.MIN_GRAM, min(len(word), self.MAX_GRAM) + 1):
+                gram = word[:length]
+                self.grams[gram].discard(word)
+                if not self.grams[gram]:
+                    del self.grams[gram]
+
+    def words_with_prefix(self, prefix: str) -> Set[str]:
+        """Get the indexed words starting with a folded prefix"""
+        if len(prefix) < self.MIN_GRAM:
+            return {prefix} if prefix in self.postings else set()
+        if len(prefix) <= self.MAX_GRAM:
+            return self.grams.get(prefix, set())
+        return {word for word in self.grams.get(prefix[:self.MAX_GRAM], ()) if word.startswith(prefix)}
+
+    def _postings_in(self, word: str, chat_ids: Set[str]) -> Iterable[Set[str]]:
+        chats = self.postings[word]
+        if len(chats) < len(chat_ids):
+            return (message_ids for chat_id, message_ids in chats.items() if chat_id in chat_ids)
+        return (chats[chat_id] for chat_id in chat_ids if chat_id in chats)
+
+    def search(self, query: str, chat_ids: Iterable[str], now: float, filters: SearchFilters = NO_FILTERS) -> List[Tuple[float, float, str]]:
+        """Get (score, timestamp, message_id) of messages matching every query word as a prefix, best first.
+
+        A word matched exactly scores 1 and a longer word scores the fraction of
+        it the prefix covers; scores add up across query words.
+        """
+        chat_ids = set(chat_ids)
+        scores: Optional[Dict[str, float]] = None
+        for token in dict.fromkeys(tokenize(query)):
+            token_scores: Dict[str, float] = {}
+            for word in self.words_with_prefix(token):
+                weight = len(token) / len(word)
+                for message_ids in self._postings_in(word, chat_ids):
+                    for message_id in message_ids:
+                        if token_scores.get(message_id, 0) < weight:
+                            token_scores[message_id] = weight
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {message_id: score + token_scores[message_id] for message_id, score in scores.items() if message_id in token_scores}
+            if not scores:
+                return []
+
+        results = []
+        for message_id, score in (scores or {}).items():
+            _, timestamp, expires_at, message_type, _ = self.documents[message_id]
+            if (expires_at is None or expires_at > now) and filters.matches(message_type, timestamp):
+                results.append((round(score, 6), timestamp, message_id))
+        results.sort(reverse=True)
+        return results
+
+    def typeahead(self, prefix: str, chat_ids: Iterable[str], limit: int) -> List[str]:
+        """Suggest indexed words starting with `prefix`, most frequent in the given chats first"""
+        tokens = tokenize(prefix)
+        if not tokens or len(tokens[-1]) < self.MIN_GRAM:
+            return []
+
+        chat_ids = set(chat_ids)
+        counts = []
+        for word in self.words_with_prefix(tokens[-1]):
+            count = sum(len(message_ids) for message_ids in self._postings_in(word, chat_ids))
+            if count:
+                counts.append((-count, word))
+        counts.sort()
+        return [self.spellings[word] for _, word in counts[:limit]]
+
+    def dump(self) -> dict:
+        return {
+            "version": self.SNAPSHOT_VERSION,
+            "documents": [
+                [message_id, chat_id, timestamp, expires_at, message_type, " ".join(words)]
+                for message_id, (chat_id, timestamp, expires_at, message_type, words) in self.documents.items()
+            ]
+        }
+
+    def load(self, snapshot: dict):
+        """Rebuild the index from a dump() (spellings fall back to the folded words)"""
+        if snapshot.get("version") != self.SNAPSHOT_VERSION:
+            raise ValueError("Unsupported search snapshot version")
+        for message_id, chat_id, timestamp, expires_at, message_type, words in snapshot["documents"]:
+            self.add(message_id, chat_id, words, timestamp, expires_at, message_type)
+
+class InvertedIndexSearchBackend(SearchBackend):
+    """Prefix and accent-insensitive search on an in-process InvertedIndex.
+
+    The index is fed directly by this process's write paths and catches up on
+    other processes' writes every SEARCH_SYNC_INTERVAL_SECONDS through the
+    messages `updated_at` index. It is saved to SEARCH_SNAPSHOT_PATH
+    periodically and on shutdown; on start the snapshot is loaded and only
+    messages changed since it was taken are read back. Until the index is
+    ready, searches go to Mongo and typeahead has no suggestions.
+    """
+
+    supports_typeahead = True
+
+    def __init__(self, snapshot_path: str, snapshot_interval: float, sync_interval: float):
+        self.snapshot_path = Path(snapshot_path)
+        self.snapshot_interval = snapshot_interval
+        self.sync_interval = sync_interval
+        self.index = InvertedIndex()
+        self.ready = False
+        self.fallback = MongoSearchBackend()
+        self._synced_until: Optional[datetime] = None
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.ready and self._dirty:
+            await self.save_snapshot()
+
+    def index_messages(self, message_dicts: Iterable[dict]):
+        for message_data in message_dicts:
+            if message_data.get("is_deleted") or message_data.get("is_scheduled"):
+                self.index.remove(message_data["id"])
+            else:
+                self.index.add(
+                    message_data["id"],
+                    message_data["chat_id"],
+                    message_data.get("text"),
+                    _to_seconds(message_data["timestamp"]),
+                    _to_seconds(message_data.get("expires_at")),
+                    getattr(message_data.get("message_type"), "value", message_data.get("message_type"))
+                )
+            self._dirty = True
+
+    def remove_messages(self, message_ids: Iterable[str]):
+        for message_id in message_ids:
+            self.index.remove(message_id)
+            self._dirty = True
+
+    async def search(self, query: str, chat_ids: List[str], limit: int, cursor: Optional[str] = None, filters: SearchFilters = NO_FILTERS) -> MessageSearchPage:
+        if not self.ready:
+            return await self.fallback.search(query, chat_ids, limit, cursor, filters)
+
+        results = self.index.search(query, chat_ids, _to_seconds(datetime.utcnow()), filters)
+        if cursor:
+            position = decode_cursor(cursor, 3)
+            if position is None:
+                raise ValueError("Invalid cursor")
+            position = tuple(position)
+            results = [result for result in results if result < position]
+
+        page = results[:limit]
+        next_cursor = encode_cursor(*page[-1]) if len(results) > limit else None
+
+        messages_collection = await get_collection("messages")
+        message_ids = [message_id for _, _, message_id in page]
+        rows = await messages_collection.find({"id": {"$in": message_ids}}).to_list(len(message_ids))
+        by_id = {message_data["id"]: message_data for message_data in rows}
+
+        messages = []
+        for message_id in message_ids:
+            message_data = by_id.get(message_id)
+            if message_data is None or message_data.get("is_deleted") or message_data.get("is_scheduled"):
+                # Changed by another process since the last sync
+                self.index.remove(message_id)
+                continue
+            messages.append(Message(**message_data))
+
+        return MessageSearchPage(messages=messages, next_cursor=next_cursor)
+
+    async def count(self, query: str, chat_ids: List[str], limit: int, filters: SearchFilters = NO_FILTERS) -> int:
+        if not self.ready:
+            return await self.fallback.count(query, chat_ids, limit, filters)
+        return min(len(self.index.search(query, chat_ids, _to_seconds(datetime.utcnow()), filters)), limit)
+
+    def typeahead(self, prefix: str, chat_ids: List[str], limit: int) -> List[str]:
+        """Suggest words starting with `prefix` that occur in the given chats"""
+        return self.index.typeahead(prefix, chat_ids, limit) if self.ready else []
+
+    async def _run(self):
+        try:
+            loaded = await asyncio.to_thread(self._read_snapshot)
+            if loaded:
+                self._synced_until, snapshot = loaded
+                self.index.load(snapshot)
+                await self.sync()
+                logger.info(f"✅ Search index loaded from snapshot with {len(self.index)} messages")
+            else:
+                await self.rebuild()
+                await self.save_snapshot()
+                logger.info(f"✅ Search index built with {len(self.index)} messages")
+            self.ready = True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Could not build search index, using Mongo search: {e}")
+            return
+
+        last_snapshot = datetime.utcnow()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+                if self._dirty and (datetime.utcnow() - last_snapshot).total_seconds() >= self.snapshot_interval:
+                    await self.save_snapshot()
+                    last_snapshot = datetime.utcnow()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Search index sync error: {e}")
+
+    async def rebuild(self):
+        """Index every visible message from scratch"""
+        messages_collection = await get_collection("messages")
+
+        started = datetime.utcnow()
+        self.index = InvertedIndex()
+        cursor = messages_collection.find(
+            {"is_deleted": {"$ne": True}, "is_scheduled": {"$ne": True}, "text": {"$ne": None}},
+            {"id": 1, "chat_id": 1, "text": 1, "timestamp": 1, "expires_at": 1, "message_type": 1, "_id": 0}
+        )
+        async for message_data in cursor:
+            self.index_messages([message_data])
+        self._synced_until = started
+
+    async def sync(self):
+        """Apply messages created, edited or deleted since the last sync"""
+        messages_collection = await get_collection("messages")
+
+        started = datetime.utcnow()
+        cursor = messages_collection.find(
+            {"updated_at": {"$gte": self._synced_until - SEARCH_SYNC_OVERLAP}},
+            {"id": 1, "chat_id": 1, "text": 1, "timestamp": 1, "expires_at": 1, "message_type": 1, "is_deleted": 1, "is_scheduled": 1, "_id": 0}
+        ).sort("updated_at", 1)
+        async for message_data in cursor:
+            self.index_messages([message_data])
+        self._synced_until = started
+
+    async def save_snapshot(self):
+        snapshot = self.index.dump()
+        snapshot["synced_until"] = self._synced_until.isoformat()
+        self._dirty = False
+        await asyncio.to_thread(self._write_snapshot, snapshot)
+
+    def _read_snapshot(self) -> Optional[Tuple[datetime, dict]]:
+        if not self.snapshot_path.exists():
+            return None
+        try:
+            with gzip.open(self.snapshot_path, "rt", encoding="utf-8") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if snapshot.get("version") != InvertedIndex.SNAPSHOT_VERSION:
+                raise ValueError(f"version {snapshot.get('version')} is not {InvertedIndex.SNAPSHOT_VERSION}")
+            return datetime.fromisoformat(snapshot["synced_until"]), snapshot
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Ignoring unreadable search snapshot {self.snapshot_path}: {e}")
+            return None
+
+    def _write_snapshot(self, snapshot: dict):
+        # A temporary file of its own, so workers sharing the snapshot path never write into each other's
+        temporary_file = tempfile.NamedTemporaryFile(
+            dir=self.snapshot_path.parent, prefix=f"{self.snapshot_path.name}.", suffix=".tmp", delete=False
+        )
+        try:
+            with temporary_file, gzip.open(temporary_file, "wt", encoding="utf-8") as snapshot_file:
+                json.dump(snapshot, snapshot_file, separators=(",", ":"))
+            os.replace(temporary_file.name, self.snapshot_path)
+        except BaseException:
+            os.unlink(temporary_file.name)
+            raise
+
+def create_search_backend(name: str) -> SearchBackend:
+    if name == "inverted":
+        return InvertedIndexSearchBackend(SEARCH_SNAPSHOT_PATH, SEARCH_SNAPSHOT_INTERVAL_SECONDS, SEARCH_SYNC_INTERVAL_SECONDS)
+    if name != "mongo":
+        logger.warning(f"⚠️ Unknown SEARCH_BACKEND '{name}', using mongo")
+    return MongoSearchBackend()
+
+search_backend = create_search_backend(SEARCH_BACKEND)
@@ -0,0 +1,134 @@
+from typing import List, Tuple
+from pymongo import UpdateOne
+from database import get_collection
+from models import Chat, Message, SearchRequest, SearchResult, User
+from services.chat_service import ChatService
+from services.message_service import MessageService
+from services.search_backend import SEARCH_MAX_TIME_MS, SearchFilters, fold, folded_name_fields, search_backend
+import asyncio
+import os
+import re
+
+# Counts stop here; SearchResult.total_is_capped tells clients the total is a lower bound
+SEARCH_COUNT_LIMIT = int(os.getenv("SEARCH_COUNT_LIMIT", "1000"))
+
+class SearchService:
+    """Unified search over messages, chat names and users"""
+
+    @staticmethod
+    async def search(search_request: SearchRequest, user_id: str) -> SearchResult:
+        """Run the message, chat and user searches concurrently and merge them.
+
+        Message filters (chat_id, message_type, date range) narrow the search
+        to messages, so chats and users are only searched without them. Each
+        part's total is counted up to SEARCH_COUNT_LIMIT.
+        """
+        limit = max(1, min(search_request.limit, 100))
+        query = search_request.query.strip()
+        filters = SearchFilters(
+            message_type=search_request.message_type.value if search_request.message_type else None,
+            date_from=search_request.date_from,
+            date_to=search_request.date_to
+        )
+        chat_ids = await MessageService.get_search_scope(user_id, search_request.chat_id)
+
+        searches = [SearchService.search_messages(query, chat_ids, filters, bool(search_request.chat_id), limit)]
+        if query and not search_request.chat_id and filters == SearchFilters():
+            searches.append(SearchService.search_chats(query, chat_ids, limit))
+            searches.append(SearchService.search_users(query, limit))
+        results = await asyncio.gather(*searches)
+
+        messages, message_total = results[0]
+        chats, chat_total = results[1] if len(results) > 1 else ([], 0)
+        users, user_total = results[2] if len(results) > 2 else ([], 0)
+        return SearchResult(
+            messages=messages,
+            chats=chats,
+            users=users,
+            total=message_total + chat_total + user_total,
+            total_is_capped=SEARCH_COUNT_LIMIT in (message_total, chat_total, user_total)
+        )
+
+    @staticmethod
+    async def search_messages(query: str, chat_ids: List[str], filters: SearchFilters, single_chat: bool, limit: int) -> Tuple[List[Message], int]:
+        """Search messages by text, or with an empty query list the filtered messages newest first.
+
+        Listing without text needs a single chat or a filter, so it never walks all of a user's history.
+        """
+        if not chat_ids or not (query or single_chat or filters != SearchFilters()):
+            return [], 0
+
+        if query:
+            page, total = await asyncio.gather(
+                search_backend.search(query, chat_ids, limit, filters=filters),
+                search_backend.count(query, chat_ids, SEARCH_COUNT_LIMIT, filters)
+            )
+            return page.messages, total
+
+        messages_collection = await get_collection("messages")
+        message_query = {
+            "chat_id": {"$in": chat_ids},
+            "is_deleted": {"$ne": True},
+            "is_scheduled": {"$ne": True},
+            **filters.to_query()
+        }
+        rows, total = await asyncio.gather(
+            messages_collection.find(message_query).sort([("timestamp", -1), ("id", -1)]).limit(limit).max_time_ms(SEARCH_MAX_TIME_MS).to_list(limit),
+            messages_collection.count_documents(message_query, limit=SEARCH_COUNT_LIMIT, maxTimeMS=SEARCH_MAX_TIME_MS)
+        )
+        return [Message(**message_data) for message_data in rows], total
+
+    @staticmethod
+    def prefix_pattern(query: str) -> dict:
+        """Anchored, case-sensitive match on a *_folded field, so Mongo scans only the index range of the prefix"""
+        return {"$regex": "^" + re.escape(fold(query))}
+
+    @staticmethod
+    async def search_chats(query: str, chat_ids: List[str], limit: int) -> Tuple[List[Chat], int]:
+        """Find the user's chats and public chats whose name starts with `query` (ignoring case and accents)"""
+        chats_collection = await get_collection("chats")
+
+        chat_query = {
+            "name_folded": SearchService.prefix_pattern(query),
+            "$or": [{"id": {"$in": chat_ids}}, {"is_public": True}]
+        }
+        rows, total = await asyncio.gather(
+            chats_collection.find(chat_query, ChatService.CHAT_PROJECTION).limit(limit).max_time_ms(SEARCH_MAX_TIME_MS).to_list(limit),
+            chats_collection.count_documents(chat_query, limit=SEARCH_COUNT_LIMIT, maxTimeMS=SEARCH_MAX_TIME_MS)
+        )
+        return [Chat(**chat_data) for chat_data in rows], total
+
+    @staticmethod
+    async def search_users(query: str, limit: int) -> Tuple[List[User], int]:
+        """Find users whose name or username starts with `query`, ignoring case and accents.
+
+        Contact details and presence are left out; presence is read through the
+        presence endpoints, which apply the users' privacy settings.
+        """
+        users_collection = await get_collection("users")
+
+        pattern = SearchService.prefix_pattern(query.lstrip("@"))
+        user_query = {"$or": [{"name_folded": pattern}, {"username_folded": pattern}]}
+        rows, total = await asyncio.gather(
+            users_collection.find(user_query, {"email": 0, "phone": 0, "is_online": 0, "last_seen": 0}).limit(limit).max_time_ms(SEARCH_MAX_TIME_MS).to_list(limit),
+            users_collection.count_documents(user_query, limit=SEARCH_COUNT_LIMIT, maxTimeMS=SEARCH_MAX_TIME_MS)
+        )
+        return [User(**user_data) for user_data in rows], total
+
+    @staticmethod
+    async def backfill_folded_names() -> int:
+        """Add the folded name fields to chats and users written before name search used them"""
+        backfilled = 0
+        for collection_name in ("chats", "users"):
+            collection = await get_collection(collection_name)
+            operations = [
+                UpdateOne({"id": document["id"]}, {"$set": folded_name_fields(document)})
+                async for document in collection.find(
+                    {"name_folded": {"$exists": False}, "name": {"$type": "string"}},
+                    {"id": 1, "name": 1, "username": 1, "_id": 0}
+                )
+            ]
+            if operations:
+                await collection.bulk_write(operations, ordered=False)
+                backfilled += len(operations)
+        return backfilled
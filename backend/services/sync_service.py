@@ -0,0 +1,135 @@
+from typing import List, Optional, Tuple
+from datetime import datetime, timedelta
+from database import get_collection
+from models import Folder, InboxEntry, Message, SyncResponse, UserPrivacySettings
+from pagination import encode_cursor, decode_cursor
+from services.chat_service import ChatService
+from services.membership_service import MembershipService
+from services.message_service import MessageService
+from indexes import SYNC_TOMBSTONE_TTL_SECONDS
+import asyncio
+import os
+
+# Delta sync configuration (tokens older than SYNC_TOMBSTONE_TTL_SECONDS get a reset)
+# Changes are re-read this far before the token, covering clock skew between workers and
+# writes still in flight when the previous sync ran
+SYNC_OVERLAP = timedelta(seconds=float(os.getenv("SYNC_OVERLAP_SECONDS", "5")))
+# Beyond this many changed chats or messages a full reload is cheaper than a delta
+SYNC_MAX_CHATS = int(os.getenv("SYNC_MAX_CHATS", "500"))
+SYNC_MAX_MESSAGES = int(os.getenv("SYNC_MAX_MESSAGES", "1000"))
+
+class SyncService:
+    """Changes to a user's chat list, folders, privacy settings and messages since a sync token.
+
+    A token is the opaque start time of the previous sync. Everything synced
+    carries `updated_at`; chats that left the user's list are reported from
+    per-user tombstones, and deleted messages by ID. Results overlap the
+    previous sync by SYNC_OVERLAP, so clients apply them idempotently.
+    """
+
+    @staticmethod
+    def decode_token(token: Optional[str]) -> Optional[datetime]:
+        values = decode_cursor(token, 1) if token else None
+        if not values or not isinstance(values[0], datetime):
+            return None
+        return values[0]
+
+    @staticmethod
+    async def sync(user_id: str, token: Optional[str]) -> SyncResponse:
+        """Return the changes since `token`, or `reset` when the client must reload everything"""
+        now = datetime.utcnow()
+        next_token = encode_cursor(now)
+        synced_at = SyncService.decode_token(token)
+        if synced_at is None or synced_at < now - timedelta(seconds=SYNC_TOMBSTONE_TTL_SECONDS):
+            return SyncResponse(token=next_token, reset=True)
+        since = synced_at - SYNC_OVERLAP
+
+        chat_ids = await MembershipService.get_user_chat_ids(user_id)
+        (chat_entries, removed_chat_ids), folders, privacy_settings, messages = await asyncio.gather(
+            SyncService.changed_chats(user_id, chat_ids, since),
+            SyncService.changed_folders(user_id, since),
+            SyncService.changed_privacy_settings(user_id, since),
+            SyncService.changed_messages(chat_ids, since)
+        )
+        if chat_entries is None or messages is None:
+            return SyncResponse(token=next_token, reset=True)
+
+        chats = await ChatService.get_chats_for_entries(chat_entries)
+        current_chat_ids = {chat.id for chat in chats}
+        return SyncResponse(
+            token=next_token,
+            chats=chats,
+            removed_chat_ids=[chat_id for chat_id in removed_chat_ids if chat_id not in current_chat_ids],
+            folders=folders,
+            privacy_settings=privacy_settings,
+            messages=[message for message in messages if not message.is_deleted],
+            deleted_message_ids=[message.id for message in messages if message.is_deleted]
+        )
+
+    @staticmethod
+    async def changed_chats(user_id: str, chat_ids: List[str], since: datetime) -> Tuple[Optional[List[InboxEntry]], List[str]]:
+        """Inbox rows whose state or chat changed, plus the IDs of chats that left the list.
+
+        Returns (None, []) when more than SYNC_MAX_CHATS changed.
+        """
+        inbox_collection = await get_collection("inbox")
+        chats_collection = await get_collection("chats")
+        tombstones_collection = await get_collection("sync_tombstones")
+
+        changed_entries, changed_chats, tombstones = await asyncio.gather(
+            inbox_collection.find(
+                {"user_id": user_id, "updated_at": {"$gte": since}}, {"_id": 0}
+            ).to_list(SYNC_MAX_CHATS + 1),
+            chats_collection.find(
+                {"id": {"$in": chat_ids}, "updated_at": {"$gte": since}}, {"id": 1, "_id": 0}
+            ).to_list(SYNC_MAX_CHATS + 1),
+            tombstones_collection.find(
+                {"user_id": user_id, "deleted_at": {"$gte": since}}, {"id": 1, "_id": 0}
+            ).to_list(None)
+        )
+        if len(changed_entries) > SYNC_MAX_CHATS or len(changed_chats) > SYNC_MAX_CHATS:
+            return None, []
+
+        entries = {entry["chat_id"]: entry for entry in changed_entries}
+        missing = [chat_data["id"] for chat_data in changed_chats if chat_data["id"] not in entries]
+        if missing:
+            async for entry in inbox_collection.find({"user_id": user_id, "chat_id": {"$in": missing}}, {"_id": 0}):
+                entries[entry["chat_id"]] = entry
+        if len(entries) > SYNC_MAX_CHATS:
+            return None, []
+
+        removed_chat_ids = list(dict.fromkeys(tombstone["id"] for tombstone in tombstones))
+        return [InboxEntry(**entry) for entry in entries.values()], removed_chat_ids
+
+    @staticmethod
+    async def changed_folders(user_id: str, since: datetime) -> List[Folder]:
+        folders_collection = await get_collection("folders")
+
+        cursor = folders_collection.find({"user_id": user_id, "updated_at": {"$gte": since}})
+        return [Folder(**folder_data) async for folder_data in cursor]
+
+    @staticmethod
+    async def changed_privacy_settings(user_id: str, since: datetime) -> Optional[UserPrivacySettings]:
+        privacy_collection = await get_collection("user_privacy_settings")
+
+        settings_data = await privacy_collection.find_one({"user_id": user_id, "updated_at": {"$gte": since}})
+        return UserPrivacySettings(**settings_data) if settings_data else None
+
+    @staticmethod
+    async def changed_messages(chat_ids: List[str], since: datetime) -> Optional[List[Message]]:
+        """Messages of the user's chats changed since `since`; None when more than SYNC_MAX_MESSAGES.
+
+        Deleted and expired (not yet swept) messages come back as tombstones.
+        """
+        messages_collection = await get_collection("messages")
+
+        rows = await messages_collection.find(
+            {"chat_id": {"$in": chat_ids}, "updated_at": {"$gte": since}, "is_scheduled": {"$ne": True}}
+        ).sort("updated_at", 1).limit(SYNC_MAX_MESSAGES + 1).to_list(SYNC_MAX_MESSAGES + 1)
+        if len(rows) > SYNC_MAX_MESSAGES:
+            return None
+        now = datetime.utcnow()
+        return [
+            MessageService.build_tombstone(message_data) if MessageService.is_hidden(message_data, now) else Message(**message_data)
+            for message_data in rows
+        ]
@@ -11,7 +11,7 @@ const Header = ({ currentChat, currentUser, onProfileClick, onLogout }) => {
       case 'channel':
         return `📢 ${chat.subscribers_count?.toLocaleString()} inscritos ${chat.is_admin ? '• Admin' : ''}`;
       case 'group':
-        return `👥 ${chat.members?.length || 0} membros`;
+        return `👥 ${chat.members_count ?? chat.members?.length ?? 0} membros`;
       case 'bot':
         return '🤖 Bot Inteligente • Sempre ativo';
       case 'private':
@@ -0,0 +1,35 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+# The backend modules import each other as top-level modules (see backend/server.py)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+
+@pytest.fixture
+def mongo():
+    """Point the backend at an in-memory MongoDB for the duration of a test.
+
+    The registry's unique and sparse indexes are created (the in-memory
+    engine has no text or TTL indexes), so duplicate-key handling is exercised.
+    """
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import database
+    from indexes import INDEX_REGISTRY
+
+    saved = (database.db.client, database.db.database)
+    database.db.client = mongomock_motor.AsyncMongoMockClient()
+    database.db.database = database.db.client["kingchat_test"]
+
+    async def create_indexes():
+        for collection, specs in INDEX_REGISTRY.items():
+            for spec in specs:
+                if not spec.is_text:
+                    options = {name: value for name, value in spec.options.items() if name in ("unique", "sparse")}
+                    await database.db.database[collection].create_index(list(spec.keys), **options)
+
+    asyncio.run(create_indexes())
+    yield database.db.database
+    database.db.client, database.db.database = saved
@@ -0,0 +1,93 @@
+"""The bulk send and bulk read-acknowledgement endpoints"""
+import asyncio
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+from models import BulkMessageSendRequest, BulkReadRequest, ChatCreate, ChatType, MessageCreate, User
+from services.chat_service import ChatService
+from services.inbox_service import InboxService
+from services.message_service import MessageService
+
+
+def _users(*names):
+    return [f"{name}-{uuid.uuid4()}" for name in names]
+
+
+async def _group(owner: str, member: str):
+    return await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[member]), owner)
+
+
+def test_bulk_send_keeps_request_order_and_reports_each_message(mongo):
+    import server
+
+    async def scenario():
+        alice, bob, eve = _users("alice", "bob", "eve")
+        first, second = await _group(alice, bob), await _group(alice, bob)
+        foreign = await _group(eve, bob)
+        texts = ["one", "two", "three", "four"]
+        request = BulkMessageSendRequest(messages=[
+            MessageCreate(chat_id=first.id, text=texts[0]),
+            MessageCreate(chat_id=second.id, text="elsewhere"),
+            MessageCreate(chat_id=foreign.id, text="intrusion"),
+            *[MessageCreate(chat_id=first.id, text=text) for text in texts[1:]]
+        ])
+
+        response = await server.send_messages_bulk(request, current_user=User(id=alice, name="Alice"))
+        assert (response.total_sent, response.total_failed) == (5, 1)
+        assert [result.index for result in response.results if result.error] == [2]
+
+        sent = await mongo["messages"].find({"chat_id": first.id}).sort("seq", 1).to_list(10)
+        assert [message["text"] for message in sent] == texts
+        assert [message["seq"] for message in sent] == [1, 2, 3, 4]
+        timestamps = [message["timestamp"] for message in sent]
+        assert timestamps == sorted(set(timestamps))
+        assert (await mongo["chats"].find_one({"id": first.id}))["last_message"] == "four"
+        assert (await InboxService.get_entry(bob, first.id))["unread_count"] == 4
+        assert await mongo["messages"].count_documents({"chat_id": foreign.id}) == 0
+
+    asyncio.run(scenario())
+
+
+def test_bulk_send_rejects_oversized_requests(mongo, monkeypatch):
+    import server
+
+    monkeypatch.setattr(MessageService, "BULK_SEND_MAX_MESSAGES", 2)
+    request = BulkMessageSendRequest(messages=[MessageCreate(chat_id="any", text=str(n)) for n in range(3)])
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.send_messages_bulk(request, current_user=User(id="alice", name="Alice")))
+    assert error.value.status_code == 400
+
+
+def test_bulk_read_advances_each_watermark_and_recounts_unread(mongo):
+    import server
+
+    async def scenario():
+        alice, bob, eve = _users("alice", "bob", "eve")
+        caught_up, behind, mismatched = [await _group(alice, bob) for _ in range(3)]
+        foreign = await _group(eve, alice)
+        sent = {}
+        for chat in (caught_up, behind, mismatched):
+            sent[chat.id] = [
+                (await MessageService.create_message(MessageCreate(chat_id=chat.id, text=text), alice, "Alice")).id
+                for text in ["one", "two", "three"]
+            ]
+
+        response = await server.mark_messages_as_read(BulkReadRequest(reads={
+            caught_up.id: sent[caught_up.id][-1],
+            behind.id: sent[behind.id][0],
+            mismatched.id: sent[behind.id][1],
+            foreign.id: "anything"
+        }), current_user=User(id=bob, name="Bob"))
+
+        assert sorted(response.marked) == sorted([caught_up.id, behind.id])
+        assert {failure["chat_id"]: failure["error"] for failure in response.failed} == {
+            mismatched.id: "Message not found", foreign.id: "Chat not found or no access"
+        }
+        unread = {chat.id: (await InboxService.get_entry(bob, chat.id))["unread_count"] for chat in (caught_up, behind, mismatched)}
+        assert unread == {caught_up.id: 0, behind.id: 2, mismatched.id: 3}
+        assert (await MessageService.get_read_receipts(sent[behind.id][0], alice)).read_by == [bob]
+        assert (await MessageService.get_read_receipts(sent[behind.id][1], alice)).read_by == []
+
+    asyncio.run(scenario())
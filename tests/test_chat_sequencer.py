@@ -0,0 +1,109 @@
+"""Per-chat sequence numbers and the change log readers scan"""
+import asyncio
+from datetime import datetime, timedelta
+
+from services.chat_sequencer import SEQUENCE_LEASE_SECONDS, ChatSequencer
+
+
+def _seqs(changes):
+    return [change["seq"] for change in changes]
+
+
+def test_allocations_number_each_chat_consecutively(mongo):
+    async def scenario():
+        sequencer = ChatSequencer(head_window=100)
+        async with sequencer.allocate({"a": ["m1", "m2"], "b": ["m3"]}) as firsts:
+            assert firsts == {"a": 1, "b": 1}
+        async with sequencer.allocate({"a": ["m1"], "b": []}) as firsts:
+            assert firsts == {"a": 3}
+        assert await sequencer.head("a") == 3
+        assert await sequencer.head("b") == 1
+        assert await sequencer.head("c") == 0
+        assert [(change["seq"], change["message_id"]) for change in await sequencer.changes("a", 0, 10)] == [
+            (1, "m1"), (2, "m2"), (3, "m1")
+        ]
+
+    asyncio.run(scenario())
+
+
+def test_readers_stop_below_the_lowest_number_still_being_written(mongo):
+    async def scenario():
+        sequencer = ChatSequencer(head_window=100)
+        async with sequencer.allocate({"a": ["m1"]}):
+            pass
+        async with sequencer.allocate({"a": ["m2", "m3"]}) as slow:
+            assert slow == {"a": 2}
+            async with sequencer.allocate({"a": ["m4"]}) as fast:
+                assert fast == {"a": 4}
+            # 4 is written, but 2 and 3 are not yet
+            assert _seqs(await sequencer.changes("a", 0, 10)) == [1]
+            assert await sequencer.head("a") == 1
+        assert _seqs(await sequencer.changes("a", 0, 10)) == [1, 2, 3, 4]
+        assert _seqs(await sequencer.changes("a", 2, 1)) == [3]
+        assert await sequencer.head("a") == 4
+
+    asyncio.run(scenario())
+
+
+def test_a_failed_write_still_records_its_numbers(mongo):
+    async def scenario():
+        sequencer = ChatSequencer(head_window=100)
+        try:
+            async with sequencer.allocate({"a": ["m1"]}):
+                raise RuntimeError("write failed")
+        except RuntimeError:
+            pass
+        async with sequencer.allocate({"a": ["m2"]}):
+            pass
+        assert _seqs(await sequencer.changes("a", 0, 10)) == [1, 2]
+
+    asyncio.run(scenario())
+
+
+def test_a_number_whose_writer_died_stops_holding_back_readers(mongo):
+    async def scenario():
+        sequencer = ChatSequencer(head_window=100)
+        async with sequencer.allocate({"a": ["m1"]}):
+            pass
+        # Number 2 was reserved by a process that died before recording it
+        await mongo["chat_sequences"].update_one({"chat_id": "a"}, {"$inc": {"seq": 1}})
+        async with sequencer.allocate({"a": ["m3"]}):
+            pass
+        assert _seqs(await sequencer.changes("a", 0, 10)) == [1]
+
+        recorded_long_ago = datetime.utcnow() - timedelta(seconds=SEQUENCE_LEASE_SECONDS + 1)
+        await mongo["chat_changes"].update_one({"chat_id": "a", "seq": 3}, {"$set": {"created_at": recorded_long_ago}})
+        assert _seqs(await sequencer.changes("a", 0, 10)) == [1, 3]
+        assert await sequencer.head("a") == 3
+
+    asyncio.run(scenario())
+
+
+def test_head_only_checks_the_newest_numbers(mongo):
+    async def scenario():
+        sequencer = ChatSequencer(head_window=2)
+        for message_id in ["m1", "m2", "m3", "m4"]:
+            async with sequencer.allocate({"a": [message_id]}):
+                pass
+        assert await sequencer.head("a") == 4
+        # Older log rows are not needed to find the head
+        await mongo["chat_changes"].delete_many({"chat_id": "a", "seq": {"$lte": 2}})
+        assert await sequencer.head("a") == 4
+
+    asyncio.run(scenario())
+
+
+def test_leaving_the_block_wakes_the_chats_watchers(mongo):
+    async def scenario():
+        sequencer = ChatSequencer(head_window=100)
+        watcher = sequencer.watch("a")
+        other = sequencer.watch("b")
+        async with sequencer.allocate({"a": ["m1"]}):
+            assert not watcher.is_set()
+        assert watcher.is_set()
+        assert not other.is_set()
+        sequencer.unwatch("a", watcher)
+        sequencer.unwatch("b", other)
+        assert sequencer.stats() == {"watched_chats": 0, "watchers": 0}
+
+    asyncio.run(scenario())
@@ -0,0 +1,53 @@
+"""Chat writes, membership and access checks"""
+import asyncio
+import uuid
+
+import identity_map
+from models import ChatCreate, ChatType, ChatUpdate, InboxStateUpdate
+from services.chat_service import ChatService
+from services.inbox_service import InboxService
+
+
+def _users(*names):
+    return [f"{name}-{uuid.uuid4()}" for name in names]
+
+
+def test_a_refused_update_does_not_hide_the_chat_for_the_rest_of_the_request(mongo):
+    async def scenario():
+        alice, bob = _users("alice", "bob")
+        chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+
+        token = identity_map.begin_request_scope()
+        try:
+            # Bob is a member but neither owner nor admin
+            assert await ChatService.update_chat(chat.id, ChatUpdate(name="Mine"), bob) is None
+            seen = await ChatService.get_chat_by_id(chat.id, bob)
+            assert seen is not None and seen.name == "Team"
+
+            updated = await ChatService.update_chat(chat.id, ChatUpdate(name="Renamed"), alice)
+            assert updated.name == "Renamed"
+            assert (await ChatService.get_chat_by_id(chat.id, bob)).name == "Renamed"
+        finally:
+            identity_map.end_request_scope(token)
+
+    asyncio.run(scenario())
+
+
+def test_update_state_returns_the_written_row(mongo):
+    async def scenario():
+        alice, bob = _users("alice", "bob")
+        chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+
+        token = identity_map.begin_request_scope()
+        try:
+            await InboxService.get_entry(bob, chat.id)  # Cached before the write
+            entry = await InboxService.update_state(bob, chat.id, InboxStateUpdate(is_pinned=True, is_muted=True))
+            assert (entry.is_pinned, entry.is_muted, entry.is_archived) == (True, True, False)
+            assert (await InboxService.get_entry(bob, chat.id))["is_pinned"] is True
+            assert await InboxService.update_state(bob, "no-such-chat", InboxStateUpdate(is_pinned=True)) is None
+        finally:
+            identity_map.end_request_scope(token)
+
+        assert (await InboxService.get_entry(alice, chat.id))["is_pinned"] is False
+
+    asyncio.run(scenario())
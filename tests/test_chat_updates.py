@@ -0,0 +1,126 @@
+"""The per-chat change feed behind /chats/{id}/updates and /chats/{id}/events"""
+import asyncio
+import json
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+from models import ChatCreate, ChatType, MessageCreate, MessageUpdate, User
+from services.chat_service import ChatService
+from services.message_service import MessageService
+
+
+async def _deleted_message():
+    alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+    chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+    message = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="secret oops"), alice, "Alice")
+    assert await MessageService.delete_message(message.id, alice)
+    return chat, message, bob
+
+
+def _assert_tombstone(body: dict, message_id: str):
+    [sent] = [m for m in body["messages"] if m["id"] == message_id]
+    assert sent["is_deleted"] is True
+    assert sent["seq"] is not None
+    assert sent["text"] is None
+    assert sent["media_url"] is None
+    assert sent["reactions"] == []
+
+
+def test_updates_send_deleted_messages_as_tombstones(mongo):
+    async def scenario():
+        chat, message, bob = await _deleted_message()
+        updates = await MessageService.get_chat_updates(chat.id, bob, 0)
+        _assert_tombstone(json.loads(updates.json()), message.id)
+
+    asyncio.run(scenario())
+
+
+def test_event_stream_sends_deleted_messages_as_tombstones(mongo):
+    import server
+
+    async def scenario():
+        chat, message, bob = await _deleted_message()
+        response = await server.stream_chat_updates(
+            chat.id, since=0, last_event_id=None, current_user=User(id=bob, name="Bob")
+        )
+        events = response.body_iterator
+        try:
+            event = await events.__anext__()
+        finally:
+            await events.aclose()
+        fields = dict(line.split(": ", 1) for line in event.strip().split("\n"))
+        assert fields["event"] == "messages"
+        _assert_tombstone(json.loads(fields["data"]), message.id)
+
+    asyncio.run(scenario())
+
+
+def test_a_message_changed_twice_is_sent_once_with_its_latest_state(mongo):
+    async def scenario():
+        alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+        chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+        first = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="helo"), alice, "Alice")
+        second = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="world"), alice, "Alice")
+        edited = await MessageService.update_message(first.id, MessageUpdate(text="hello"), alice)
+
+        updates = await MessageService.get_chat_updates(chat.id, bob, 0)
+        assert [(message.id, message.text, message.seq) for message in updates.messages] == [
+            (second.id, "world", second.seq), (first.id, "hello", edited.seq)
+        ]
+        assert updates.seq == edited.seq == 3
+        assert (await MessageService.get_chat_updates(chat.id, bob, updates.seq)).messages == []
+
+    asyncio.run(scenario())
+
+
+def test_long_poll_parks_until_a_message_lands(mongo):
+    import server
+
+    async def scenario():
+        alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+        chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+        reader = User(id=bob, name="Bob")
+        head = await server.get_chat_updates(chat.id, current_user=reader)
+        assert (head.seq, head.messages) == (0, [])
+
+        poll = asyncio.create_task(server.get_chat_updates(chat.id, since=head.seq, timeout=10, current_user=reader))
+        await asyncio.sleep(0.05)
+        assert not poll.done()
+        message = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="hi"), alice, "Alice")
+        updates = await asyncio.wait_for(poll, timeout=1)
+        assert [(sent.id, sent.seq) for sent in updates.messages] == [(message.id, 1)]
+        assert updates.seq == 1
+
+        # Nothing new: an idle poll answers empty once its timeout runs out
+        idle = await server.get_chat_updates(chat.id, since=updates.seq, timeout=0.05, current_user=reader)
+        assert (idle.seq, idle.messages) == (1, [])
+
+        with pytest.raises(HTTPException) as error:
+            await server.get_chat_updates(chat.id, since=0, timeout=0, current_user=User(id="eve", name="Eve"))
+        assert error.value.status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_event_stream_resumes_after_the_last_event_id(mongo):
+    import server
+
+    async def scenario():
+        alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+        chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+        await MessageService.create_message(MessageCreate(chat_id=chat.id, text="seen"), alice, "Alice")
+        missed = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="missed"), alice, "Alice")
+
+        response = await server.stream_chat_updates(chat.id, since=None, last_event_id="1", current_user=User(id=bob, name="Bob"))
+        events = response.body_iterator
+        try:
+            event = await events.__anext__()
+        finally:
+            await events.aclose()
+        fields = dict(line.split(": ", 1) for line in event.strip().split("\n"))
+        assert fields["id"] == "2"
+        assert [sent["id"] for sent in json.loads(fields["data"])["messages"]] == [missed.id]
+
+    asyncio.run(scenario())
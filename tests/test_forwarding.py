@@ -0,0 +1,115 @@
+"""Forwarding a message to many chats"""
+import asyncio
+import uuid
+
+from models import ChatCreate, ChatType, MessageCreate
+from services.chat_service import ChatService
+from services.inbox_service import InboxService
+from services.message_service import MessageService
+
+
+def _users(*names):
+    return [f"{name}-{uuid.uuid4()}" for name in names]
+
+
+async def _groups(owner: str, member: str, count: int):
+    return [
+        await ChatService.create_chat(ChatCreate(name=f"Group {n}", type=ChatType.group, participants=[member]), owner)
+        for n in range(count)
+    ]
+
+
+def test_forwarding_writes_every_accessible_chat_and_reports_the_rest(mongo):
+    async def scenario():
+        alice, bob, eve = _users("alice", "bob", "eve")
+        source, *targets = await _groups(alice, bob, 4)
+        [foreign] = await _groups(eve, bob, 1)
+        original = await MessageService.create_message(MessageCreate(chat_id=source.id, text="news"), alice, "Alice")
+
+        result = await MessageService.forward_message_unlimited(
+            original.id, [target.id for target in targets] + [foreign.id, "no-such-chat"], alice, "Alice", "FYI"
+        )
+        assert (result["total_sent"], result["total_failed"]) == (3, 2)
+        assert result["successful_forwards"] == [target.id for target in targets]
+        assert [failure["chat_id"] for failure in result["failed_forwards"]] == [foreign.id, "no-such-chat"]
+
+        for target in targets:
+            [copy] = await mongo["messages"].find({"chat_id": target.id}).to_list(10)
+            assert (copy["is_forwarded"], copy["forwarded_from"], copy["seq"]) == (True, alice, 1)
+            assert copy["text"].startswith("FYI") and copy["text"].endswith("news")
+            assert (await mongo["chats"].find_one({"id": target.id}))["last_message"] == copy["text"]
+            assert (await InboxService.get_entry(bob, target.id))["unread_count"] == 1
+        assert await mongo["messages"].count_documents({"chat_id": foreign.id}) == 0
+
+    asyncio.run(scenario())
+
+
+def test_forward_jobs_run_in_chunks_and_complete(mongo, monkeypatch):
+    from services import forward_job_service
+    from services.forward_job_service import ForwardJobQueue, ForwardJobService
+
+    async def scenario():
+        queue = ForwardJobQueue(workers=2, lease_seconds=60)
+        monkeypatch.setattr(forward_job_service, "forward_job_queue", queue)
+        monkeypatch.setattr(forward_job_service, "FORWARD_JOB_CHUNK_SIZE", 2)
+        alice, bob = _users("alice", "bob")
+        source, *targets = await _groups(alice, bob, 6)
+        original = await MessageService.create_message(MessageCreate(chat_id=source.id, text="news"), alice, "Alice")
+
+        queue.start()
+        try:
+            job = await ForwardJobService.create_job(original, [target.id for target in targets] + ["no-such-chat"], alice, "Alice")
+            assert (job.status.value, job.total_targets) == ("queued", 6)
+            # Three chunks of at most two chats each
+            assert queue._active[job.id] == 3
+            await queue._queue.join()
+        finally:
+            await queue.stop()
+
+        job = await ForwardJobService.get_job(job.id, alice)
+        assert (job.status.value, job.total_sent, job.total_failed) == ("completed", 5, 1)
+        assert [failure["chat_id"] for failure in job.failed_forwards] == ["no-such-chat"]
+        assert (await mongo["forward_jobs"].find_one({"id": job.id}))["pending_chunks"] == 0
+        assert await ForwardJobService.get_job(job.id, bob) is None
+
+    asyncio.run(scenario())
+
+
+def test_only_jobs_whose_owner_stopped_renewing_are_interrupted(mongo, monkeypatch):
+    from datetime import datetime, timedelta
+
+    from services import forward_job_service
+    from services.forward_job_service import ForwardJobQueue, ForwardJobService
+
+    async def scenario():
+        # No workers: the chunks stay queued in this process
+        queue = ForwardJobQueue(workers=0, lease_seconds=60)
+        monkeypatch.setattr(forward_job_service, "forward_job_queue", queue)
+        alice, bob = _users("alice", "bob")
+        source, target = await _groups(alice, bob, 2)
+        original = await MessageService.create_message(MessageCreate(chat_id=source.id, text="news"), alice, "Alice")
+        queue.start()
+        try:
+            ours = await ForwardJobService.create_job(original, [target.id], alice, "Alice")
+            theirs = await ForwardJobService.create_job(original, [target.id], alice, "Alice")
+        finally:
+            await queue.stop()
+        lapsed = datetime.utcnow() - timedelta(seconds=1)
+        await mongo["forward_jobs"].update_many({}, {"$set": {"lease_expires_at": lapsed}})
+        await mongo["forward_jobs"].update_one({"id": theirs.id}, {"$set": {"worker_id": "a-process-that-died"}})
+
+        # Renewing only revives the jobs this process still holds chunks of
+        await ForwardJobService.renew_leases([ours.id, theirs.id])
+        assert await ForwardJobService.fail_interrupted_jobs() == 1
+        assert (await ForwardJobService.get_job(ours.id, alice)).status.value == "queued"
+        assert (await ForwardJobService.get_job(theirs.id, alice)).status.value == "interrupted"
+
+        # A chunk finishing after its job was interrupted is not recorded
+        await ForwardJobService.record_chunk(theirs.id, 1, [])
+        interrupted = await ForwardJobService.get_job(theirs.id, alice)
+        assert (interrupted.status.value, interrupted.total_sent) == ("interrupted", 0)
+        await ForwardJobService.record_chunk(ours.id, 1, [])
+        completed = await ForwardJobService.get_job(ours.id, alice)
+        assert (completed.status.value, completed.total_sent) == ("completed", 1)
+
+    asyncio.run(scenario())
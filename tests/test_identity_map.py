@@ -0,0 +1,66 @@
+"""Per-request scoping of the identity map"""
+import asyncio
+
+import identity_map
+
+def test_concurrent_requests_do_not_share_documents():
+    started = asyncio.Event()
+
+    async def request(user_id: str):
+        token = identity_map.begin_request_scope()
+        try:
+            async def loader():
+                return {"id": "m1", "loaded_by": user_id}
+            first = await identity_map.load("messages", "m1", loader)
+            if user_id == "alice":
+                started.set()
+            else:
+                await started.wait()
+            # Both requests have loaded m1 by now; each still sees its own copy
+            return first, await identity_map.load("messages", "m1", loader)
+        finally:
+            identity_map.end_request_scope(token)
+
+    async def main():
+        return await asyncio.gather(request("alice"), request("bob"))
+
+    (alice_first, alice_again), (bob_first, bob_again) = asyncio.run(main())
+    assert alice_first is alice_again and alice_first["loaded_by"] == "alice"
+    assert bob_first is bob_again and bob_first["loaded_by"] == "bob"
+
+def test_a_miss_is_loaded_once_per_request_until_discarded():
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        return None
+
+    async def main():
+        token = identity_map.begin_request_scope()
+        try:
+            assert await identity_map.load("messages", "missing", loader) is None
+            assert await identity_map.load("messages", "missing", loader) is None
+            assert len(calls) == 1
+
+            identity_map.discard("messages", "missing")
+            assert await identity_map.load("messages", "missing", loader) is None
+            assert len(calls) == 2
+        finally:
+            identity_map.end_request_scope(token)
+
+    asyncio.run(main())
+
+def test_outside_a_request_every_load_hits_the_loader():
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        return {"id": "m1"}
+
+    async def main():
+        identity_map.remember("messages", "m1", {"id": "stale"})
+        await identity_map.load("messages", "m1", loader)
+        await identity_map.load("messages", "m1", loader)
+
+    asyncio.run(main())
+    assert len(calls) == 2
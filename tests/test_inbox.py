@@ -0,0 +1,62 @@
+"""Per-user inbox rows: unread counters and archived listings"""
+import asyncio
+import uuid
+
+from models import ChatCreate, ChatType, InboxStateUpdate, MessageCreate, User
+from services.chat_service import ChatService
+from services.inbox_service import InboxService
+from services.message_service import MessageService
+
+
+def _users(*names):
+    return [f"{name}-{uuid.uuid4()}" for name in names]
+
+
+async def _unread(user_id: str, chat_id: str) -> int:
+    return (await InboxService.get_entry(user_id, chat_id))["unread_count"]
+
+
+def test_unread_counters_follow_messages_and_reads(mongo):
+    async def scenario():
+        alice, bob = _users("alice", "bob")
+        chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+        first = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="one"), alice, "Alice")
+        await MessageService.create_message(MessageCreate(chat_id=chat.id, text="two"), alice, "Alice")
+        assert (await _unread(alice, chat.id), await _unread(bob, chat.id)) == (0, 2)
+
+        # Replying counts as reading, and the reply is unread for the other side
+        await MessageService.create_message(MessageCreate(chat_id=chat.id, text="three"), bob, "Bob")
+        assert (await _unread(alice, chat.id), await _unread(bob, chat.id)) == (1, 0)
+
+        await MessageService.create_message(MessageCreate(chat_id=chat.id, text="four"), alice, "Alice")
+        assert await MessageService.mark_as_read(chat.id, bob, [first.id])
+        assert await _unread(bob, chat.id) == 1
+
+        assert await MessageService.mark_as_read(chat.id, bob)
+        assert await _unread(bob, chat.id) == 0
+
+    asyncio.run(scenario())
+
+
+def test_archiving_is_per_user_and_listed_on_request(mongo):
+    import server
+
+    async def scenario():
+        alice, bob = _users("alice", "bob")
+        group = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+        direct = await ChatService.create_chat(ChatCreate(name="Bob", type=ChatType.private, participants=[bob]), alice)
+        await InboxService.update_state(bob, group.id, InboxStateUpdate(is_archived=True))
+
+        bob_user = User(id=bob, name="Bob")
+
+        async def listed(user: User, **params):
+            return [chat.id for chat in await server.get_chats(current_user=user, **params)]
+
+        assert await listed(bob_user) == [direct.id]
+        assert await listed(bob_user, archived=True) == [group.id]
+        assert await listed(bob_user, chat_type=ChatType.group) == []
+        assert await listed(bob_user, chat_type=ChatType.group, archived=True) == [group.id]
+        # Alice still sees the group in her inbox
+        assert await listed(User(id=alice, name="Alice"), chat_type=ChatType.group) == [group.id]
+
+    asyncio.run(scenario())
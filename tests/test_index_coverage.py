@@ -0,0 +1,443 @@
+"""Every query shape issued by the service layer must be served by a declared index"""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from indexes import INDEX_REGISTRY, diff_indexes, find_supporting_index, index, sync_indexes
+
+# (collection, equality fields, sort, text search) for each query the services run.
+# test_query_shapes_match_the_queries_services_issue records the queries of a
+# workload and fails when a row is missing here or is no longer issued.
+QUERY_SHAPES = [
+    # auth.get_user_from_token / create_demo_user, PresenceStore.get_presences / flush
+    ("users", ("id",), (), False),
+    # PrivacyService.get_user_privacy_settings / get_privacy_settings_many / update_*, SyncService
+    ("user_privacy_settings", ("user_id",), (), False),
+    # ChatService.load_chat_document / update_chat / get_accessible_chats / get_chats_for_entries,
+    # LastMessageCoalescer.write, SyncService.changed_chats
+    ("chats", ("id",), (), False),
+    # MembershipService.get_membership / add_member(s) / remove_member / get_member_chat_ids
+    ("chat_members", ("chat_id", "user_id"), (), False),
+    # MembershipService.list_members
+    ("chat_members", ("chat_id",), (("user_id", 1),), False),
+    # MembershipService.remove_all_members, InboxService.backfill_from_memberships
+    ("chat_members", ("chat_id",), (), False),
+    # MembershipService.get_user_chat_ids
+    ("chat_members", ("user_id",), (), False),
+    # InboxService.get_entry / update_state / mark_read / set_unread_count / remove_entry / mark_read_many
+    ("inbox", ("user_id", "chat_id"), (), False),
+    # InboxService.list_entries (all chats, or one type for ChatService.get_chats_by_type)
+    ("inbox", ("user_id", "is_archived"), (("last_activity", -1), ("chat_id", -1)), False),
+    ("inbox", ("user_id", "chat_type", "is_archived"), (("last_activity", -1), ("chat_id", -1)), False),
+    # InboxService.record_messages / remove_chat
+    ("inbox", ("chat_id",), (), False),
+    # InboxService.get_readers
+    ("inbox", ("chat_id",), (("last_read_at", 1),), False),
+    # MessageService.load_message_document / update_message / hide_messages / recount_reactions,
+    # ScheduledMessageDispatcher.deliver, SearchService lookups by id
+    ("messages", ("id",), (), False),
+    # MessageService.get_chat_messages_page (both directions)
+    ("messages", ("chat_id",), (("timestamp", -1), ("id", -1)), False),
+    ("messages", ("chat_id",), (("timestamp", 1), ("id", 1)), False),
+    # InboxService.count_unread (timestamp after the read watermark)
+    ("messages", ("chat_id",), (("timestamp", 1),), False),
+    # ChatService.delete_chat
+    ("messages", ("chat_id",), (), False),
+    # MongoSearchBackend.search / count (chat_id $in the caller's chats, filtered after the text index)
+    ("messages", ("chat_id",), (), True),
+    # ScheduledMessageDispatcher._load_window (scheduled_for is a range on the sort key)
+    ("messages", ("is_scheduled",), (("scheduled_for", 1),), False),
+    # MessageExpirySweeper.sweep / _next_expiry (range and sort on expires_at)
+    ("messages", (), (("expires_at", 1),), False),
+    # SearchService.search_messages without text (chat_id $in, message_type filter, newest first) and its count
+    ("messages", ("chat_id", "message_type"), (("timestamp", -1), ("id", -1)), False),
+    ("messages", ("chat_id", "message_type"), (), False),
+    # SearchService.search_chats (public chats by folded name prefix) and search_users; an anchored
+    # case-sensitive $regex is a range on the field
+    ("chats", ("is_public",), (("name_folded", 1),), False),
+    ("users", (), (("name_folded", 1),), False),
+    ("users", (), (("username_folded", 1),), False),
+    # SearchService.backfill_folded_names on users (missing fields are null in the index)
+    ("users", ("name_folded",), (), False),
+    # InvertedIndexSearchBackend.sync
+    ("messages", (), (("updated_at", 1),), False),
+    # SyncService.changed_chats / changed_folders (rows, folders and tombstones changed since the token)
+    ("inbox", ("user_id",), (("updated_at", 1),), False),
+    ("folders", ("user_id",), (("updated_at", 1),), False),
+    ("sync_tombstones", ("user_id",), (("deleted_at", 1),), False),
+    # SyncService.changed_messages (chat_id $in, updated_at range on the sort key)
+    ("messages", ("chat_id",), (("updated_at", 1),), False),
+    # ChatSequencer.allocate / head
+    ("chat_sequences", ("chat_id",), (), False),
+    # ChatSequencer.changes (seq is a range on the sort key)
+    ("chat_changes", ("chat_id",), (("seq", 1),), False),
+    # MessageService.add_reaction / remove_reaction
+    ("message_reactions", ("message_id", "user_id", "emoji"), (), False),
+    # MessageService.recount_reactions (rows of one message, grouped by emoji)
+    ("message_reactions", ("message_id",), (), False),
+    # MessageService.get_my_reactions (message_id $in)
+    ("message_reactions", ("user_id", "message_id"), (), False),
+    # ChatService.delete_chat
+    ("message_reactions", ("chat_id",), (), False),
+    # ForwardJobService.get_job / record_chunk / renew_leases
+    ("forward_jobs", ("id",), (), False),
+    # ForwardJobService.fail_interrupted_jobs: expired leases, and jobs from before leases that went quiet
+    ("forward_jobs", ("status",), (("lease_expires_at", 1),), False),
+    ("forward_jobs", ("status", "lease_expires_at"), (("updated_at", 1),), False),
+    # server: folders for a user
+    ("folders", ("user_id",), (), False),
+]
+
+# Queries that deliberately read a whole collection: one-off startup migrations and index rebuilds
+UNINDEXED_SCANS = [
+    # MembershipService.migrate_embedded_members
+    ("chats", ("members_count",), (), False),
+    # InboxService.backfill_from_memberships
+    ("chats", (), (), False),
+    # SearchService.backfill_folded_names on chats
+    ("chats", ("name_folded",), (), False),
+    # InvertedIndexSearchBackend.rebuild
+    ("messages", (), (), False),
+]
+
+# Operators that bound a range on their field
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte", "$regex"}
+
+def _unique_fields(collection, equality):
+    """The fields of a unique index bound by the equality fields, if any"""
+    for spec in INDEX_REGISTRY.get(collection, []):
+        if spec.options.get("unique") and set(spec.fields) <= set(equality):
+            return tuple(sorted(spec.fields))
+    return None
+
+def query_shapes(collection, query, sort=None):
+    """The QUERY_SHAPES rows one query needs.
+
+    Fields matched by value, by $in or by `$exists: False` (null in the index)
+    are the equality fields; when they bind a unique index the query is a
+    lookup by that key and nothing else matters. Otherwise, without a sort,
+    the fields bounded by a range stand in for it. $ne, $nin and
+    `$exists: True` are filtered after the index. Without a sort each branch
+    of a top-level $or is planned on its own; with one, $or is filtered after
+    the sort's index.
+    """
+    query = dict(query or {})
+    branches = query.pop("$or", None)
+    if branches and not sort:
+        return [shape for branch in branches for shape in query_shapes(collection, {**query, **branch})]
+
+    equality, ranges, text = [], [], False
+    for field, condition in query.items():
+        if field == "$text":
+            text = True
+        elif field.startswith("$"):
+            continue
+        elif not isinstance(condition, dict) or not any(key.startswith("$") for key in condition):
+            equality.append(field)
+        elif "$in" in condition or "$eq" in condition or condition.get("$exists") is False:
+            equality.append(field)
+        elif RANGE_OPERATORS & set(condition):
+            ranges.append(field)
+
+    unique_fields = None if text else _unique_fields(collection, equality)
+    if unique_fields:
+        return [(collection, unique_fields, (), False)]
+    if sort:
+        order = tuple(sort.items() if isinstance(sort, dict) else (tuple(key) for key in sort))
+    elif text:
+        order = ()
+    else:
+        order = tuple((field, 1) for field in ranges)
+    return [(collection, tuple(sorted(equality)), order, text)]
+
+def _normalized(shape):
+    collection, equality, sort, text = shape
+    return (collection, tuple(sorted(equality)), tuple(sort), text)
+
+class _RecordingCursor:
+    def __init__(self, cursor, record):
+        self._cursor = cursor
+        self._record = record
+
+    def sort(self, key, direction=None):
+        self._record["sort"] = [(key, direction or 1)] if isinstance(key, str) else key
+        self._cursor = self._cursor.sort(key, direction) if direction else self._cursor.sort(key)
+        return self
+
+    def __aiter__(self):
+        return self._cursor.__aiter__()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+
+        def call(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if type(result) is not type(self._cursor):
+                return result
+            # limit(), max_time_ms() and the like chain
+            self._cursor = result
+            return self
+        return call
+
+class _RecordingCollection:
+    """Passes every call on to the real collection, noting the filter and sort of each query"""
+
+    FILTERED = ("find_one", "find_one_and_update", "update_one", "update_many", "delete_one", "delete_many", "count_documents")
+
+    def __init__(self, collection, queries):
+        self._collection = collection
+        self._queries = queries
+
+    def _note(self, query, sort=None):
+        record = {"collection": self._collection.name, "query": query, "sort": sort}
+        self._queries.append(record)
+        return record
+
+    def find(self, query=None, *args, **kwargs):
+        record = self._note(query, kwargs.get("sort"))
+        return _RecordingCursor(self._collection.find(query, *args, **kwargs), record)
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        # Only a leading $match, and a $sort right after it, can use an index
+        if pipeline and "$match" in pipeline[0]:
+            sort = pipeline[1].get("$sort") if len(pipeline) > 1 else None
+            self._note(pipeline[0]["$match"], sort)
+        return self._collection.aggregate(pipeline, *args, **kwargs)
+
+    def bulk_write(self, operations, *args, **kwargs):
+        for operation in operations:
+            if getattr(operation, "_filter", None) is not None:
+                self._note(operation._filter)
+        return self._collection.bulk_write(operations, *args, **kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in self.FILTERED:
+            return attribute
+
+        def call(query, *args, **kwargs):
+            self._note(query, kwargs.get("sort"))
+            return attribute(query, *args, **kwargs)
+        return call
+
+class _RecordingDatabase:
+    def __init__(self, database):
+        self._database = database
+        self.queries = []
+
+    def __getitem__(self, name):
+        return _RecordingCollection(self._database[name], self.queries)
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+@pytest.mark.parametrize("collection,equality,sort,text", QUERY_SHAPES)
+def test_query_shape_has_supporting_index(collection, equality, sort, text):
+    spec = find_supporting_index(collection, equality, sort, text)
+    assert spec is not None, f"No index in INDEX_REGISTRY serves {collection} {equality} sort={sort} text={text}"
+
+def test_registry_has_no_duplicate_indexes():
+    for collection, specs in INDEX_REGISTRY.items():
+        keys = [spec.keys for spec in specs]
+        assert len(keys) == len(set(keys)), f"Duplicate index declared on {collection}"
+
+def test_diff_reports_missing_undeclared_and_redundant():
+    declared = [index("id", unique=True), index(("chat_id", 1), ("timestamp", -1))]
+    existing = [
+        {"name": "_id_", "key": {"_id": 1}},
+        {"name": "id_1", "key": {"id": 1}, "unique": True},
+        {"name": "chat_id_1", "key": {"chat_id": 1}},
+        {"name": "text_text", "key": {"_fts": "text", "_ftsx": 1}, "weights": {"text": 1}},
+    ]
+
+    diff = diff_indexes(declared, existing)
+
+    assert [spec.name for spec in diff["missing"]] == ["chat_id_1_timestamp_-1"]
+    assert diff["undeclared"] == ["chat_id_1", "text_text"]
+    assert diff["redundant"] == ["chat_id_1"]
+
+def test_diff_reports_indexes_whose_options_differ():
+    declared = [index("id", unique=True), index("expires_at", expireAfterSeconds=0), index("name")]
+    existing = [
+        {"name": "id_1", "key": {"id": 1}},
+        {"name": "expires_at_1", "key": {"expires_at": 1}, "expireAfterSeconds": 3600},
+        {"name": "name_1", "key": {"name": 1}},
+    ]
+
+    diff = diff_indexes(declared, existing)
+
+    assert diff["missing"] == []
+    assert diff["mismatched"] == {
+        "id_1": {"unique": (True, False)},
+        "expires_at_1": {"expireAfterSeconds": (0, 3600)},
+    }
+
+class _FakeCursor:
+    def __init__(self, items):
+        self.items = items
+
+    async def to_list(self, length):
+        return self.items
+
+class _FakeCollection:
+    def __init__(self, fail: bool):
+        self.fail = fail
+        self.created = []
+
+    def list_indexes(self):
+        return _FakeCursor([{"name": "_id_", "key": {"_id": 1}}])
+
+    async def create_indexes(self, models):
+        if self.fail:
+            raise RuntimeError("build failed")
+        self.created.extend(models)
+        return [model.document["name"] for model in models]
+
+def test_sync_continues_after_a_collection_fails():
+    database = {"broken": _FakeCollection(fail=True), "healthy": _FakeCollection(fail=False)}
+    registry = {"broken": [index("id")], "healthy": [index("id")]}
+
+    report = asyncio.run(sync_indexes(database, registry))
+
+    assert report["broken"]["error"] == "build failed"
+    assert [model.document["name"] for model in database["healthy"].created] == ["id_1"]
+
+async def _issue_every_query(mongo):
+    """Run each service query at least once; `mongo` is the database without the recorder"""
+    import server
+    from auth import create_access_token, create_demo_user, get_user_from_token
+    from models import (
+        ChatCreate, ChatType, ChatUpdate, ContactPrivacyUpdate, InboxStateUpdate, MessageCreate,
+        MessageUpdate, SearchRequest, User
+    )
+    from pagination import encode_cursor
+    from services.chat_sequencer import chat_sequencer
+    from services.chat_service import ChatService
+    from services.expiry_sweeper import MessageExpirySweeper
+    from services.forward_job_service import ForwardJobService, forward_job_queue
+    from services.inbox_service import InboxService
+    from services.last_message_coalescer import LastMessageCoalescer
+    from services.membership_service import MembershipService
+    from services.message_service import MessageService
+    from services.presence_service import PresenceStore
+    from services.privacy_service import PrivacyService
+    from services.scheduled_dispatcher import ScheduledMessageDispatcher
+    from services.search_backend import InvertedIndexSearchBackend
+    from services.search_service import SearchService
+    from services.sync_service import SyncService
+
+    alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+    alice_user = User(id=alice, name="Alice")
+    started = datetime.utcnow() - timedelta(seconds=1)
+
+    # Startup
+    await create_demo_user()
+    await MembershipService.migrate_embedded_members()
+    await InboxService.backfill_from_memberships()
+    await SearchService.backfill_folded_names()
+    await ForwardJobService.fail_interrupted_jobs()
+
+    # Users, privacy and presence
+    await get_user_from_token(create_access_token({"sub": "demo_user_123"}))
+    await PrivacyService.update_global_privacy_settings(alice, {"default_show_last_seen": False})
+    await PrivacyService.update_contact_privacy_settings(alice, ContactPrivacyUpdate(contact_user_id=bob, show_last_seen_to_contact=True))
+    await PrivacyService.get_visibility_matrix([alice, bob], [bob])
+    presence = PresenceStore(ttl_seconds=60, typing_ttl_seconds=5, flush_seconds=60)
+    await presence.heartbeat(alice)
+    await presence.flush()
+    await presence.get_presences([alice, bob, "demo_user_123"], bob)
+
+    # Chats, membership and inbox
+    group = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob], is_public=True), alice)
+    other = await ChatService.create_chat(ChatCreate(name="Other", type=ChatType.group, participants=[bob]), alice)
+    await ChatService.update_chat(group.id, ChatUpdate(description="Hello"), alice)
+    await ChatService.leave_chat(group.id, bob)
+    await ChatService.join_chat(group.id, bob)
+    await MembershipService.list_members(group.id, limit=1, after=alice)
+    await ChatService.get_accessible_chats([group.id, other.id], bob)
+    await InboxService.update_state(bob, other.id, InboxStateUpdate(is_archived=True))
+    await ChatService.get_user_chats_page(bob)
+    await ChatService.get_chats_by_type(bob, ChatType.group, archived=True)
+    await server.get_user_chats_with_folders(current_user=alice_user)
+
+    # Messages
+    first = await MessageService.create_message(MessageCreate(chat_id=group.id, text="hello world"), alice, "Alice")
+    await MessageService.create_messages([MessageCreate(chat_id=group.id, text="bulk"), MessageCreate(chat_id=other.id, text="bulk")], alice, "Alice")
+    await MessageService.create_message(MessageCreate(chat_id=group.id, text="later", scheduled_for=datetime.utcnow() + timedelta(seconds=30)), alice, "Alice")
+    secret = await MessageService.create_message(MessageCreate(chat_id=group.id, text="secret", self_destruct="1m"), alice, "Alice")
+    reply = await MessageService.create_message(MessageCreate(chat_id=group.id, text="reply", reply_to=first.id), bob, "Bob")
+    await MessageService.create_message(MessageCreate(chat_id=group.id, text="again"), alice, "Alice")
+    page = await MessageService.get_chat_messages_page(group.id, bob, limit=1, reply_previews=True)
+    await MessageService.get_chat_messages_page(group.id, bob, limit=1, before=page.older_cursor)
+    await MessageService.get_chat_messages_page(group.id, bob, limit=1, after=encode_cursor(first.timestamp, first.id))
+    await MessageService.get_chat_messages_page(group.id, bob, limit=2, around=first.id)
+    await MessageService.update_message(first.id, MessageUpdate(text="hello there"), alice)
+    await MessageService.add_reaction(first.id, "👍", bob)
+    await MessageService.remove_reaction(first.id, "👍", bob)
+    await MessageService.get_my_reactions([first.id, reply.id], bob)
+    await MessageService.mark_as_read(group.id, bob, [first.id])
+    await MessageService.mark_as_read(group.id, bob, [first.id, reply.id])
+    await MessageService.mark_many_as_read({group.id: reply.id, other.id: reply.id}, bob)
+    await MessageService.get_read_receipts(first.id, alice)
+    await MessageService.forward_message_unlimited(first.id, [other.id], alice, "Alice")
+    await MessageService.delete_message(reply.id, bob)
+    await MessageService.get_chat_updates(group.id, bob, 0)
+    await MessageService.get_chat_updates(group.id, bob, None)
+
+    # Forward jobs
+    forward_job_queue.start()
+    try:
+        job = await ForwardJobService.create_job(first, [other.id], alice, "Alice")
+    finally:
+        await forward_job_queue.stop()
+    await ForwardJobService.renew_leases([job.id])
+    await ForwardJobService.record_chunk(job.id, 1, [])
+    await ForwardJobService.get_job(job.id, alice)
+
+    # Background components
+    dispatcher = ScheduledMessageDispatcher(window_seconds=60, lease_seconds=30, batch_size=10)
+    await dispatcher._load_window(datetime.utcnow())
+    await dispatcher.deliver([message_id for _, message_id in dispatcher._heap])
+    await LastMessageCoalescer.write({group.id: ("hello", datetime.utcnow())})
+    await mongo["messages"].update_one({"id": secret.id}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+    sweeper = MessageExpirySweeper(batch_seconds=1, idle_seconds=60, batch_size=10)
+    sweeper._hide_messages = MessageService.hide_messages
+    await sweeper.sweep()
+    await sweeper._next_expiry()
+    inverted = InvertedIndexSearchBackend(snapshot_path="/nonexistent/snapshot", snapshot_interval=60, sync_interval=60)
+    await inverted.rebuild()
+    await inverted.sync()
+
+    # Search and sync
+    await SearchService.search_chats("tea", [group.id], 10)
+    await SearchService.search_users("ali", 10)
+    await SearchService.search(SearchRequest(query="", chat_id=group.id, message_type="text"), bob)
+    # The in-memory engine has no $text; the query is recorded before it fails
+    with pytest.raises(NotImplementedError):
+        await MessageService.search_messages_page("hello", bob)
+    await SyncService.sync(bob, encode_cursor(started))
+    await chat_sequencer.head(group.id)
+
+    await ChatService.delete_chat(other.id, alice)
+
+
+def test_query_shapes_match_the_queries_services_issue(mongo, monkeypatch):
+    import database
+    from services import forward_job_service
+
+    # Chunks stay queued: no workers
+    monkeypatch.setattr(forward_job_service, "forward_job_queue", forward_job_service.ForwardJobQueue(workers=0, lease_seconds=60))
+    recorder = _RecordingDatabase(mongo)
+    database.db.database = recorder
+    asyncio.run(_issue_every_query(mongo))
+
+    issued = {
+        shape
+        for record in recorder.queries
+        for shape in query_shapes(record["collection"], record["query"], record["sort"])
+    }
+    listed = {_normalized(shape) for shape in QUERY_SHAPES + UNINDEXED_SCANS}
+    assert sorted(issued - listed) == [], "Issued queries missing from QUERY_SHAPES"
+    assert sorted(listed - issued) == [], "QUERY_SHAPES rows no service issues any more"
@@ -0,0 +1,93 @@
+"""Write-behind buffering of chats' last message"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from services.last_message_coalescer import LastMessageCoalescer
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def _at(seconds: int) -> datetime:
+    return T0 + timedelta(seconds=seconds)
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """Record every bulk write instead of sending it to the database"""
+    calls = []
+
+    async def write(updates):
+        calls.append(dict(updates))
+
+    monkeypatch.setattr(LastMessageCoalescer, "write", staticmethod(write))
+    return calls
+
+
+def test_submissions_collapse_to_the_newest_per_chat(writes):
+    async def scenario():
+        coalescer = LastMessageCoalescer(flush_seconds=60, max_pending=100)
+        coalescer.start()
+        try:
+            await coalescer.submit({"a": ("first", _at(1)), "b": ("only", _at(1))})
+            await coalescer.submit({"a": ("third", _at(3))})
+            await coalescer.submit({"a": ("second, late", _at(2))})
+            assert coalescer.pending() == 2
+            assert writes == []
+        finally:
+            await coalescer.stop()
+
+        assert writes == [{"a": ("third", _at(3)), "b": ("only", _at(1))}]
+
+    asyncio.run(scenario())
+
+
+def test_reaching_max_pending_flushes_early(writes):
+    async def scenario():
+        coalescer = LastMessageCoalescer(flush_seconds=60, max_pending=2)
+        coalescer.start()
+        try:
+            await coalescer.submit({"a": ("hi", _at(1))})
+            await asyncio.sleep(0)
+            assert writes == []
+            await coalescer.submit({"b": ("hi", _at(1))})
+            for _ in range(10):
+                await asyncio.sleep(0)
+            assert writes == [{"a": ("hi", _at(1)), "b": ("hi", _at(1))}]
+            assert coalescer.pending() == 0
+        finally:
+            await coalescer.stop()
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_keeps_updates_unless_newer_arrived(monkeypatch):
+    async def scenario():
+        coalescer = LastMessageCoalescer(flush_seconds=60, max_pending=100)
+
+        async def failing_write(updates):
+            # A newer message for "a" arrives while the write is in flight
+            coalescer._pending["a"] = ("newer", _at(5))
+            raise RuntimeError("database unavailable")
+
+        monkeypatch.setattr(LastMessageCoalescer, "write", staticmethod(failing_write))
+        coalescer._pending = {"a": ("older", _at(1)), "b": ("kept", _at(1))}
+        with pytest.raises(RuntimeError):
+            await coalescer.flush()
+        assert coalescer._pending == {"a": ("newer", _at(5)), "b": ("kept", _at(1))}
+
+    asyncio.run(scenario())
+
+
+def test_out_of_order_writes_never_overwrite_a_newer_last_message(mongo):
+    async def scenario():
+        await mongo["chats"].insert_one({"id": "a"})
+        await LastMessageCoalescer.write({"a": ("newer", _at(2))})
+        # Another process flushes an older message afterwards
+        await LastMessageCoalescer.write({"a": ("older", _at(1))})
+
+        chat = await mongo["chats"].find_one({"id": "a"})
+        assert (chat["last_message"], chat["last_message_time"], chat["updated_at"]) == ("newer", _at(2), _at(2))
+
+    asyncio.run(scenario())
@@ -0,0 +1,65 @@
+"""The chat_members store: migrating legacy member arrays and the access checks built on it"""
+import asyncio
+import uuid
+
+from models import ChatType, ChatUpdate, MemberRole
+from services.chat_service import ChatService
+from services.inbox_service import InboxService
+from services.membership_service import MembershipService
+
+
+def test_legacy_member_arrays_migrate_into_chat_members(mongo):
+    async def scenario():
+        chat_id = f"legacy-{uuid.uuid4()}"
+        await mongo["chats"].insert_one({
+            "id": chat_id, "name": "Old group", "type": ChatType.group.value, "owner": "olga",
+            "participants": ["olga", "ann"], "members": ["ann", "bo"], "admins": ["ann"]
+        })
+
+        assert await MembershipService.migrate_embedded_members() == 1
+        assert await MembershipService.migrate_embedded_members() == 0
+
+        chat = await mongo["chats"].find_one({"id": chat_id})
+        assert chat["members_count"] == 3
+        assert "members" not in chat and "admins" not in chat
+        page = await MembershipService.list_members(chat_id)
+        assert [(member.user_id, member.role) for member in page.members] == [
+            ("ann", MemberRole.admin), ("bo", MemberRole.member), ("olga", MemberRole.owner)
+        ]
+
+        # Access and admin rights now come from chat_members
+        assert await ChatService.get_chat_by_id(chat_id, "bo") is not None
+        assert await ChatService.get_chat_by_id(chat_id, "eve") is None
+        assert await ChatService.update_chat(chat_id, ChatUpdate(name="Renamed"), "bo") is None
+        assert (await ChatService.update_chat(chat_id, ChatUpdate(name="Renamed"), "ann")).name == "Renamed"
+        assert set(await ChatService.get_accessible_chats([chat_id], "bo")) == {chat_id}
+        assert await ChatService.get_accessible_chats([chat_id], "eve") == {}
+
+        # Members get an inbox row for the migrated chat
+        assert await InboxService.backfill_from_memberships() == 3
+        assert (await InboxService.get_entry("bo", chat_id))["chat_type"] == ChatType.group.value
+
+    asyncio.run(scenario())
+
+
+def test_joining_and_leaving_update_access_and_counters(mongo):
+    async def scenario():
+        chat_id = f"public-{uuid.uuid4()}"
+        await mongo["chats"].insert_one({
+            "id": chat_id, "name": "Open group", "type": ChatType.group.value, "owner": "olga",
+            "is_public": True, "participants": [], "members_count": 1
+        })
+        await MembershipService.add_member(chat_id, "olga", MemberRole.owner)
+
+        assert await ChatService.get_chat_by_id(chat_id, "bo") is None
+        assert await ChatService.join_chat(chat_id, "bo")
+        assert await ChatService.join_chat(chat_id, "bo")
+        assert await ChatService.get_chat_by_id(chat_id, "bo") is not None
+        assert (await mongo["chats"].find_one({"id": chat_id}))["members_count"] == 2
+
+        assert await ChatService.leave_chat(chat_id, "bo")
+        assert await ChatService.get_chat_by_id(chat_id, "bo") is None
+        assert (await mongo["chats"].find_one({"id": chat_id}))["members_count"] == 1
+        assert not await ChatService.leave_chat(chat_id, "olga")
+
+    asyncio.run(scenario())
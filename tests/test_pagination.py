@@ -0,0 +1,51 @@
+"""Keyset cursors shared by the paginated endpoints"""
+import base64
+from datetime import datetime
+
+import pytest
+
+from pagination import decode_cursor, encode_cursor, keyset_filter
+
+def test_cursor_round_trips_datetimes_at_millisecond_precision():
+    timestamp = datetime(2024, 5, 1, 12, 30, 15, 123456)
+
+    values = decode_cursor(encode_cursor(timestamp, "m1"), 2)
+
+    assert values == [datetime(2024, 5, 1, 12, 30, 15, 123000), "m1"]
+
+@pytest.mark.parametrize("token", [
+    "",
+    "not base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    base64.urlsafe_b64encode(b'{"a": 1}').decode(),
+    encode_cursor("only one value"),
+])
+def test_malformed_cursors_decode_to_none(token):
+    assert decode_cursor(token, 2) is None
+
+def _matches(row: dict, keyset: dict) -> bool:
+    """Evaluate a keyset filter against one row in memory"""
+    for branch in keyset["$or"]:
+        *equal, (field, condition) = branch.items()
+        (operator, bound), = condition.items()
+        after = row[field] < bound if operator == "$lt" else row[field] > bound
+        if after and all(row[name] == value for name, value in equal):
+            return True
+    return False
+
+def test_equal_timestamps_are_broken_by_id():
+    timestamp = datetime(2024, 5, 1, 12, 0)
+    rows = [{"timestamp": timestamp, "id": message_id} for message_id in ("a", "b", "c")]
+    rows.append({"timestamp": datetime(2024, 5, 1, 11, 0), "id": "z"})
+
+    older = keyset_filter(["timestamp", "id"], [timestamp, "b"], -1)
+    newer = keyset_filter(["timestamp", "id"], [timestamp, "b"], 1)
+
+    assert [row["id"] for row in rows if _matches(row, older)] == ["a", "z"]
+    assert [row["id"] for row in rows if _matches(row, newer)] == ["c"]
+
+def test_keyset_filter_shape():
+    assert keyset_filter(["last_activity", "chat_id"], [5, "c1"], -1) == {"$or": [
+        {"last_activity": {"$lt": 5}},
+        {"last_activity": 5, "chat_id": {"$lt": "c1"}},
+    ]}
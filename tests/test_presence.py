@@ -0,0 +1,112 @@
+"""Buffered presence writes and the users they touch"""
+import asyncio
+import uuid
+from datetime import datetime
+
+from auth import create_access_token, get_user_from_token
+from models import ContactPrivacyUpdate, SearchRequest, User
+from services.presence_service import PresenceStore, presence_store
+from services.privacy_service import PrivacyService
+from services.search_backend import folded_name_fields
+
+
+async def _user(mongo, name: str) -> User:
+    user = User(id=f"{name.lower()}-{uuid.uuid4()}", name=name)
+    await mongo["users"].insert_one({**user.dict(exclude_none=True), **folded_name_fields(user.dict())})
+    return user
+
+
+def test_flush_drops_flushed_users_from_the_auth_cache(mongo):
+    async def scenario():
+        user = User(id=f"user-{uuid.uuid4()}", name="Alice")
+        await mongo["users"].insert_one(user.dict(exclude_none=True))
+        token = create_access_token({"sub": user.id})
+        assert (await get_user_from_token(token)).is_online is False  # Now cached
+
+        store = PresenceStore(ttl_seconds=60, typing_ttl_seconds=5, flush_seconds=60)
+        await store.heartbeat(user.id)
+        await store.flush()
+
+        cached = await get_user_from_token(token)
+        assert cached.is_online is True
+        assert cached.last_seen is not None
+
+    asyncio.run(scenario())
+
+
+def test_presence_endpoint_hides_online_status_from_everyone_but_the_user(mongo):
+    import server
+
+    async def scenario():
+        alice, bob = await _user(mongo, "Alice"), await _user(mongo, "Bob")
+        await PrivacyService.update_global_privacy_settings(alice.id, {"default_show_online_status": False})
+        await presence_store.heartbeat(alice.id)
+
+        seen_by_bob = await server.get_user_presence(alice.id, current_user=bob)
+        assert seen_by_bob.is_online is None
+        assert seen_by_bob.last_seen is not None
+        assert (await server.get_user_presence(alice.id, current_user=alice)).is_online is True
+
+    asyncio.run(scenario())
+
+
+def test_presence_endpoint_hides_last_seen_from_one_contact(mongo):
+    import server
+
+    async def scenario():
+        alice, bob, carol = await _user(mongo, "Alice"), await _user(mongo, "Bob"), await _user(mongo, "Carol")
+        await PrivacyService.update_contact_privacy_settings(
+            alice.id, ContactPrivacyUpdate(contact_user_id=bob.id, show_last_seen_to_contact=False)
+        )
+        await presence_store.heartbeat(alice.id)
+
+        seen_by_bob = await server.get_user_presence(alice.id, current_user=bob)
+        assert (seen_by_bob.is_online, seen_by_bob.last_seen) == (True, None)
+        assert (await server.get_user_presence(alice.id, current_user=carol)).last_seen is not None
+
+    asyncio.run(scenario())
+
+
+def test_user_search_does_not_expose_presence(mongo):
+    import server
+
+    async def scenario():
+        alice, bob = await _user(mongo, "Zebediah"), await _user(mongo, "Bob")
+        await PrivacyService.update_global_privacy_settings(
+            alice.id, {"default_show_online_status": False, "default_show_last_seen": False}
+        )
+        await mongo["users"].update_one({"id": alice.id}, {"$set": {"is_online": True, "last_seen": datetime.utcnow()}})
+
+        result = await server.search(SearchRequest(query="zebed"), current_user=bob)
+        assert [(user.id, user.is_online, user.last_seen) for user in result.users] == [(alice.id, False, None)]
+
+    asyncio.run(scenario())
+
+
+def test_presence_lives_in_memory_until_flushed(mongo):
+    async def scenario():
+        alice, bob = await _user(mongo, "Alice"), await _user(mongo, "Bob")
+        store = PresenceStore(ttl_seconds=0, typing_ttl_seconds=5, flush_seconds=60)
+
+        await store.heartbeat(alice.id)
+        await store.heartbeat(bob.id)
+        assert (await store.get_presence(alice.id, bob.id)).is_online is True
+        assert await mongo["users"].count_documents({"is_online": True}) == 0
+        assert store.stats() == {"online": 2, "typing": 0, "pending_writes": 2}
+
+        # Lapsed heartbeats go offline as of the last heartbeat, written in the next flush
+        last_heartbeat = store._online[alice.id]
+        await store.expire()
+        await store.flush()
+        stored = await mongo["users"].find_one({"id": alice.id})
+        assert stored["is_online"] is False
+        assert abs(stored["last_seen"] - last_heartbeat).total_seconds() < 0.01
+        assert (await store.get_presence(alice.id, bob.id)).is_online is False
+
+        # Stopping takes everyone still online offline and flushes
+        await store.heartbeat(bob.id)
+        await store.stop()
+        assert (await mongo["users"].find_one({"id": bob.id}))["is_online"] is False
+        assert store.stats() == {"online": 0, "typing": 0, "pending_writes": 0}
+
+    asyncio.run(scenario())
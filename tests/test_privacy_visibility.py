@@ -0,0 +1,16 @@
+"""Privacy rules shared by the single-pair checks and the visibility matrix"""
+from models import ContactPrivacySettings, UserPrivacySettings
+from services.privacy_service import PrivacyService, PrivacyVisibility
+
+def test_contact_override_wins_over_global_settings():
+    target_privacy = UserPrivacySettings(user_id="alice", default_show_last_seen=False)
+    overrides = {
+        "bob": ContactPrivacySettings(contact_user_id="bob", show_read_receipts_to_contact=False)
+    }
+
+    assert PrivacyService.evaluate_visibility(target_privacy, overrides, "bob") == PrivacyVisibility(
+        read_receipts=False, last_seen=True, online_status=True
+    )
+    assert PrivacyService.evaluate_visibility(target_privacy, overrides, "carol") == PrivacyVisibility(
+        read_receipts=True, last_seen=False, online_status=True
+    )
@@ -0,0 +1,53 @@
+"""Reaction rows and the per-message counts derived from them"""
+import asyncio
+import uuid
+
+import pytest
+
+from models import ChatCreate, ChatType, MessageCreate
+from services.chat_service import ChatService
+from services.message_service import MessageService
+
+
+async def _message_in_group(members: int):
+    users = [f"user-{uuid.uuid4()}" for _ in range(members)]
+    chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=users[1:]), users[0])
+    message = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="hi"), users[0], "Owner")
+    return message, users
+
+
+def test_concurrent_reactions_leave_counts_matching_the_rows(mongo):
+    async def scenario():
+        message, users = await _message_in_group(8)
+        await asyncio.gather(*[MessageService.add_reaction(message.id, "👍", user_id) for user_id in users])
+        await asyncio.gather(
+            *[MessageService.remove_reaction(message.id, "👍", user_id) for user_id in users[:3]],
+            *[MessageService.add_reaction(message.id, "🎉", user_id) for user_id in users[:5]],
+            MessageService.add_reaction(message.id, "👍", users[-1])  # Duplicate, no change
+        )
+
+        stored = await mongo["messages"].find_one({"id": message.id})
+        assert stored["reaction_counts"] == {"👍": 5, "🎉": 5}
+        assert stored["updated_at"] > message.timestamp
+        assert stored["seq"] > message.seq
+
+    asyncio.run(scenario())
+
+
+def test_removing_the_last_reaction_drops_the_emoji(mongo):
+    async def scenario():
+        message, users = await _message_in_group(1)
+        added = await MessageService.add_reaction(message.id, "👍", users[0])
+        assert [(reaction.emoji, reaction.count) for reaction in added.reactions] == [("👍", 1)]
+
+        removed = await MessageService.remove_reaction(message.id, "👍", users[0])
+        assert removed.reactions == []
+        assert (await mongo["messages"].find_one({"id": message.id}))["reaction_counts"] == {}
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("emoji", ["", "a.b", "$set", "x" * 100])
+def test_invalid_reactions_are_rejected(emoji):
+    with pytest.raises(ValueError):
+        MessageService.validate_reaction(emoji)
@@ -0,0 +1,56 @@
+"""Read watermarks and the receipts derived from them"""
+import asyncio
+import uuid
+
+from models import ChatCreate, ChatType, MessageCreate
+from services.chat_service import ChatService
+from services.inbox_service import InboxService
+from services.message_service import MessageService
+from services.privacy_service import PrivacyService
+
+
+def _users(*names):
+    return [f"{name}-{uuid.uuid4()}" for name in names]
+
+
+def test_receipts_come_from_watermarks_and_respect_privacy(mongo):
+    async def scenario():
+        alice, bob, carol, dave = _users("alice", "bob", "carol", "dave")
+        chat = await ChatService.create_chat(
+            ChatCreate(name="Team", type=ChatType.group, participants=[bob, carol, dave]), alice
+        )
+        first = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="one"), alice, "Alice")
+        second = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="two"), alice, "Alice")
+
+        # Bob reads up to the second message, Carol only the first, Dave nothing
+        assert await MessageService.mark_as_read(chat.id, bob, [second.id])
+        assert await MessageService.mark_as_read(chat.id, carol, [first.id])
+        # Reading an older message never moves a watermark back
+        assert await MessageService.mark_as_read(chat.id, bob, [first.id])
+
+        assert sorted((await MessageService.get_read_receipts(first.id, alice)).read_by) == sorted([bob, carol])
+        receipts = await MessageService.get_read_receipts(second.id, alice)
+        assert (receipts.read_by, receipts.read_count) == ([bob], 1)
+        assert (await InboxService.get_entry(carol, chat.id))["unread_count"] == 1
+
+        await PrivacyService.update_global_privacy_settings(bob, {"default_show_read_receipts": False})
+        assert (await MessageService.get_read_receipts(second.id, alice)).read_by == []
+
+        # Nothing is written to the messages themselves
+        assert await mongo["messages"].count_documents({"chat_id": chat.id, "read_by": {"$exists": True}}) == 0
+
+    asyncio.run(scenario())
+
+
+def test_demo_data_seeds_watermarks_instead_of_read_by(mongo):
+    import server
+
+    async def scenario():
+        await server.create_initial_data()
+        assert await mongo["messages"].count_documents({"read_by": {"$exists": True}}) == 0
+        sender = await InboxService.get_entry("user_maria", "demo_chat_1")
+        message = await mongo["messages"].find_one({"id": "demo_msg_1"})
+        assert sender["last_read_at"] >= message["timestamp"]
+        assert (await InboxService.get_entry("demo_user_123", "demo_chat_1"))["unread_count"] == 1
+
+    asyncio.run(scenario())
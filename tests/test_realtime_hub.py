@@ -0,0 +1,59 @@
+"""In-process fan-out behind the realtime WebSocket endpoint"""
+import asyncio
+import json
+
+from services.realtime_hub import RealtimeHub
+
+def test_publish_reaches_only_followers_of_the_chat():
+    hub = RealtimeHub(queue_size=10, max_subscriptions=10)
+    alice = hub.connect("alice", ["chat_a"])
+    bob = hub.connect("bob", ["chat_b"])
+
+    hub.publish("chat_a", "message.deleted", {"message_id": "m1"})
+
+    event = json.loads(alice.queue.get_nowait())
+    assert event == {"type": "message.deleted", "chat_id": "chat_a", "data": {"message_id": "m1"}}
+    assert bob.queue.empty()
+
+def test_full_queue_evicts_the_slow_subscriber():
+    hub = RealtimeHub(queue_size=2, max_subscriptions=10)
+    slow = hub.connect("alice", ["chat_a"])
+    fast = hub.connect("bob", ["chat_a"])
+
+    for position in range(3):
+        hub.publish("chat_a", "message.deleted", {"message_id": f"m{position}"})
+        fast.queue.get_nowait()
+
+    assert slow.evicted.is_set() and not fast.evicted.is_set()
+    assert hub.subscriptions["chat_a"] == {fast}
+    assert hub.stats() == {"connections": 1, "chats": 1, "evictions": 1}
+    assert asyncio.run(slow.next_event()) is None
+
+def test_membership_changes_follow_every_connection_of_the_user():
+    hub = RealtimeHub(queue_size=10, max_subscriptions=10)
+    phone = hub.connect("alice", [])
+    laptop = hub.connect("alice", [])
+
+    hub.add_member("chat_a", "alice")
+    assert phone.chat_ids == laptop.chat_ids == {"chat_a"}
+
+    hub.remove_member("chat_a", "alice")
+    assert "chat_a" not in hub.subscriptions
+
+def test_disconnect_forgets_the_subscriber():
+    hub = RealtimeHub(queue_size=10, max_subscriptions=2)
+    subscriber = hub.connect("alice", ["chat_a", "chat_b", "chat_c"])
+
+    assert subscriber.chat_ids == {"chat_a", "chat_b"}
+    hub.disconnect(subscriber)
+    assert hub.subscriptions == {} and hub.subscribers_by_user == {}
+
+def test_presence_watchers_share_the_subscription_limit():
+    hub = RealtimeHub(queue_size=10, max_subscriptions=3)
+    subscriber = hub.connect("alice", ["chat_a"])
+
+    assert hub.watch_presence(subscriber, ["bob", "carol", "dave"]) == ["bob", "carol"]
+    assert hub.presence_watchers["bob"] == {subscriber}
+
+    hub.disconnect(subscriber)
+    assert hub.presence_watchers == {} and not hub.is_connected("alice")
@@ -0,0 +1,76 @@
+"""Delivery of scheduled messages under a per-message lease"""
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta
+
+from models import ChatCreate, ChatType, MessageCreate
+from services.chat_service import ChatService
+from services.message_service import MessageService
+from services.realtime_hub import realtime_hub
+from services.scheduled_dispatcher import ScheduledMessageDispatcher
+
+
+def _dispatcher(lease_seconds: float = 30) -> ScheduledMessageDispatcher:
+    return ScheduledMessageDispatcher(window_seconds=60, lease_seconds=lease_seconds, batch_size=100)
+
+
+async def _due_message(mongo):
+    alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+    chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+    message = await MessageService.create_message(
+        MessageCreate(chat_id=chat.id, text="good morning", scheduled_for=datetime.utcnow() + timedelta(hours=1)), alice, "Alice"
+    )
+    assert message.is_scheduled
+    await mongo["messages"].update_one({"id": message.id}, {"$set": {"scheduled_for": datetime.utcnow() - timedelta(seconds=1)}})
+    return chat, message, bob
+
+
+def _events(subscriber):
+    events = []
+    while not subscriber.queue.empty():
+        events.append(json.loads(subscriber.queue.get_nowait()))
+    return events
+
+
+def test_contending_dispatchers_deliver_a_message_once(mongo):
+    async def scenario():
+        chat, message, bob = await _due_message(mongo)
+        subscriber = realtime_hub.connect(bob, [chat.id])
+        try:
+            delivered = await asyncio.gather(*[_dispatcher().deliver([message.id]) for _ in range(3)])
+            events = _events(subscriber)
+        finally:
+            realtime_hub.disconnect(subscriber)
+
+        assert sorted(delivered) == [0, 0, 1]
+        assert [(event["type"], event["data"]["message"]["id"]) for event in events] == [("message.created", message.id)]
+        stored = await mongo["messages"].find_one({"id": message.id})
+        assert stored["is_scheduled"] is False
+        assert "dispatch_owner" not in stored and stored["seq"] is not None
+
+        updates = await MessageService.get_chat_updates(chat.id, bob, 0)
+        assert [sent.id for sent in updates.messages] == [message.id]
+
+    asyncio.run(scenario())
+
+
+def test_a_dispatcher_whose_lease_ran_out_does_not_deliver(mongo):
+    async def scenario():
+        chat, message, bob = await _due_message(mongo)
+        subscriber = realtime_hub.connect(bob, [chat.id])
+        try:
+            # The lease is over before the delivery write, so the claim no longer holds
+            assert await _dispatcher(lease_seconds=0).deliver([message.id]) == 0
+            assert _events(subscriber) == []
+            assert (await mongo["messages"].find_one({"id": message.id}))["is_scheduled"] is True
+
+            # Later, another dispatcher takes over the lapsed claim
+            lapsed = datetime.utcnow() - timedelta(seconds=1)
+            await mongo["messages"].update_one({"id": message.id}, {"$set": {"dispatch_lease_until": lapsed}})
+            assert await _dispatcher().deliver([message.id]) == 1
+            assert [event["type"] for event in _events(subscriber)] == ["message.created"]
+        finally:
+            realtime_hub.disconnect(subscriber)
+
+    asyncio.run(scenario())
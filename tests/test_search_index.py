@@ -0,0 +1,91 @@
+"""In-memory inverted index used by the "inverted" search backend"""
+from datetime import datetime
+
+from services.search_backend import InvertedIndex, InvertedIndexSearchBackend, fold
+
+def build_index():
+    search_index = InvertedIndex()
+    search_index.add("m1", "chat_a", "Vamos marcar uma Conversa amanhã", 100.0)
+    search_index.add("m2", "chat_a", "conversação encerrada", 200.0)
+    search_index.add("m3", "chat_b", "Conversa privada", 300.0)
+    return search_index
+
+def test_fold_strips_accents_and_case():
+    assert fold("Convérsa AMANHÃ") == "conversa amanha"
+
+def test_prefix_and_accent_insensitive_match():
+    search_index = build_index()
+
+    results = search_index.search("convers", ["chat_a", "chat_b"], now=0)
+
+    assert [message_id for _, _, message_id in results] == ["m3", "m1", "m2"]
+
+def test_exact_words_rank_above_prefixes():
+    search_index = build_index()
+
+    results = search_index.search("conversa", ["chat_a"], now=0)
+
+    assert [message_id for _, _, message_id in results] == ["m1", "m2"]
+    assert results[0][0] > results[1][0]
+
+def test_every_query_word_must_match():
+    search_index = build_index()
+
+    assert [result[2] for result in search_index.search("conv amanha", ["chat_a"], now=0)] == ["m1"]
+    assert search_index.search("conv inexistente", ["chat_a"], now=0) == []
+
+def test_search_is_limited_to_the_given_chats():
+    search_index = build_index()
+
+    assert [result[2] for result in search_index.search("privada", ["chat_a"], now=0)] == []
+    assert [result[2] for result in search_index.search("privada", ["chat_b"], now=0)] == ["m3"]
+
+def test_expired_messages_are_skipped():
+    search_index = InvertedIndex()
+    search_index.add("m1", "chat_a", "segredo", 100.0, expires_at=150.0)
+
+    assert search_index.search("segredo", ["chat_a"], now=140.0)
+    assert search_index.search("segredo", ["chat_a"], now=160.0) == []
+
+def test_edit_and_remove_clean_up_postings():
+    search_index = build_index()
+
+    search_index.add("m3", "chat_b", "mensagem editada", 300.0)
+    search_index.remove("m1")
+    search_index.remove("m2")
+
+    assert search_index.search("conv", ["chat_a", "chat_b"], now=0) == []
+    assert "conversa" not in search_index.postings
+    assert "co" not in search_index.grams
+    assert search_index.search("edit", ["chat_b"], now=0)[0][2] == "m3"
+
+def test_typeahead_ranks_words_by_frequency_in_scope():
+    search_index = build_index()
+    search_index.add("m4", "chat_a", "converse comigo", 400.0)
+    search_index.add("m5", "chat_a", "Converse de novo", 500.0)
+
+    assert search_index.typeahead("vamos conv", ["chat_a"], limit=2) == ["converse", "conversa"]
+    assert search_index.typeahead("c", ["chat_a"], limit=5) == []
+
+def test_snapshot_round_trip():
+    search_index = build_index()
+
+    restored = InvertedIndex()
+    restored.load(search_index.dump())
+
+    assert len(restored) == 3
+    assert restored.search("convers", ["chat_a", "chat_b"], now=0) == search_index.search("convers", ["chat_a", "chat_b"], now=0)
+
+def test_snapshot_round_trip_leaves_no_temporary_files(tmp_path):
+    snapshot_path = tmp_path / "search_index.json.gz"
+    backend = InvertedIndexSearchBackend(str(snapshot_path), snapshot_interval=300, sync_interval=5)
+    snapshot = build_index().dump()
+    snapshot["synced_until"] = datetime(2024, 5, 1).isoformat()
+
+    backend._write_snapshot(snapshot)
+    backend._write_snapshot(snapshot)
+
+    synced_until, loaded = backend._read_snapshot()
+    assert synced_until == datetime(2024, 5, 1)
+    assert len(loaded["documents"]) == 3
+    assert [path.name for path in tmp_path.iterdir()] == ["search_index.json.gz"]
@@ -0,0 +1,64 @@
+"""Self-destruct timers and the sweeper that hides expired messages"""
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import ChatCreate, ChatType, MessageCreate
+from services.chat_service import ChatService
+from services.expiry_sweeper import MessageExpirySweeper, parse_self_destruct
+from services.message_service import MessageService
+from services.realtime_hub import realtime_hub
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("30s", timedelta(seconds=30)),
+    ("5m", timedelta(minutes=5)),
+    (" 1H ", timedelta(hours=1)),
+    ("1d", timedelta(days=1)),
+    ("2w", timedelta(weeks=2)),
+])
+def test_parse_self_destruct_units(value, expected):
+    assert parse_self_destruct(value) == expected
+
+
+@pytest.mark.parametrize("value", [None, ""])
+def test_parse_self_destruct_without_timer(value):
+    assert parse_self_destruct(value) is None
+
+
+@pytest.mark.parametrize("value", ["0s", "5", "m", "-5m", "1.5h", "5y", "5 m s"])
+def test_parse_self_destruct_rejects_malformed_timers(value):
+    with pytest.raises(ValueError):
+        parse_self_destruct(value)
+
+
+def test_expiry_goes_through_the_delete_path(mongo):
+    async def scenario():
+        alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+        chat = await ChatService.create_chat(ChatCreate(name="Secret", type=ChatType.group, participants=[bob]), alice)
+        message = await MessageService.create_message(
+            MessageCreate(chat_id=chat.id, text="burn after reading", self_destruct="1h"), alice, "Alice"
+        )
+        await mongo["messages"].update_one({"id": message.id}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+
+        subscriber = realtime_hub.connect(bob, [chat.id])
+        sweeper = MessageExpirySweeper(batch_seconds=0, idle_seconds=60, batch_size=1)
+        sweeper.start(MessageService.hide_messages)
+        try:
+            event = json.loads(await asyncio.wait_for(subscriber.next_event(), timeout=5))
+        finally:
+            await sweeper.stop()
+            realtime_hub.disconnect(subscriber)
+
+        assert event == {"type": "message.deleted", "chat_id": chat.id, "data": {"message_id": message.id}}
+        stored = await mongo["messages"].find_one({"id": message.id})
+        assert stored["is_deleted"] is True
+        assert stored["seq"] > message.seq
+
+        updates = await MessageService.get_chat_updates(chat.id, bob, message.seq)
+        assert [(sent.id, sent.is_deleted, sent.text) for sent in updates.messages] == [(message.id, True, None)]
+
+    asyncio.run(scenario())
@@ -0,0 +1,79 @@
+"""Delta sync of messages changed since a token"""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+from indexes import INDEX_REGISTRY, SYNC_TOMBSTONE_TTL_SECONDS
+from models import ChatCreate, ChatType, MessageCreate
+from pagination import encode_cursor
+from services.chat_service import ChatService
+from services.message_service import MessageService
+from services.sync_service import SyncService
+
+
+def test_reactions_and_deletes_reach_the_next_sync(mongo):
+    async def scenario():
+        alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+        chat = await ChatService.create_chat(ChatCreate(name="Team", type=ChatType.group, participants=[bob]), alice)
+        liked = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="like me"), alice, "Alice")
+        doomed = await MessageService.create_message(MessageCreate(chat_id=chat.id, text="delete me"), alice, "Alice")
+        # Both were synced long ago
+        an_hour_ago = datetime.utcnow() - timedelta(hours=1)
+        await mongo["messages"].update_many({"chat_id": chat.id}, {"$set": {"updated_at": an_hour_ago}})
+        token = encode_cursor(datetime.utcnow() - timedelta(minutes=1))
+        assert (await SyncService.sync(bob, token)).messages == []
+
+        await MessageService.add_reaction(liked.id, "👍", bob)
+        await MessageService.delete_message(doomed.id, alice)
+
+        response = await SyncService.sync(bob, token)
+        assert [(message.id, [(reaction.emoji, reaction.count) for reaction in message.reactions]) for message in response.messages] == [
+            (liked.id, [("👍", 1)])
+        ]
+        assert response.deleted_message_ids == [doomed.id]
+
+    asyncio.run(scenario())
+
+
+def test_self_destructed_messages_outlive_every_token_that_could_miss_them(mongo):
+    [ttl] = [spec for spec in INDEX_REGISTRY["messages"] if "expireAfterSeconds" in spec.options]
+    assert ttl.fields == ["expires_at"]
+    assert ttl.options["expireAfterSeconds"] >= SYNC_TOMBSTONE_TTL_SECONDS
+
+    async def scenario():
+        alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+        chat = await ChatService.create_chat(ChatCreate(name="Secret", type=ChatType.group, participants=[bob]), alice)
+        secret = await MessageService.create_message(
+            MessageCreate(chat_id=chat.id, text="burn after reading", self_destruct="1m"), alice, "Alice"
+        )
+        token = encode_cursor(datetime.utcnow())
+        await mongo["messages"].update_one({"id": secret.id}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+        await MessageService.hide_messages([{"id": secret.id, "chat_id": chat.id}])
+        assert (await SyncService.sync(bob, token)).deleted_message_ids == [secret.id]
+
+        # Once the TTL monitor may remove the row, every token from before the expiry gets a reset
+        expired_at = datetime.utcnow() - timedelta(seconds=SYNC_TOMBSTONE_TTL_SECONDS)
+        await mongo["messages"].delete_one({"id": secret.id})
+        token_before_expiry = encode_cursor(expired_at - timedelta(seconds=1))
+        response = await SyncService.sync(bob, token_before_expiry)
+        assert response.reset is True
+
+    asyncio.run(scenario())
+
+
+def test_expired_messages_are_reported_deleted_before_the_sweep(mongo):
+    async def scenario():
+        alice, bob = f"alice-{uuid.uuid4()}", f"bob-{uuid.uuid4()}"
+        chat = await ChatService.create_chat(ChatCreate(name="Secret", type=ChatType.group, participants=[bob]), alice)
+        token = encode_cursor(datetime.utcnow())
+        secret = await MessageService.create_message(
+            MessageCreate(chat_id=chat.id, text="burn after reading", self_destruct="1m"), alice, "Alice"
+        )
+        # Expired, but the sweeper has not hidden it yet
+        await mongo["messages"].update_one({"id": secret.id}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+
+        response = await SyncService.sync(bob, token)
+        assert response.messages == []
+        assert response.deleted_message_ids == [secret.id]
+
+    asyncio.run(scenario())
@@ -0,0 +1,50 @@
+"""TTL expiry and LRU eviction of the in-process caches"""
+import cache
+from cache import TTLCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, "time", clock)
+    users = TTLCache(maxsize=10, ttl=30)
+
+    users.set("alice", {"name": "Alice"})
+    clock.now += 29
+    assert users.get("alice") == {"name": "Alice"}
+
+    clock.now += 1
+    assert users.get("alice") is None
+    assert len(users) == 0
+    assert (users.hits, users.misses) == (1, 1)
+
+def test_least_recently_used_entry_is_evicted_first():
+    users = TTLCache(maxsize=2, ttl=30)
+    users.set("alice", 1)
+    users.set("bob", 2)
+
+    users.get("alice")
+    users.set("carol", 3)
+
+    assert users.get("bob") is None
+    assert users.get("alice") == 1 and users.get("carol") == 3
+
+def test_invalidate_drops_only_that_key():
+    users = TTLCache(maxsize=10, ttl=30)
+    users.set("alice", 1)
+    users.set("bob", 2)
+
+    users.invalidate("alice")
+    users.invalidate("nobody")
+
+    assert users.get("alice") is None and users.get("bob") == 2
+
+def test_zero_maxsize_disables_the_cache():
+    users = TTLCache(maxsize=0, ttl=30)
+    users.set("alice", 1)
+    assert users.get("alice") is None and users.stats()["size"] == 0